@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Compare the speed of hydrating documents from SON (and encoding them back)
+using the per-class codecs against building them through the constructor,
+which is how documents were created before the codecs were added.
+
+No database connection is needed::
+
+    $ python benchmark.py
+"""
+
+import datetime
+import timeit
+
+import pymongo.objectid
+
+from mongoengine import *
+
+
+NUMBER_OF_DOCUMENTS = 10000
+
+
+class Comment(EmbeddedDocument):
+    author = StringField()
+    content = StringField(db_field='c')
+    votes = IntField(default=0)
+
+
+class BlogPost(Document):
+    title = StringField(required=True)
+    slug = StringField()
+    content = StringField()
+    hits = IntField(default=0)
+    rating = FloatField()
+    published = BooleanField(default=False)
+    published_date = DateTimeField()
+    tags = ListField(StringField())
+    comments = ListField(EmbeddedDocumentField(Comment))
+    extra = DictField()
+
+
+def legacy_from_son(cls, son):
+    """Build a document the way ``_from_son`` used to: through ``cls(...)``.
+    """
+    data = dict((str(key), value) for key, value in son.items())
+    data.pop('_types', None)
+    data.pop('_cls', None)
+    for field_name, field in cls._fields.items():
+        if field.db_field in data:
+            data[field_name] = field.to_python(data[field.db_field])
+    return cls(None, **data)
+
+
+def legacy_to_mongo(doc):
+    """Encode a document the way ``to_mongo`` used to, using ``getattr``.
+    """
+    data = {}
+    for field_name, field in doc._fields.items():
+        value = getattr(doc, field_name, None)
+        if value is not None:
+            data[field.db_field] = field.to_mongo(value)
+    data['_cls'] = doc._class_name
+    data['_types'] = doc._superclasses.keys() + [doc._class_name]
+    return data
+
+
+def make_sons():
+    sons = []
+    for i in range(NUMBER_OF_DOCUMENTS):
+        sons.append({
+            '_id': pymongo.objectid.ObjectId(),
+            '_cls': 'BlogPost',
+            '_types': ['BlogPost'],
+            'title': u'Post %s' % i,
+            'slug': u'post-%s' % i,
+            'content': u'Lorem ipsum dolor sit amet ' * 10,
+            'hits': i,
+            'rating': 3.5,
+            'published': True,
+            'published_date': datetime.datetime(2010, 1, 1),
+            'tags': [u'mongodb', u'python', u'benchmark'],
+            'comments': [
+                {'_cls': 'Comment', '_types': ['Comment'], 'author': u'Bob',
+                 'c': u'Nice post', 'votes': 2},
+                {'_cls': 'Comment', '_types': ['Comment'], 'author': u'Alice',
+                 'c': u'Thanks', 'votes': 1},
+            ],
+            'extra': {'source': u'import'},
+        })
+    return sons
+
+
+def best_of(func, repeat=3):
+    return min(timeit.Timer(func).repeat(repeat=repeat, number=1))
+
+
+def main():
+    sons = make_sons()
+    docs = [BlogPost._from_son(son) for son in sons]
+
+    # Embedded documents must be built the old way too
+    BlogPost._from_son = Comment._from_son = classmethod(legacy_from_son)
+    legacy_time = best_of(lambda: [BlogPost._from_son(son) for son in sons])
+    del BlogPost._from_son, Comment._from_son
+
+    results = [
+        ('_from_son (constructor)', legacy_time,
+         '_from_son (codec)',
+         best_of(lambda: [BlogPost._from_son(son) for son in sons])),
+        ('to_mongo (getattr)',
+         best_of(lambda: [legacy_to_mongo(doc) for doc in docs]),
+         'to_mongo (codec)',
+         best_of(lambda: [doc.to_mongo() for doc in docs])),
+    ]
+
+    print 'Documents: %d' % NUMBER_OF_DOCUMENTS
+    for old_name, old_time, new_name, new_time in results:
+        print '%-26s %8.3fs' % (old_name, old_time)
+        print '%-26s %8.3fs  (%.1fx)' % (new_name, new_time,
+                                         old_time / new_time)
+
+
+if __name__ == '__main__':
+    main()
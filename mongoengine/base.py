@@ -15,6 +15,11 @@ except ImportError:
     
 _document_registry = {}
 
+# Every top-level document class that has been defined, including those
+# whose names are reused in other modules, which replace them in
+# _document_registry
+_document_classes = []
+
 def get_document(name):
     return _document_registry[name]
 
@@ -64,6 +69,24 @@ class BaseField(object):
         """Descriptor for assigning a value to a field in a document.
         """
         instance._data[self.name] = value
+        instance._mark_as_changed(self.name)
+
+    def _track_changes(self, instance, value):
+        """Wrap a mutable container so that modifying it in place marks the
+        field as changed on the document holding it.
+        """
+        if isinstance(value, (BaseList, BaseDict, BaseSet)):
+            return value
+        if isinstance(value, list):
+            value = BaseList(value, instance, self.name)
+        elif isinstance(value, dict):
+            value = BaseDict(value, instance, self.name)
+        elif isinstance(value, set):
+            value = BaseSet(value, instance, self.name)
+        else:
+            return value
+        instance._data[self.name] = value
+        return value
 
     def to_python(self, value):
         """Convert a MongoDB-compatible type to a Python type.
@@ -105,10 +128,6 @@ class ObjectIdField(BaseField):
     """An field wrapper around MongoDB's ObjectIds.
     """
     
-    def to_python(self, value):
-        return value
-        # return unicode(value)
-
     def to_mongo(self, value):
         if not isinstance(value, pymongo.objectid.ObjectId):
             try:
@@ -128,6 +147,167 @@ class ObjectIdField(BaseField):
             raise ValidationError('Invalid Object ID')
 
 
+class BaseList(list):
+    """A list that marks the field holding it as changed when it is modified
+    in place.
+    """
+
+    def __init__(self, items, instance, name):
+        self._instance = instance
+        self._name = name
+        super(BaseList, self).__init__(items)
+
+    def __reduce__(self):
+        # Pickle the items with the constructor's arguments, as restoring
+        # them through the wrapped methods would need _instance to be set
+        return (self.__class__, (list(self), self._instance, self._name))
+
+
+class BaseDict(dict):
+    """A dict that marks the field holding it as changed when it is modified
+    in place.
+    """
+
+    def __init__(self, items, instance, name):
+        self._instance = instance
+        self._name = name
+        super(BaseDict, self).__init__(items)
+
+    def __reduce__(self):
+        # Pickle the items with the constructor's arguments, as restoring
+        # them through the wrapped methods would need _instance to be set
+        return (self.__class__, (dict(self), self._instance, self._name))
+
+
+class BaseSet(set):
+    """A set that marks the field holding it as changed when it is modified
+    in place.
+    """
+
+    def __init__(self, items, instance, name):
+        self._instance = instance
+        self._name = name
+        super(BaseSet, self).__init__(items)
+
+    def __reduce__(self):
+        # Pickle the items with the constructor's arguments, as restoring
+        # them through the wrapped methods would need _instance to be set
+        return (self.__class__, (set(self), self._instance, self._name))
+
+
+class LazyData(dict):
+    """The ``_data`` dict of a lazily hydrated document. Values are stored as
+    they were read from the database and converted with their field's
+    ``to_python`` the first time they are read.
+    """
+
+    def __init__(self):
+        super(LazyData, self).__init__()
+        self._converters = {}
+
+    def _set_raw(self, key, value, to_python):
+        dict.__setitem__(self, key, value)
+        self._converters[key] = to_python
+
+    def _hydrate(self, key):
+        value = self._converters.pop(key)(dict.__getitem__(self, key))
+        dict.__setitem__(self, key, value)
+        return value
+
+    def _hydrate_all(self):
+        for key in self._converters.keys():
+            self._hydrate(key)
+
+    def __getitem__(self, key):
+        if key in self._converters:
+            return self._hydrate(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self._converters.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def get(self, key, default=None):
+        if key in self._converters:
+            return self._hydrate(key)
+        return dict.get(self, key, default)
+
+    def __delitem__(self, key):
+        self._converters.pop(key, None)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self._converters:
+            self._hydrate(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        to_python = self._converters.pop(key, None)
+        if to_python is not None:
+            value = to_python(value)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key in self._converters:
+            return self._hydrate(key)
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def values(self):
+        self._hydrate_all()
+        return dict.values(self)
+
+    def items(self):
+        self._hydrate_all()
+        return dict.items(self)
+
+    def itervalues(self):
+        self._hydrate_all()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self._hydrate_all()
+        return dict.iteritems(self)
+
+    def __reduce__(self):
+        # Converters are bound methods, which can't be pickled, so the
+        # values are converted and pickled as a plain dict
+        self._hydrate_all()
+        return (dict, (dict(self),))
+
+
+def _mark_changed(base, method_name):
+    """Wrap a mutating method of a container type so that it marks the field
+    holding the container as changed before running.
+    """
+    method = getattr(base, method_name)
+    def wrapper(self, *args, **kwargs):
+        self._instance._mark_as_changed(self._name)
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method_name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+_mutating_methods = {
+    BaseList: ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+               '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+               'remove', 'reverse', 'sort'),
+    BaseDict: ('__setitem__', '__delitem__', 'clear', 'pop', 'popitem',
+               'setdefault', 'update'),
+    BaseSet: ('__iand__', '__ior__', '__isub__', '__ixor__', 'add', 'clear',
+              'difference_update', 'discard', 'intersection_update', 'pop',
+              'remove', 'symmetric_difference_update', 'update'),
+}
+for container_cls, method_names in _mutating_methods.items():
+    for method_name in method_names:
+        setattr(container_cls, method_name,
+                _mark_changed(container_cls.__bases__[0], method_name))
+
+
 class DocumentMetaclass(type):
     """Metaclass for all documents.
     """
@@ -232,6 +412,7 @@ class TopLevelDocumentMetaclass(DocumentMetaclass):
         collection = name.lower()
         
         id_field = None
+        db_alias = None
         base_indexes = []
 
         # Subclassed documents inherit collection from superclass
@@ -240,6 +421,7 @@ class TopLevelDocumentMetaclass(DocumentMetaclass):
                 collection = base._meta['collection']
 
                 id_field = id_field or base._meta.get('id_field')
+                db_alias = db_alias or base._meta.get('db_alias')
                 base_indexes += base._meta.get('indexes', [])
 
         meta = {
@@ -250,6 +432,7 @@ class TopLevelDocumentMetaclass(DocumentMetaclass):
             'indexes': [], # indexes to be ensured at runtime
             'geo_indexes': [],
             'id_field': id_field,
+            'db_alias': db_alias,
         }
 
         # Apply document-defined meta options
@@ -308,9 +491,12 @@ class TopLevelDocumentMetaclass(DocumentMetaclass):
         if not new_class._meta['id_field']:
             new_class._meta['id_field'] = 'id'
             new_class._fields['id'] = ObjectIdField(db_field='_id')
+            new_class._fields['id'].name = 'id'
+            new_class._fields['id'].owner_document = new_class
             new_class.id = new_class._fields['id']
 
         _document_registry[name] = new_class
+        _document_classes.append(new_class)
 
         return new_class
 
@@ -323,6 +509,9 @@ class BaseDocument(object):
             signals.pre_init.send(sender=self.__class__, args=[], kwargs=values)
         self._data = {}
         self._dynamic_fields = {}
+        self._changed_fields = set()
+        # Documents are created until they are saved or loaded from the db
+        self._created = True
         # Assign initial values to instance
         if dynamic_fields_list is not None:
             for field_name in dynamic_fields_list:
@@ -342,9 +531,13 @@ class BaseDocument(object):
         """Ensure that all fields' values are valid and that required fields
         are present.
         """
-        # Get a list of tuples of field names and their current values
-        fields = [(field, getattr(self, name)) 
-                  for name, field in self._fields.items()]
+        # Get a list of tuples of field names and their current values.
+        # Lazily hydrated values that haven't been converted since they were
+        # loaded are left unconverted, and aren't validated again
+        unconverted = getattr(self._data, '_converters', {})
+        fields = [(field, getattr(self, name))
+                  for name, field in self._fields.items()
+                  if name not in unconverted]
 
         # Ensure that each field is matched to a valid value
         for field, value in fields:
@@ -357,6 +550,65 @@ class BaseDocument(object):
             elif field.required:
                 raise ValidationError('Field "%s" is required' % field.name)
 
+    def _mark_as_changed(self, name):
+        """Record that a field has been changed since the document was
+        loaded or saved.
+        """
+        self._changed_fields.add(name)
+
+    def _clear_changed_fields(self):
+        """Forget the changes to this document and the documents embedded
+        in it, e.g. once they have been saved.
+        """
+        self._changed_fields = set()
+        # Values that haven't been hydrated yet can't have been changed
+        for value in dict.itervalues(self._data):
+            for item in _embedded_documents(value):
+                item[1]._clear_changed_fields()
+
+    def _get_changed_fields(self, prefix=''):
+        """Return a list of ``(db path, field, value)`` tuples for the fields
+        that have been changed, following embedded documents (including those
+        held in lists and dicts) and using dotted paths for their fields.
+        """
+        changed = []
+        unhydrated = getattr(self._data, '_converters', ())
+        for name, field in self._fields.items():
+            key = prefix + field.db_field
+            if name in self._changed_fields:
+                value = self._data.get(name)
+                if value is None:
+                    value = getattr(self, name, None)
+                changed.append((key, field, value))
+                continue
+            if name in unhydrated:
+                continue
+            value = self._data.get(name)
+            for path, item in _embedded_documents(value):
+                item_prefix = '.'.join([key] + path) + '.'
+                changed += item._get_changed_fields(item_prefix)
+        return changed
+
+    def _delta(self):
+        """Return the ``$set`` and ``$unset`` parts of an update that writes
+        the changes made to the document since it was loaded or saved.
+        """
+        set_data = {}
+        unset_data = {}
+        for key, field, value in self._get_changed_fields():
+            if value is None:
+                unset_data[key] = 1
+            else:
+                set_data[key] = field.to_mongo(value)
+
+        # Dynamic fields are not tracked, so always write them
+        dynamic_fields = self._data.get('_dynamic_fields_list') or []
+        for field_name in dynamic_fields:
+            if field_name in self._data:
+                set_data[field_name] = getattr(self, field_name,
+                                               self._data[field_name])
+        return set_data, unset_data
+
     @classmethod
     def _get_subclasses(cls):
         """Return a dictionary of all subclasses (found recursively).
@@ -419,10 +671,23 @@ class BaseDocument(object):
         """Return data dictionary ready for use with MongoDB.
         """
         data = {}
-        for field_name, field in self._fields.items():
-            value = getattr(self, field_name, None)
-            if value is not None:
-                data[field.db_field] = field.to_mongo(value)
+        unhydrated = getattr(self._data, '_converters', None)
+        for field_name, db_field, to_mongo, in_data in self._get_codec()[2]:
+            if unhydrated and field_name in unhydrated:
+                # Still in the form it was read from the database
+                data[db_field] = dict.__getitem__(self._data, field_name)
+                continue
+            value = None
+            if in_data:
+                value = self._data.get(field_name)
+            if value is None:
+                # Use the default value, if there is one
+                value = getattr(self, field_name, None)
+                if value is None:
+                    continue
+            if to_mongo is not None:
+                value = to_mongo(value)
+            data[db_field] = value
         # Only add _cls and _types if allow_inheritance is not False
         if not (hasattr(self, '_meta') and
                 self._meta.get('allow_inheritance', True) == False):
@@ -437,21 +702,60 @@ class BaseDocument(object):
         return self.to_mongo()
     
     @classmethod
-    def _from_son(cls, son):
+    def _get_codec(cls):
+        """Return the plan used to convert between SON and instances of this
+        class, building it the first time it is needed. The plan is a tuple
+        of the number of fields it was built for, a list of ``(db_field,
+        field_name, to_python, default)`` tuples for decoding and a list of
+        ``(field_name, db_field, to_mongo, in_data)`` tuples for encoding,
+        where converters that would return their input unchanged are ``None``
+        and ``in_data`` tells whether the value is kept in ``_data`` by a
+        field descriptor (dynamic fields are plain attributes). The last item
+        tells whether the class uses the default constructor.
+        """
+        codec = cls.__dict__.get('_codec')
+        # Dynamic fields may be added to _fields after the plan was built
+        if codec is not None and codec[0] == len(cls._fields):
+            return codec
+
+        decode = []
+        encode = []
+        for field_name, field in cls._fields.items():
+            field_cls = field.__class__
+            to_python = field.to_python
+            if field_cls.to_python.im_func is BaseField.to_python.im_func:
+                to_python = None
+            to_mongo = field.to_mongo
+            if to_python is None and \
+               field_cls.to_mongo.im_func is BaseField.to_mongo.im_func:
+                to_mongo = None
+            in_data = getattr(cls, field_name, None) is field
+            decode.append((field.db_field, field_name, to_python,
+                           field.default))
+            encode.append((field_name, field.db_field, to_mongo, in_data))
+
+        # Instances may be created without calling the constructor, unless a
+        # subclass has its own
+        plain_init = cls.__init__.im_func is BaseDocument.__init__.im_func
+
+        codec = (len(cls._fields), decode, encode, plain_init)
+        cls._codec = codec
+        return codec
+
+    @classmethod
+    def _from_son(cls, son, lazy=None):
         """Create an instance of a Document (subclass) from a PyMongo SON.
+
+        :param lazy: keep the raw values and only convert each one when its
+            field is first read; defaults to :attr:`lazy_hydration` in the
+            document's :attr:`meta`. Documents with dynamic fields or a
+            custom ``__init__`` are always hydrated fully, as they are built
+            through the constructor
         """
         # get the class name from the document, falling back to the given
         # class if unavailable
         class_name = son.get(u'_cls', cls._class_name)
 
-        data = dict((str(key), value) for key, value in son.items())
-
-        if '_types' in data:
-            del data['_types']
-
-        if '_cls' in data:
-            del data['_cls']
-
         # Return correct subclass for document type
         if class_name != cls._class_name:
             subclasses = cls._get_subclasses()
@@ -461,6 +765,60 @@ class BaseDocument(object):
                 return None
             cls = subclasses[class_name]
 
+        # Documents with dynamic fields or a custom constructor are built
+        # through the constructor
+        codec = cls._get_codec()
+        if not codec[3] or '_dynamic_fields_list' in son:
+            return cls._from_son_with_init(son)
+
+        if lazy is None:
+            lazy = cls._meta.get('lazy_hydration', False)
+
+        if lazy:
+            data = LazyData()
+        else:
+            data = {}
+        for db_field, field_name, to_python, default in codec[1]:
+            value = son.get(db_field)
+            if value is None:
+                value = default
+                # Allow callable default values
+                if callable(value):
+                    value = value()
+            elif to_python is not None:
+                if lazy:
+                    data._set_raw(field_name, value, to_python)
+                    continue
+                value = to_python(value)
+            data[field_name] = value
+
+        # Send the signals the constructor would, receivers of pre_init may
+        # change the values before the document is created
+        if signals:
+            signals.pre_init.send(sender=cls, args=[], kwargs=data)
+        obj = cls.__new__(cls)
+        obj._data = data
+        obj._dynamic_fields = {}
+        obj._changed_fields = set()
+        obj._created = False
+        obj._present_fields = son.keys()
+        if signals:
+            signals.post_init.send(sender=cls, instance=obj)
+        return obj
+
+    @classmethod
+    def _from_son_with_init(cls, son):
+        """Create an instance of this exact class from a PyMongo SON by
+        calling its constructor.
+        """
+        data = dict((str(key), value) for key, value in son.items())
+
+        if '_types' in data:
+            del data['_types']
+
+        if '_cls' in data:
+            del data['_cls']
+
         present_fields = data.keys()
         for field_name, field in cls._fields.items():
             if field.db_field in data:
@@ -475,6 +833,8 @@ class BaseDocument(object):
 
         obj = cls(dynamic_fields_list, **data)
         obj._present_fields = present_fields
+        obj._changed_fields = set()
+        obj._created = False
         return obj
     
     def __eq__(self, other):
@@ -483,6 +843,22 @@ class BaseDocument(object):
                 return True
         return False
 
+def _embedded_documents(value):
+    """Yield ``(path, document)`` pairs for the embedded documents held by a
+    field value, where ``path`` is a list of the list indexes or dict keys
+    leading to the document.
+    """
+    if isinstance(value, BaseDocument):
+        yield [], value
+    elif isinstance(value, (list, tuple)):
+        for i, item in enumerate(value):
+            if isinstance(item, BaseDocument):
+                yield [str(i)], item
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, BaseDocument):
+                yield [key], item
+
 if sys.version_info < (2, 5):
     # Prior to Python 2.5, Exception was an old-style class
     def subclass_exception(name, parents, unused):
@@ -1,5 +1,12 @@
 from pymongo import Connection
 from pymongo.son_manipulator import SONManipulator
+import pymongo
+import inspect
+import os
+import re
+import threading
+import time
+import warnings
 
 try:
     from django.db.models import Model
@@ -13,11 +20,75 @@ try:
                 'pk':model.pk,
                 '_type':"django"}
     
+    # ContentTypes, by (app label, model name), shared by the whole process
+    _content_types = {}
+
+    def _get_content_type(app_label, model):
+        key = (app_label, model)
+        if key not in _content_types:
+            _content_types[key] = ContentType.objects.get(app_label=app_label,
+                                                          model=model)
+        return _content_types[key]
+
+    def _is_django_stub(value):
+        return isinstance(value, dict) and value.get('_type') == u'django'
+
     def decode_django(data):
-        return ContentType.objects.get(app_label=data['app'], model=data['model']).get_object_for_this_type(pk=data['pk'])
-    
+        return decode_django_stubs([data])[0]
+
+    def decode_django_stubs(stubs):
+        """Return the Django model instances referred to by a list of stubs
+        created by :func:`encode_django`, using one query per model class.
+        The model's :exc:`DoesNotExist` is raised if an instance no longer
+        exists.
+        """
+        pks = {}
+        for stub in stubs:
+            content_type = _get_content_type(stub['app'], stub['model'])
+            pks.setdefault(content_type, set()).add(stub['pk'])
+
+        instances = {}
+        for content_type, model_pks in pks.items():
+            manager = content_type.model_class()._default_manager
+            for pk, instance in manager.in_bulk(list(model_pks)).items():
+                instances[(content_type.pk, pk)] = instance
+
+        results = []
+        for stub in stubs:
+            content_type = _get_content_type(stub['app'], stub['model'])
+            key = (content_type.pk, stub['pk'])
+            if key not in instances:
+                model = content_type.model_class()
+                raise model.DoesNotExist('%s matching query does not exist.'
+                                         % model._meta.object_name)
+            results.append(instances[key])
+        return results
+
+    def _find_django_stubs(value, stubs):
+        """Add a ``(container, key, stub)`` tuple to ``stubs`` for each stub
+        found in the dicts and lists of ``value``.
+        """
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            return
+        for key, item in items:
+            if _is_django_stub(item):
+                stubs.append((value, key, item))
+            else:
+                _find_django_stubs(item, stubs)
+
     class TransformDjango(SONManipulator):
+        def __init__(self):
+            # Collections of documents that never contain Django models
+            self.skip_collections = set()
+
         def transform_incoming(self, son, collection):
+            if collection is not None and \
+               collection.name in self.skip_collections:
+                return son
             if isinstance(son, dict):
                 for (key, value) in son.items():
                     if isinstance(value, Model):
@@ -29,54 +100,92 @@ try:
             elif hasattr(son, "__iter__"): # Make sure we recurse into sub-docs
                 son = [self.transform_incoming(item, collection) for item in son]
             elif isinstance(son, Model):
-                son = encode_django(value)
+                son = encode_django(son)
             return son
         
         def transform_outgoing(self, son, collection):
-            if isinstance(son, dict):
-                if "_type" in son and son["_type"] == u"django":
-                    son = decode_django(son)
-                else:
-                    for (key, value) in son.items():
-                        if isinstance(value, dict):
-                            if "_type" in value and value["_type"] == u"django":
-                                son[key] = decode_django(value)
-                            else:
-                                son[key] = self.transform_outgoing(value, collection)
-                        elif hasattr(value, "__iter__"): # Make sure we recurse into sub-docs
-                            son[key] = [self.transform_outgoing(item, collection) for item in value]
-                        else: # Again, make sure to recurse into sub-docs
-                            son[key] = self.transform_outgoing(value, collection)
-            elif hasattr(son, "__iter__"): # Make sure we recurse into sub-docs
-                son = [self.transform_outgoing(item, collection) for item in son]
+            if collection is not None and \
+               collection.name in self.skip_collections:
+                return son
+            if _is_django_stub(son):
+                return decode_django(son)
+
+            # Load all of the models referred to by the document together
+            stubs = []
+            _find_django_stubs(son, stubs)
+            if stubs:
+                instances = decode_django_stubs([stub for c, k, stub in stubs])
+                for (container, key, stub), instance in zip(stubs, instances):
+                    container[key] = instance
             return son
 except ImportError:
     #no django, disable SON
     TransformDjango = None
 
-__all__ = ['ConnectionError', 'connect']
+__all__ = ['ConnectionError', 'connect', 'start_request', 'end_request',
+           'request_stats', 'switch_db', 'DEFAULT_CONNECTION_NAME']
+
+# The alias of the connection used by documents that don't specify one using
+# db_alias in their meta
+DEFAULT_CONNECTION_NAME = 'default'
+
+# The installed version of PyMongo, as a tuple of integers that can be
+# compared (version_tuple is missing from PyMongo < 2.1)
+PYMONGO_VERSION = getattr(pymongo, 'version_tuple', None) or \
+                  tuple(int(part) for part in re.findall(r'\d+',
+                                                          pymongo.version))
+
+# Connection pool settings that may be given to connect(), timeouts are in
+# seconds
+POOL_SETTINGS = ('max_pool_size', 'wait_queue_timeout', 'connect_timeout',
+                 'socket_timeout')
+
+# The settings of each connection, by alias: the name of the database, the
+# credentials, the arguments for the Connection and the pool settings
+_connection_settings = {}
+_connections = {}
+_dbs = {}
+
+# The SON manipulators installed in the database of each connection, by alias
+_son_manipulators = {}
+
+# Threads in a request (see start_request) each hold a socket of a
+# connection's pool; _request_stats counts, for each alias, the threads in a
+# request, the threads waiting to start one and the number of requests started
+_pool_condition = threading.Condition()
+_request_stats = {}
+_request_local = threading.local()
 
-_connection_settings = {
-    'host': 'localhost',
-    'port': 27017,
-}
+# The aliases that document classes have been switched to by switch_db in
+# each thread, as a stack for each class
+_switch_local = threading.local()
 
-_connection = None
+# The process the connections were made in; a child process that inherits
+# them from its parent (e.g. in pre-forking servers) makes its own instead of
+# sharing the parent's sockets
+_pid = os.getpid()
 
-_db_name = None
-_db_username = None
-_db_password = None
-_db = None
+
+def _new_settings():
+    return {
+        'name': None,
+        'username': None,
+        'password': None,
+        'connection': {'host': 'localhost', 'port': 27017},
+        'pool': {},
+    }
 
 try:
     from django.conf import settings
     for dbname in ['mongodb', 'default']:
         if dbname in settings.DATABASES:
-            _connection_settings['host'] = settings.DATABASES[dbname]['HOST']
+            default = _new_settings()
+            default['connection']['host'] = settings.DATABASES[dbname]['HOST']
             port = settings.DATABASES[dbname]['PORT']
             if port:
-                _connection_settings['port'] = int(port)
-            _db_name = settings.DATABASES[dbname]['NAME']
+                default['connection']['port'] = int(port)
+            default['name'] = settings.DATABASES[dbname]['NAME']
+            _connection_settings[DEFAULT_CONNECTION_NAME] = default
             break
 except ImportError:
     pass
@@ -86,45 +195,351 @@ class ConnectionError(Exception):
     pass
 
 
-def _get_connection():
-    global _connection
+def _reset_after_fork():
+    """Forget the connections, databases and requests inherited from the
+    parent process. Collections cached by each
+    :class:`~mongoengine.queryset.QuerySetManager` are obtained again as
+    soon as they are used, as their databases have been replaced.
+    """
+    global _pid, _pool_condition, _request_local
+    _pid = os.getpid()
+    _connections.clear()
+    _dbs.clear()
+    _son_manipulators.clear()
+    _request_stats.clear()
+    _pool_condition = threading.Condition()
+    _request_local = threading.local()
+
+def _check_pid():
+    if os.getpid() != _pid:
+        _reset_after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _get_settings(alias):
+    try:
+        return _connection_settings[alias]
+    except KeyError:
+        if alias == DEFAULT_CONNECTION_NAME:
+            raise ConnectionError('Not connected to the database')
+        raise ConnectionError('No connection has been defined with the alias '
+                              '"%s"' % alias)
+
+def _connection_options(alias):
+    """Return the arguments for creating the :class:`~pymongo.Connection`,
+    passing on the pool settings supported by the installed PyMongo. A
+    warning is issued for each setting that PyMongo can't accept.
+    """
+    settings = _get_settings(alias)
+    options = dict(settings['connection'])
+    pool_settings = settings['pool']
+    args, varargs, varkw, defaults = inspect.getargspec(Connection.__init__)
+    unsupported = []
+
+    if pool_settings.get('socket_timeout') is not None:
+        options['network_timeout'] = pool_settings['socket_timeout']
+    if pool_settings.get('max_pool_size'):
+        if 'max_pool_size' in args:
+            options['max_pool_size'] = pool_settings['max_pool_size']
+        else:
+            unsupported.append('max_pool_size')
+    # Options accepted as keyword arguments by newer versions of PyMongo,
+    # which raise a ConfigurationError for options they don't know
+    for name, option, version in (
+            ('connect_timeout', 'connectTimeoutMS', (2, 0)),
+            ('wait_queue_timeout', 'waitQueueTimeoutMS', (2, 6))):
+        if pool_settings.get(name) is None:
+            continue
+        if varkw and PYMONGO_VERSION >= version:
+            options[option] = int(pool_settings[name] * 1000)
+        else:
+            unsupported.append(name)
+
+    for name in unsupported:
+        if name == 'connect_timeout':
+            msg = '%s is not supported by PyMongo %s and is ignored'
+        else:
+            msg = ('%s is not supported by PyMongo %s, it only applies to '
+                   'threads in start_request()')
+        warnings.warn(msg % (name, pymongo.version), RuntimeWarning)
+    return options
+
+def _get_connection(alias=DEFAULT_CONNECTION_NAME):
+    _check_pid()
     # Connect to the database if not already connected
-    if _connection is None:
+    if alias not in _connections:
+        options = _connection_options(alias)
         try:
-            _connection = Connection(**_connection_settings)
+            _connections[alias] = Connection(**options)
         except:
             raise ConnectionError('Cannot connect to the database')
-    return _connection
-
-def _get_db():
-    global _db, _connection
-    # Connect if not already connected
-    if _connection is None:
-        _connection = _get_connection()
+    return _connections[alias]
 
-    if _db is None:
-        # _db_name will be None if the user hasn't called connect()
-        if _db_name is None:
+def _get_db(alias=DEFAULT_CONNECTION_NAME):
+    _check_pid()
+    db = _dbs.get(alias)
+    if db is None:
+        settings = _get_settings(alias)
+        # The name will be None if the user hasn't called connect()
+        if settings['name'] is None:
             raise ConnectionError('Not connected to the database')
 
         # Get DB from current connection and authenticate if necessary
-        _db = _connection[_db_name]
-        if _db_username and _db_password:
-            _db.authenticate(_db_username, _db_password)
+        db = _get_connection(alias)[settings['name']]
+        if settings['username'] and settings['password']:
+            db.authenticate(settings['username'], settings['password'])
+        _install_son_manipulators(alias, db)
+        _dbs[alias] = db
+
+    return db
+
+def _install_son_manipulators(alias, db):
+    """Add the SON manipulators used by MongoEngine to a database, once
+    when the database is first used.
+    """
+    manipulators = []
     if TransformDjango:
-        _db.add_son_manipulator(TransformDjango())
+        manipulators.append(TransformDjango())
+    for manipulator in manipulators:
+        db.add_son_manipulator(manipulator)
+    _son_manipulators[alias] = manipulators
 
-    return _db
+def _skip_django_transform(alias, collection_name):
+    """Stop Django models from being looked for in the documents of a
+    collection, for documents that set :attr:`django_models` to ``False`` in
+    their :attr:`meta`.
+    """
+    for manipulator in _son_manipulators.get(alias, []):
+        if TransformDjango and isinstance(manipulator, TransformDjango):
+            manipulator.skip_collections.add(collection_name)
 
-def connect(db, username=None, password=None, **kwargs):
+def connect(db, username=None, password=None,
+            alias=DEFAULT_CONNECTION_NAME, **kwargs):
     """Connect to the database specified by the 'db' argument. Connection 
     settings may be provided here as well if the database is not running on
     the default port on localhost. If authentication is needed, provide
     username and password arguments as well.
+
+    Several connections may be defined by giving each of them an ``alias``.
+    Documents use the connection whose alias is given by :attr:`db_alias` in
+    their :attr:`meta`, or the connection with the default alias,
+    ``'default'``. Each connection has its own pool.
+
+    The following keyword arguments configure the connection, timeouts are
+    given in seconds:
+
+    * ``max_pool_size`` -- the maximum number of threads that may be in a
+      request (see :func:`start_request`) at once
+    * ``wait_queue_timeout`` -- how long :func:`start_request` waits for a
+      thread to leave its request when ``max_pool_size`` is reached, before
+      raising a :class:`ConnectionError`
+    * ``connect_timeout`` -- the timeout for opening sockets
+    * ``socket_timeout`` -- the timeout for socket operations
+
+    ``max_pool_size`` and ``wait_queue_timeout`` are enforced by MongoEngine
+    as a limit on the threads in a request; they are also passed to the
+    versions of PyMongo that accept them (2.0 and newer for
+    ``max_pool_size`` and ``connect_timeout``, 2.6 and newer for
+    ``wait_queue_timeout``), which apply them to their own pool. A
+    :class:`RuntimeWarning` is issued when connecting for each setting the
+    installed PyMongo doesn't accept; ``connect_timeout`` is then ignored, and
+    the other settings only apply to the request limit.
+    """
+    settings = _connection_settings.get(alias) or _new_settings()
+    connection_settings = dict(settings['connection'])
+    pool_settings = dict(settings['pool'])
+    for name, value in kwargs.items():
+        if name in POOL_SETTINGS:
+            pool_settings[name] = value
+        else:
+            connection_settings[name] = value
+
+    # Reconnect if the settings have changed
+    if (connection_settings != settings['connection'] or
+        pool_settings != settings['pool']):
+        _connections.pop(alias, None)
+        _dbs.pop(alias, None)
+    if (db, username, password) != (settings['name'], settings['username'],
+                                    settings['password']):
+        _dbs.pop(alias, None)
+
+    _connection_settings[alias] = {
+        'name': db,
+        'username': username,
+        'password': password,
+        'connection': connection_settings,
+        'pool': pool_settings,
+    }
+    return _get_db(alias)
+
+def _request_depths():
+    """Return how deeply the current thread is nested in requests on each
+    connection.
+    """
+    if not hasattr(_request_local, 'depths'):
+        _request_local.depths = {}
+    return _request_local.depths
+
+def start_request(alias=DEFAULT_CONNECTION_NAME):
+    """Reserve a socket of the connection pool for the current thread until
+    :func:`end_request` is called, so that every operation performed by the
+    thread in between reads its own writes. If ``max_pool_size`` threads are
+    already in a request, wait for one to end, for at most
+    ``wait_queue_timeout`` seconds; this limit is kept by MongoEngine,
+    separately from any limit of PyMongo's pool. Requests may be nested.
+
+    :param alias: the alias of the connection
+    """
+    _check_pid()
+    depths = _request_depths()
+    if depths.get(alias):
+        depths[alias] += 1
+        return
+
+    # Connect before reserving a place, so that a failure to connect doesn't
+    # hold one
+    connection = _get_connection(alias)
+    pool_settings = _get_settings(alias)['pool']
+    max_pool_size = pool_settings.get('max_pool_size')
+    timeout = pool_settings.get('wait_queue_timeout')
+    _pool_condition.acquire()
+    try:
+        stats = _request_stats.setdefault(alias, {'in_request': 0,
+                                                  'waiting': 0, 'requests': 0})
+        if max_pool_size and stats['in_request'] >= max_pool_size:
+            stats['waiting'] += 1
+            try:
+                if timeout is not None:
+                    deadline = time.time() + timeout
+                while stats['in_request'] >= max_pool_size:
+                    if timeout is None:
+                        _pool_condition.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ConnectionError('Timed out waiting for a '
+                                              'connection from the pool')
+                    _pool_condition.wait(remaining)
+            finally:
+                stats['waiting'] -= 1
+        stats['in_request'] += 1
+        stats['requests'] += 1
+    finally:
+        _pool_condition.release()
+
+    # PyMongo < 2.0 always keeps a socket for each thread, and warns that
+    # start_request is deprecated
+    if PYMONGO_VERSION >= (2, 0):
+        try:
+            connection.start_request()
+        except:
+            _release_request(alias)
+            raise
+    depths[alias] = 1
+
+def end_request(alias=DEFAULT_CONNECTION_NAME):
+    """End the current thread's request (see :func:`start_request`),
+    returning its socket to the connection pool.
+
+    :param alias: the alias of the connection
+    """
+    _check_pid()
+    depths = _request_depths()
+    depth = depths.get(alias, 0)
+    if not depth:
+        return
+    depths[alias] = depth - 1
+    if depth > 1:
+        return
+
+    if alias in _connections:
+        _connections[alias].end_request()
+    _release_request(alias)
+
+def _release_request(alias):
+    """Give up the current thread's place among the threads in a request,
+    waking a thread waiting for one.
+    """
+    _pool_condition.acquire()
+    try:
+        _request_stats[alias]['in_request'] -= 1
+        _pool_condition.notifyAll()
+    finally:
+        _pool_condition.release()
+
+def request_stats(alias=DEFAULT_CONNECTION_NAME):
+    """Return statistics of the requests on a connection (see
+    :func:`start_request`), for monitoring, as a dictionary of the maximum
+    number of threads that may be in a request (``max_requests``), the
+    number of threads in a request (``in_request``), the number of threads
+    waiting to start one (``waiting``) and the number of requests that have
+    been started (``requests``).
+
+    These are counted by MongoEngine, and are not figures of PyMongo's
+    socket pool: queries made outside of a request aren't counted, and as
+    PyMongo doesn't report how many sockets it has opened, no count of
+    created connections is available.
+
+    :param alias: the alias of the connection
+    """
+    _pool_condition.acquire()
+    try:
+        stats = dict(_request_stats.get(alias, {'in_request': 0,
+                                                'waiting': 0, 'requests': 0}))
+    finally:
+        _pool_condition.release()
+    stats['max_requests'] = _get_settings(alias)['pool'].get('max_pool_size')
+    return stats
+
+
+def _switched_aliases():
+    if not hasattr(_switch_local, 'aliases'):
+        _switch_local.aliases = {}
+    return _switch_local.aliases
+
+def _get_alias(doc_cls):
+    """Return the alias of the connection used by a document class in the
+    current thread: the one given by :class:`switch_db`, if the class has been
+    switched, or else the :attr:`db_alias` in its :attr:`meta`.
     """
-    global _connection_settings, _db_name, _db_username, _db_password
-    _connection_settings.update(kwargs)
-    _db_name = db
-    _db_username = username
-    _db_password = password
-    return _get_db()
\ No newline at end of file
+    aliases = _switched_aliases().get(doc_cls)
+    if aliases:
+        return aliases[-1]
+    return doc_cls._meta.get('db_alias') or DEFAULT_CONNECTION_NAME
+
+
+class switch_db(object):
+    """Context manager that temporarily stores and loads the documents of a
+    :class:`~mongoengine.Document` class, and of its subclasses, using another
+    connection. ::
+
+        with switch_db(User, 'archive') as User:
+            User(name='Ross').save()  # Saved using the 'archive' connection
+
+    The connection is only switched for the current thread; other threads
+    keep using the class's own connection.
+
+    :param cls: the :class:`~mongoengine.Document` class
+    :param db_alias: the alias of the connection to use
+    """
+
+    def __init__(self, cls, db_alias):
+        self.cls = cls
+        self.db_alias = db_alias
+        self.switched = []
+
+    def __enter__(self):
+        aliases = _switched_aliases()
+        classes = [self.cls] + self.cls._get_subclasses().values()
+        for doc_cls in classes:
+            aliases.setdefault(doc_cls, []).append(self.db_alias)
+        self.switched.append(classes)
+        return self.cls
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        aliases = _switched_aliases()
+        for doc_cls in self.switched.pop():
+            aliases[doc_cls].pop()
+            if not aliases[doc_cls]:
+                del aliases[doc_cls]
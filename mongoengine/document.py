@@ -1,7 +1,8 @@
 from base import (DocumentMetaclass, TopLevelDocumentMetaclass, BaseDocument,
-                  ValidationError, BaseField)
-from queryset import OperationError
-from connection import _get_db
+                  ValidationError, BaseField, _document_classes)
+from queryset import (OperationError, _ensure_index, _forget_indexes,
+                      _get_collection)
+from connection import _get_db, _get_alias
 import pymongo
 
 try:
@@ -10,7 +11,8 @@ except ImportError:
     signals = None
 
 
-__all__ = ['Document', 'EmbeddedDocument', 'ValidationError', 'OperationError']
+__all__ = ['Document', 'EmbeddedDocument', 'ValidationError', 'OperationError',
+           'ensure_all_indexes']
 
 
 class EmbeddedDocument(BaseDocument):
@@ -56,6 +58,17 @@ class Document(BaseDocument):
     dictionary. The value should be a list of field names or tuples of field 
     names. Index direction may be specified by prefixing the field names with
     a **+** or **-** sign.
+
+    Indexes are ensured once per process, the first time the collection is
+    used. Set :attr:`index_mode` in the :attr:`meta` dictionary (or call
+    :func:`~mongoengine.queryset.set_index_mode`) to ``'background'`` to
+    ensure them from a separate thread, or to ``'deferred'`` to only ensure
+    them through :meth:`ensure_indexes` or
+    :func:`~mongoengine.ensure_all_indexes`.
+
+    Documents are stored using the default connection, unless the alias of
+    another connection (see :func:`~mongoengine.connect`) is given by
+    :attr:`db_alias` in the :attr:`meta` dictionary.
     """
 
     __metaclass__ = TopLevelDocumentMetaclass
@@ -63,7 +76,11 @@ class Document(BaseDocument):
     def save(self, safe=True, force_insert=False):
         """Save the :class:`~mongoengine.Document` to the database. If the
         document already exists, it will be updated, otherwise it will be
-        created.
+        created. Documents that were loaded from the database are updated
+        using ``$set`` and ``$unset`` with only the fields that have changed.
+        These updates are always acknowledged by the server, so that a
+        document that has been removed from the database since it was loaded
+        is saved in full instead.
 
         If ``safe=True`` and the operation is unsuccessful, an 
         :class:`~mongoengine.OperationError` will be raised.
@@ -80,25 +97,49 @@ class Document(BaseDocument):
             record_exists = True
 
         self.validate()
-        doc = self.to_mongo()
-        # Also check for any dynamic fields that were set and write them to the
-        # database as well.
-        for field_name, field in self._dynamic_fields.items():
-            if field_name in self._data.keys():
-                doc[field_name] = self._data[field_name]
+        id_field = self._meta['id_field']
+        # Documents that were loaded from (or saved to) the database only
+        # need their changed fields writing, unless the primary key changed
+        use_delta = not (self._created or force_insert or
+                         id_field in self._changed_fields)
         try:
             collection = self.__class__.objects._collection
-            if force_insert:
-                object_id = collection.insert(doc, safe=safe)
-            else:
-                object_id = collection.save(doc, safe=safe)
+            if use_delta:
+                object_id = self._fields[id_field].to_mongo(self[id_field])
+                set_data, unset_data = self._delta()
+                update = {}
+                if set_data:
+                    update['$set'] = set_data
+                if unset_data:
+                    update['$unset'] = unset_data
+                if update:
+                    result = collection.update({'_id': object_id}, update,
+                                               safe=True)
+                    found = result.get('n')
+                else:
+                    found = collection.find_one({'_id': object_id}, ['_id'])
+                # The document has been removed from the database
+                if not found:
+                    use_delta = False
+            if not use_delta:
+                doc = self.to_mongo()
+                # Also check for any dynamic fields that were set and write
+                # them to the database as well.
+                for field_name, field in self._dynamic_fields.items():
+                    if field_name in self._data.keys():
+                        doc[field_name] = self._data[field_name]
+                if force_insert:
+                    object_id = collection.insert(doc, safe=safe)
+                else:
+                    object_id = collection.save(doc, safe=safe)
         except pymongo.errors.OperationFailure, err:
             message = 'Could not save document (%s)'
             if u'duplicate key' in unicode(err):
                 message = u'Tried to save duplicate unique keys (%s)'
             raise OperationError(message % unicode(err))
-        id_field = self._meta['id_field']
         self[id_field] = self._fields[id_field].to_python(object_id)
+        self._clear_changed_fields()
+        self._created = False
         
         #propagate post save signal
         if signals:
@@ -134,14 +175,55 @@ class Document(BaseDocument):
         obj = self.__class__.objects(**{id_field: self[id_field]}).first()
         for field in self._fields:
             setattr(self, field, obj[field])
+        self._clear_changed_fields()
+        self._created = False
+
+    @classmethod
+    def ensure_indexes(cls):
+        """Ensure that the indexes needed by this
+        :class:`~mongoengine.Document` type are in place: the indexes in
+        :attr:`meta`, those created by uniqueness constraints, geospatial
+        indexes and the ``_types`` index. Each index is only sent to the
+        server once per process.
+        """
+        collection = _get_collection(cls)
+
+        # Ensure document-defined indexes are created
+        for key_or_list in cls._meta['indexes']:
+            _ensure_index(collection, key_or_list)
+
+        # Ensure indexes created by uniqueness constraints
+        for index in cls._meta['unique_indexes']:
+            _ensure_index(collection, index, unique=True)
+
+        if cls._meta['geo_indexes'] and pymongo.version >= "1.5.1":
+            for index in cls._meta['geo_indexes']:
+                _ensure_index(collection, [(index, pymongo.GEO2D)])
+
+        # If _types is being used (for polymorphism), it needs an index
+        if cls._meta.get('allow_inheritance'):
+            _ensure_index(collection, '_types')
+
+        # Ensure all needed field indexes are created
+        for field in cls._fields.values():
+            if field.__class__.__name__ == 'GeoLocationField':
+                _ensure_index(collection, [(field.db_field, pymongo.GEO2D)])
+
+    @classmethod
+    def _get_db(cls):
+        """Return the database of the connection given by :attr:`db_alias`
+        in :attr:`meta`.
+        """
+        return _get_db(_get_alias(cls))
 
     @classmethod
     def drop_collection(cls):
         """Drops the entire collection associated with this
         :class:`~mongoengine.Document` type from the database.
         """
-        db = _get_db()
+        db = cls._get_db()
         db.drop_collection(cls._meta['collection'])
+        _forget_indexes(db[cls._meta['collection']])
 
     def create_dynamic_field(self, field_name, field_value=None):
         """Creates a new dynamic field on the object.
@@ -160,7 +242,19 @@ class Document(BaseDocument):
         else:
             message = u'Field %s already exists' % field_name
             raise OperationError(message)
-        
+
+
+def ensure_all_indexes():
+    """Ensure the indexes of every :class:`~mongoengine.Document` class that
+    has been defined. Intended to be called from a startup hook when indexes
+    are not ensured on first use (see :attr:`index_mode`).
+
+    .. versionadded:: 0.4
+    """
+    for doc_cls in list(_document_classes):
+        doc_cls.ensure_indexes()
+
+
 class MapReduceDocument(object):
     """A document returned from a map/reduce query.
     
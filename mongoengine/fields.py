@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
-from base import BaseField, ObjectIdField, ValidationError, get_document
+from base import (BaseField, ObjectIdField, ValidationError, get_document,
+                  BaseList, BaseSet)
 from document import Document, EmbeddedDocument
-from connection import _get_db
+from queryset import _load_references
 from operator import itemgetter
 import re
 import pymongo
@@ -25,6 +26,30 @@ __all__ = ['StringField', 'IntField', 'FloatField', 'BooleanField',
 
 RECURSIVE_REFERENCE_CONSTANT = 'self'
 
+
+def _dereference_list(field, values):
+    """Dereference the items of a list of references held by ``field`` (a
+    :class:`ReferenceField` or :class:`GenericReferenceField`), using one
+    query per referenced collection. The order of the items is kept, and items
+    whose documents no longer exist are left as references, so the list can
+    still be saved.
+    """
+    references = [field._get_reference(value) for value in values]
+    if not any(references):
+        # Already dereferenced
+        return values
+
+    loaded = iter(_load_references([ref for ref in references if ref]))
+    deref_list = []
+    for value, reference in zip(values, references):
+        if reference:
+            son = loaded.next()
+            if son is not None:
+                value = reference[0]._from_son(son)
+        deref_list.append(value)
+    return deref_list
+
+
 class StringField(BaseField):
     """A unicode string field.
     """
@@ -279,34 +304,16 @@ class ListField(BaseField):
             # Document class being used rather than a document object
             return self
 
-        if isinstance(self.field, ReferenceField):
-            referenced_type = self.field.document_type
-            # Get value from document instance if available 
+        if isinstance(self.field, (ReferenceField, GenericReferenceField)):
+            # Get value from document instance if available; lists that are
+            # already tracked have been dereferenced by an earlier read
             value_list = instance._data.get(self.name)
-            if value_list:
-                deref_list = []
-                for value in value_list:
-                    # Dereference DBRefs
-                    if isinstance(value, (pymongo.dbref.DBRef)):
-                        value = _get_db().dereference(value)
-                        deref_list.append(referenced_type._from_son(value))
-                    else:
-                        deref_list.append(value)
-                instance._data[self.name] = deref_list
-
-        if isinstance(self.field, GenericReferenceField):
-            value_list = instance._data.get(self.name)
-            if value_list:
-                deref_list = []
-                for value in value_list:
-                    # Dereference DBRefs
-                    if isinstance(value, (dict, pymongo.son.SON)):
-                        deref_list.append(self.field.dereference(value))
-                    else:
-                        deref_list.append(value)
-                instance._data[self.name] = deref_list
-
-        return super(ListField, self).__get__(instance, owner)
+            if value_list and not isinstance(value_list, BaseList):
+                instance._data[self.name] = _dereference_list(self.field,
+                                                              value_list)
+
+        value = super(ListField, self).__get__(instance, owner)
+        return self._track_changes(instance, value)
 
     def to_python(self, value):
         return [self.field.to_python(item) for item in value]
@@ -377,6 +384,13 @@ class DictField(BaseField):
     .. versionadded:: 0.3
     """
 
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        value = super(DictField, self).__get__(instance, owner)
+        return self._track_changes(instance, value)
+
     def validate(self, value):
         """Make sure that a list of valid fields is being used.
         """
@@ -427,34 +441,17 @@ class SetField(BaseField):
             # Document class being used rather than a document object
             return self
 
-        if isinstance(self.field, ReferenceField):
-            referenced_type = self.field.document_type
-            # Get value from document instance if available 
-            value_list = instance._data.get(self.name)
-            if value_list:
-                deref_list = set()
-                for value in value_list:
-                    # Dereference DBRefs
-                    if isinstance(value, (pymongo.dbref.DBRef)):
-                        value = _get_db().dereference(value)
-                        deref_list.add(referenced_type._from_son(value))
-                    else:
-                        deref_list.add(value)
-                instance._data[self.name] = deref_list
-
-        if isinstance(self.field, GenericReferenceField):
+        if isinstance(self.field, (ReferenceField, GenericReferenceField)):
+            # Get value from document instance if available
             value_list = instance._data.get(self.name)
-            if value_list:
-                deref_list = set()
-                for value in value_list:
-                    # Dereference DBRefs
-                    if isinstance(value, (dict, pymongo.son.SON)):
-                        deref_list.add(self.field.dereference(value))
-                    else:
-                        deref_list.add(value)
-                instance._data[self.name] = deref_list
-
-        return super(SetField, self).__get__(instance, owner)
+            if value_list and not isinstance(value_list, BaseSet):
+                values = list(value_list)
+                deref_list = _dereference_list(self.field, values)
+                if deref_list is not values:
+                    instance._data[self.name] = set(deref_list)
+
+        value = super(SetField, self).__get__(instance, owner)
+        return self._track_changes(instance, value)
     
     def validate(self, value):
         if not isinstance(value, set):
@@ -484,6 +481,13 @@ class MapField(BaseField):
         self.key_field = key_field
         self.value_field = value_field
         super(MapField, self).__init__(**kwargs)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        value = super(MapField, self).__get__(instance, owner)
+        return self._track_changes(instance, value)
     
     def validate(self, value):
         if not isinstance(value, dict):
@@ -594,13 +598,25 @@ class ReferenceField(BaseField):
         value = instance._data.get(self.name)
         # Dereference DBRefs
         if isinstance(value, (pymongo.dbref.DBRef)):
-            value = _get_db().dereference(value)
+            value = self.document_type._get_db().dereference(value)
             if value is not None:
                 instance._data[self.name] = self.document_type._from_son(value)
 
         return super(ReferenceField, self).__get__(instance, owner)
 
+    def _get_reference(self, value):
+        """Return the document class and DBRef a value refers to, or
+        ``None`` if it has already been dereferenced.
+        """
+        if isinstance(value, pymongo.dbref.DBRef):
+            return self.document_type, value
+        return None
+
     def to_mongo(self, document):
+        if isinstance(document, pymongo.dbref.DBRef):
+            # Not dereferenced since it was loaded
+            return document
+
         id_field_name = self.document_type._meta['id_field']
         id_field = self.document_type._fields[id_field_name]
 
@@ -644,15 +660,27 @@ class GenericReferenceField(BaseField):
 
         return super(GenericReferenceField, self).__get__(instance, owner)
 
+    def _get_reference(self, value):
+        """Return the document class and DBRef a value refers to, or
+        ``None`` if it has already been dereferenced.
+        """
+        if isinstance(value, (dict, pymongo.son.SON)):
+            return get_document(value['_cls']), value['_ref']
+        return None
+
     def dereference(self, value):
         doc_cls = get_document(value['_cls'])
         reference = value['_ref']
-        doc = _get_db().dereference(reference)
+        doc = doc_cls._get_db().dereference(reference)
         if doc is not None:
             doc = doc_cls._from_son(doc)
         return doc
 
     def to_mongo(self, document):
+        if isinstance(document, (dict, pymongo.son.SON)):
+            # Not dereferenced since it was loaded
+            return document
+
         id_field_name = document.__class__._meta['id_field']
         id_field = document.__class__._fields[id_field_name]
 
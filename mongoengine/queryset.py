@@ -1,8 +1,16 @@
-from connection import _get_db
+from connection import (_get_db, _skip_django_transform, start_request,
+                        end_request, _get_alias, PYMONGO_VERSION)
 
 import pymongo
+import pymongo.objectid
+from pymongo.son import SON
+import base64
+import calendar
+import datetime
 import re
-import copy
+import threading
+import time
+import Queue
 try:
     from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 except ImportError:
@@ -10,15 +18,73 @@ except ImportError:
         pass
     class MultipleObjectsReturned(Exception):
         pass
+
+try:
+    from django.db.models import signals
+except ImportError:
+    signals = None
+
+try:
+    from bson import BSON
+except ImportError:
+    # PyMongo < 1.9
+    from pymongo.bson import BSON
     
 DoesNotExist = ObjectDoesNotExist
 
 __all__ = ['queryset_manager', 'Q', 'InvalidQueryError',
-           'InvalidCollectionError']
+           'InvalidCollectionError', 'BulkInsertError', 'ParallelMapError',
+           'set_index_mode']
 
 # The maximum number of items to display in a QuerySet.__repr__
 REPR_OUTPUT_SIZE = 20
 
+# The number of results read from the cursor at a time when a QuerySet's
+# result cache is filled
+ITER_CHUNK_SIZE = 100
+
+# The number of documents whose references are loaded together when
+# QuerySet.select_related is used
+SELECT_RELATED_BATCH_SIZE = 100
+
+# The maximum number of documents, and of bytes of BSON, sent in a single
+# insert message by QuerySet.insert
+INSERT_BATCH_SIZE = 1000
+INSERT_BATCH_BYTES = 4 * 1024 * 1024
+
+# The maximum number of compiled query and update keys kept for each document
+# class, see QuerySet._query_plan
+QUERY_PLAN_CACHE_SIZE = 1000
+
+QUERY_OPERATORS = frozenset(['ne', 'gt', 'gte', 'lt', 'lte', 'in', 'nin',
+                             'mod', 'all', 'size', 'exists'])
+GEO_OPERATORS = frozenset(['within_distance', 'within_box', 'near'])
+MATCH_OPERATORS = frozenset(['contains', 'icontains', 'startswith',
+                             'istartswith', 'endswith', 'iendswith'])
+UPDATE_OPERATORS = frozenset(['set', 'unset', 'inc', 'dec', 'push',
+                              'push_all', 'pull', 'pull_all'])
+
+# How document-defined indexes are ensured:
+#   'auto'       - on the first access of a collection (the default)
+#   'background' - on the first access, from a separate daemon thread
+#   'deferred'   - never implicitly, call ensure_all_indexes() at startup
+INDEX_MODES = ('auto', 'background', 'deferred')
+_index_mode = 'auto'
+
+# Indexes that have already been ensured by this process, keyed by
+# (host, port, database, collection, index spec, options)
+_index_registry = set()
+_index_threads = set()
+_index_registry_lock = threading.RLock()
+
+# Servers, as (host, port), found not to support the aggregate command, for
+# which aggregations are computed client side instead
+_no_aggregation = set()
+
+# Servers, as (host, port), found not to support $setOnInsert, for which
+# QuerySet.get_or_create saves new documents instead of upserting them
+_no_set_on_insert = set()
+
 class InvalidQueryError(Exception):
     pass
 
@@ -26,6 +92,32 @@ class InvalidQueryError(Exception):
 class OperationError(Exception):
     pass
 
+
+class BulkInsertError(OperationError):
+    """Raised by :meth:`~mongoengine.queryset.QuerySet.insert` when some
+    of the documents could not be inserted. :attr:`errors` is a list of
+    ``(index, document, message)`` tuples, one per failed document, and
+    :attr:`inserted` is the list of documents that were inserted.
+    """
+
+    def __init__(self, message, errors, inserted):
+        OperationError.__init__(self, message)
+        self.errors = errors
+        self.inserted = inserted
+
+class ParallelMapError(OperationError):
+    """Raised by :meth:`~mongoengine.queryset.QuerySet.parallel_map` when the
+    function failed for some of the partitions. :attr:`errors` is a list of
+    ``(partition index, exception)`` tuples, one per failed partition, and
+    :attr:`results` holds the results for the documents that were processed
+    (or their number, if the results weren't collected).
+    """
+
+    def __init__(self, message, errors, results):
+        OperationError.__init__(self, message)
+        self.errors = errors
+        self.results = results
+
 class InvalidCollectionError(Exception):
     pass
 
@@ -34,35 +126,29 @@ RE_TYPE = type(re.compile(''))
 
 
 class Q(object):
+    """A query, or a combination of queries, that may be combined with
+    others using ``&`` (and) and ``|`` (or), and negated using ``~``. Q
+    objects are compiled to native MongoDB query documents, using ``$or``
+    and ``$nor`` (and ``$and`` where queries on the same field can't be
+    merged).
+    """
 
-    OR = '||'
-    AND = '&&'
-    OPERATORS = {
-        'eq': 'this.%(field)s == %(value)s',
-        'ne': 'this.%(field)s != %(value)s',
-        'gt': 'this.%(field)s > %(value)s',
-        'gte': 'this.%(field)s >= %(value)s',
-        'lt': 'this.%(field)s < %(value)s',
-        'lte': 'this.%(field)s <= %(value)s',
-        'lte': 'this.%(field)s <= %(value)s',
-        'in': '%(value)s.indexOf(this.%(field)s) != -1',
-        'nin': '%(value)s.indexOf(this.%(field)s) == -1',
-        'mod': '%(field)s %% %(value)s',
-        'all': ('%(value)s.every(function(a){'
-                'return this.%(field)s.indexOf(a) != -1 })'),
-        'size': 'this.%(field)s.length == %(value)s',
-        'exists': 'this.%(field)s != null',
-        'regex_eq': '%(value)s.test(this.%(field)s)',
-        'regex_ne': '!%(value)s.test(this.%(field)s)',
-    }
+    OR = '$or'
+    AND = '$and'
+    NOT = '$nor'
 
     def __init__(self, **query):
-        self.query = [query]
+        self.query = query
+        self.op = None
+        self.children = []
 
     def _combine(self, other, op):
+        # Combining only links the two operands; nodes of the same type are
+        # flattened when the query is compiled, so building long chains of
+        # Q objects takes linear time
         obj = Q()
-        obj.query = ['('] + copy.deepcopy(self.query) + [op]
-        obj.query += copy.deepcopy(other.query) + [')']
+        obj.op = op
+        obj.children = [self, other]
         return obj
 
     def __or__(self, other):
@@ -71,68 +157,337 @@ class Q(object):
     def __and__(self, other):
         return self._combine(other, self.AND)
 
-    def as_js(self, document):
-        js = []
-        js_scope = {}
-        for i, item in enumerate(self.query):
-            if isinstance(item, dict):
-                item_query = QuerySet._transform_query(document, **item)
-                # item_query will values will either be a value or a dict
-                js.append(self._item_query_as_js(item_query, js_scope, i))
-            else:
-                js.append(item)
-        return pymongo.code.Code(' '.join(js), js_scope)
-
-    def _item_query_as_js(self, item_query, js_scope, item_num):
-        # item_query will be in one of the following forms
-        #    {'age': 25, 'name': 'Test'}
-        #    {'age': {'$lt': 25}, 'name': {'$in': ['Test', 'Example']}
-        #    {'age': {'$lt': 25, '$gt': 18}}
-        js = []
-        for i, (key, value) in enumerate(item_query.items()):
-            op = 'eq'
-            # Construct a variable name for the value in the JS
-            value_name = 'i%sf%s' % (item_num, i)
-            if isinstance(value, dict):
-                # Multiple operators for this field
-                for j, (op, value) in enumerate(value.items()):
-                    # Create a custom variable name for this operator
-                    op_value_name = '%so%s' % (value_name, j)
-                    # Construct the JS that uses this op
-                    value, operation_js = self._build_op_js(op, key, value,
-                                                            op_value_name)
-                    # Update the js scope with the value for this op
-                    js_scope[op_value_name] = value
-                    js.append(operation_js)
+    def __invert__(self):
+        if self.op == self.NOT:
+            return self.children[0]
+        obj = Q()
+        obj.op = self.NOT
+        obj.children = [self]
+        return obj
+
+    def _flatten(self):
+        """Return the operands of this node, with the operands of nested
+        nodes of the same type in their place.
+        """
+        operands = []
+        stack = list(reversed(self.children))
+        while stack:
+            node = stack.pop()
+            if node.op == self.op and self.op != self.NOT:
+                stack.extend(reversed(node.children))
             else:
-                # Construct the JS for this field
-                value, field_js = self._build_op_js(op, key, value, value_name)
-                js_scope[value_name] = value
-                js.append(field_js)
-        return ' && '.join(js)
-
-    def _build_op_js(self, op, key, value, value_name):
-        """Substitute the values in to the correct chunk of Javascript.
-        """
-        if isinstance(value, RE_TYPE):
-            # Regexes are handled specially
-            if op.strip('$') == 'ne':
-                op_js = Q.OPERATORS['regex_ne']
+                operands.append(node)
+        return operands
+
+    def to_query(self, document):
+        """Compile this query into a MongoDB query document.
+
+        :param document: the :class:`~mongoengine.Document` class the query
+            is run against, used to translate field names and values
+        """
+        if self.op is None:
+            return QuerySet._transform_query(_doc_cls=document, **self.query)
+
+        queries = [child.to_query(document) for child in self._flatten()]
+        if self.op == self.AND:
+            return _merge_queries(queries)
+        if self.op == self.OR:
+            # An empty query matches every document
+            if not all(queries):
+                return {}
+            if len(queries) == 1:
+                return queries[0]
+            return {'$or': queries}
+
+        # Negation
+        query = queries[0]
+        if not query:
+            return {'$nor': [{}]}
+        if query.keys() == ['$or']:
+            return {'$nor': query['$or']}
+        return {'$nor': [query]}
+
+
+def _is_operator_dict(value):
+    return (isinstance(value, dict) and value and
+            all(key.startswith('$') for key in value))
+
+
+def _merge_queries(queries):
+    """Combine MongoDB query documents with a logical AND. Conditions are
+    merged into a single document where possible, and only conditions on the
+    same field that can't be merged are combined using ``$and``.
+    """
+    merged = {}
+    clauses = []
+    for query in queries:
+        for key, value in query.items():
+            if key == '$and':
+                clauses.extend(value)
+            elif key not in merged:
+                merged[key] = value
+            elif merged[key] == value:
+                continue
+            elif (_is_operator_dict(merged[key]) and _is_operator_dict(value)
+                  and not set(merged[key]) & set(value)):
+                operators = merged[key].copy()
+                operators.update(value)
+                merged[key] = operators
             else:
-                op_js = Q.OPERATORS['regex_eq']
-        else:
-            op_js = Q.OPERATORS[op.strip('$')]
+                clauses.append({key: value})
+    if clauses:
+        merged['$and'] = clauses
+    return merged
 
-        # Comparing two ObjectIds in Javascript doesn't work..
-        if isinstance(value, pymongo.objectid.ObjectId):
-            value = unicode(value)
 
-        # Perform the substitution
-        operation_js = op_js % {
-            'field': key, 
-            'value': value_name
-        }
-        return value, operation_js
+def set_index_mode(mode):
+    """Set the default way document-defined indexes are ensured. May be
+    overridden per document with :attr:`index_mode` in :attr:`meta`.
+
+    :param mode: one of ``'auto'``, ``'background'`` or ``'deferred'``
+    """
+    global _index_mode
+    if mode not in INDEX_MODES:
+        raise ValueError('Index mode must be one of %s' % ', '.join(INDEX_MODES))
+    _index_mode = mode
+
+
+def _get_collection(doc_cls):
+    """Return the PyMongo collection of a document class. The class's
+    :class:`QuerySetManager` is looked up directly, as accessing it through
+    the class would create a :class:`QuerySet`.
+    """
+    for cls in doc_cls.__mro__:
+        manager = cls.__dict__.get('_default_manager')
+        if manager is not None:
+            return manager._get_collection(doc_cls)
+    raise InvalidCollectionError('%s has no collection' % doc_cls.__name__)
+
+
+def _collection_key(collection):
+    """Identify a collection across the whole process.
+    """
+    db = collection.database
+    connection = db.connection
+    return (connection.host, connection.port, db.name, collection.name)
+
+
+def _ensure_index(collection, key_or_list, **kwargs):
+    """Ensure an index on a PyMongo collection at most once per process.
+    Returns ``True`` if the index was sent to the server.
+    """
+    if isinstance(key_or_list, basestring):
+        spec = ((key_or_list, pymongo.ASCENDING),)
+    else:
+        spec = tuple(tuple(item) for item in key_or_list)
+    key = _collection_key(collection) + (spec, tuple(sorted(kwargs.items())))
+
+    _index_registry_lock.acquire()
+    try:
+        if key in _index_registry:
+            return False
+        _index_registry.add(key)
+    finally:
+        _index_registry_lock.release()
+    try:
+        collection.ensure_index(list(spec), **kwargs)
+    except:
+        _index_registry_lock.acquire()
+        try:
+            _index_registry.discard(key)
+        finally:
+            _index_registry_lock.release()
+        raise
+    return True
+
+
+def _forget_indexes(collection):
+    """Remove all registry entries for a collection, e.g. after it has been
+    dropped.
+    """
+    prefix = _collection_key(collection)
+    _index_registry_lock.acquire()
+    try:
+        for key in [k for k in _index_registry if k[:4] == prefix]:
+            _index_registry.discard(key)
+        for doc_cls in list(_index_threads):
+            if doc_cls._meta['collection'] == collection.name:
+                _index_threads.discard(doc_cls)
+    finally:
+        _index_registry_lock.release()
+
+
+def _ensure_indexes_in_background(doc_cls):
+    """Ensure a document's indexes from a daemon thread, starting at most one
+    thread per document class.
+    """
+    _index_registry_lock.acquire()
+    try:
+        if doc_cls in _index_threads:
+            return
+        _index_threads.add(doc_cls)
+    finally:
+        _index_registry_lock.release()
+
+    def run():
+        try:
+            doc_cls.ensure_indexes()
+        except:
+            # Allow a later access to try again
+            _index_registry_lock.acquire()
+            try:
+                _index_threads.discard(doc_cls)
+            finally:
+                _index_registry_lock.release()
+            raise
+
+    thread = threading.Thread(target=run, name='ensure_indexes')
+    thread.setDaemon(True)
+    thread.start()
+
+
+def _load_references(references):
+    """Fetch referenced documents using one ``$in`` query per collection.
+    References are grouped by connection alias, database and collection, so
+    collections with the same name in different databases aren't mixed up.
+
+    :param references: a list of ``(document class, DBRef)`` pairs
+    :rtype: a list of the raw SON of the referenced documents, in the order
+        of ``references``, with ``None`` for documents that weren't found
+    """
+    collections = {}
+    ids = {}
+    keys = []
+    for doc_cls, dbref in references:
+        alias = _get_alias(doc_cls)
+        collection = _get_collection(doc_cls)
+        if dbref.collection != collection.name:
+            collection = collection.database[dbref.collection]
+        key = (alias, collection.database.name, collection.name)
+        if key not in collections:
+            collections[key] = collection
+            ids[key] = set()
+        ids[key].add(dbref.id)
+        keys.append((key, dbref.id))
+
+    loaded = {}
+    for key, collection in collections.items():
+        for son in collection.find({'_id': {'$in': list(ids[key])}}):
+            loaded[(key, son['_id'])] = son
+    return [loaded.get(key) for key in keys]
+
+
+def _dereference_documents(documents, field_names=None, depth=1):
+    """Replace the DBRefs held by the :class:`~mongoengine.ReferenceField`\ s
+    of several documents with the documents they refer to, issuing one query
+    per referenced collection for each level of references.
+
+    :param documents: the documents whose references should be loaded
+    :param field_names: only follow these fields on the first level, all
+        reference fields are followed if this is empty
+    :param depth: the number of levels of references to follow
+    """
+    from fields import ReferenceField
+
+    for level in range(depth):
+        targets = []
+        for doc in documents:
+            if doc is None:
+                continue
+            for name, field in doc._fields.items():
+                if level == 0 and field_names and name not in field_names:
+                    continue
+                if not isinstance(field, ReferenceField):
+                    continue
+                value = doc._data.get(name)
+                if isinstance(value, pymongo.dbref.DBRef):
+                    targets.append((doc, name, field.document_type, value))
+        if not targets:
+            break
+
+        loaded = _load_references([(t[2], t[3]) for t in targets])
+        documents = []
+        for (doc, name, doc_cls, dbref), son in zip(targets, loaded):
+            # Dangling references are left as DBRefs, as with lazy access
+            if son is not None:
+                doc._data[name] = doc_cls._from_son(son)
+                documents.append(doc._data[name])
+
+
+def _lookup_path(value, parts):
+    """Return the value found by following a path of database field names
+    through a raw dictionary, or ``None`` if there isn't one.
+    """
+    for part in parts:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _check_aggregation_options(options):
+    """Refuse options for :meth:`QuerySet.aggregate` that the installed
+    PyMongo can't apply.
+    """
+    if options.get('batch_size') and PYMONGO_VERSION < (2, 7):
+        raise OperationError('batch_size requires PyMongo >= 2.7')
+
+
+def _has_receivers(signal, sender):
+    """Return ``True`` if ``signal`` has receivers for ``sender``, including
+    receivers connected for any sender.
+    """
+    if hasattr(signal, 'has_listeners'):
+        return signal.has_listeners(sender)
+    # Django < 1.4 keys each receiver by the ids of the receiver and sender
+    from django.dispatch.dispatcher import _make_id
+    senders = (_make_id(None), _make_id(sender))
+    return bool([receiver for (receiver_id, sender_id), receiver
+                 in signal.receivers if sender_id in senders])
+
+
+def _insert_error(err):
+    """Describe why a document could not be inserted.
+    """
+    if u'duplicate key' in unicode(err):
+        return u'Tried to save duplicate unique keys (%s)' % unicode(err)
+    return u'Could not save document (%s)' % unicode(err)
+
+
+def _map_queryset(fn, queryset, collect):
+    """Apply a function to each document of a
+    :class:`~mongoengine.queryset.QuerySet` within a request, returning a
+    tuple of the results (if collected), the number of documents processed
+    and the exception that stopped the processing, if any.
+    """
+    alias = _get_alias(queryset._document)
+    results = []
+    count = 0
+    try:
+        start_request(alias)
+        try:
+            for doc in queryset.no_cache():
+                result = fn(doc)
+                if collect:
+                    results.append(result)
+                count += 1
+        finally:
+            end_request(alias)
+    except Exception, err:
+        return results, count, err
+    return results, count, None
+
+
+def _map_partition(args):
+    """Rebuild a partition of a :class:`~mongoengine.queryset.QuerySet` in a
+    worker process, which makes its own connection, and apply a function to
+    its documents (see :func:`_map_queryset`).
+    """
+    fn, doc_cls, state, collect = args
+    queryset = QuerySet(doc_cls, _get_collection(doc_cls))
+    queryset.__dict__.update(state)
+    return _map_queryset(fn, queryset, collect)
+
 
 class InternalMetadata:
     def __init__(self, meta):
@@ -150,6 +505,11 @@ class InternalModel:
 class QuerySet(object):
     """A set of results returned from a query. Wraps a MongoDB cursor,
     providing :class:`~mongoengine.Document` objects as the results.
+
+    Methods that refine the query return a new
+    :class:`~mongoengine.queryset.QuerySet` rather than changing the one they
+    are called on, and the cursor is only created when the results are read,
+    so a :class:`~mongoengine.queryset.QuerySet` may be built once and shared.
     """
 
     def __init__(self, document, collection):
@@ -157,7 +517,6 @@ class QuerySet(object):
         self._collection_obj = collection
         self._accessed_collection = False
         self._query = {}
-        self._where_clause = None
         self._loaded_fields = []
         self._ordering = []
         
@@ -168,6 +527,22 @@ class QuerySet(object):
         self._cursor_obj = None
         self._limit = None
         self._skip = None
+        self._select_related = None
+        self._select_related_depth = 1
+        self._related_buffer = []
+        self._lazy_hydration = None
+        self._as_pymongo = False
+        self._scalar = None
+        self._scalar_flat = False
+        self._result_cache = None
+        self._has_more = True
+        self._no_cache = False
+        self._batch_size = None
+        self._hint = None
+        self._max_time_ms = None
+        self._no_cursor_timeout = False
+        self._snapshot = False
+        self._comment = None
 
         #required for compatibility with django
         self.model = InternalModel(document)
@@ -180,7 +555,7 @@ class QuerySet(object):
             or a **-** to determine the index ordering
         """
         index_list = QuerySet._build_index_spec(self._document, key_or_list)
-        self._collection.ensure_index(index_list)
+        _ensure_index(self._collection, index_list)
         return self
 
     @classmethod
@@ -223,16 +598,19 @@ class QuerySet(object):
         :class:`~mongoengine.queryset.QuerySet` with a query.
 
         :param q_obj: a :class:`~mongoengine.queryset.Q` object to be used in
-            the query; the :class:`~mongoengine.queryset.QuerySet` is filtered
-            multiple times with different :class:`~mongoengine.queryset.Q`
-            objects, only the last one will be used
+            the query; if the :class:`~mongoengine.queryset.QuerySet` is
+            filtered multiple times with different
+            :class:`~mongoengine.queryset.Q` objects, all of them must match
         :param query: Django-style query keyword arguments
         """
+        queries = [self._query]
         if q_obj:
-            self._where_clause = q_obj.as_js(self._document)
-        query = QuerySet._transform_query(_doc_cls=self._document, **query)
-        self._query.update(query)
-        return self
+            queries.append(q_obj.to_query(self._document))
+        queries.append(QuerySet._transform_query(_doc_cls=self._document,
+                                                 **query))
+        queryset = self.clone()
+        queryset._query = _merge_queries(queries)
+        return queryset
 
     def filter(self, *q_objs, **query):
         """An alias of :meth:`~mongoengine.queryset.QuerySet.__call__`
@@ -244,37 +622,47 @@ class QuerySet(object):
         """
         return self.__call__()
 
+    def clone(self):
+        """Return a copy of the :class:`~mongoengine.queryset.QuerySet` that
+        may be refined without changing this one. The query that has already
+        been transformed is copied rather than built again, but results and
+        the cursor are not shared.
+
+        .. versionadded:: 0.4
+        """
+        queryset = self.__class__.__new__(self.__class__)
+        queryset.__dict__.update(self.__dict__)
+        queryset._query = self._query.copy()
+        queryset._cursor_obj = None
+        queryset._related_buffer = []
+        queryset._result_cache = None
+        queryset._has_more = True
+        return queryset
+
     @property
     def _collection(self):
         """Property that returns the collection object. This allows us to
         perform operations only if the collection is accessed.
+
+        The collection is obtained again if the document's database has
+        changed since the :class:`~mongoengine.queryset.QuerySet` was
+        created, e.g. in a forked child process, after :func:`connect` or
+        within :class:`~mongoengine.switch_db`.
         """
+        alias = _get_alias(self._document)
+        if self._collection_obj is None or \
+           self._collection_obj.database is not _get_db(alias):
+            self._collection_obj = _get_collection(self._document)
+
         if not self._accessed_collection:
             self._accessed_collection = True
-            
-            # Ensure document-defined indexes are created
-            if self._document._meta['indexes']:
-                for key_or_list in self._document._meta['indexes']:
-                    self._collection.ensure_index(key_or_list)
-
-            # Ensure indexes created by uniqueness constraints
-            for index in self._document._meta['unique_indexes']:
-                self._collection.ensure_index(index, unique=True)
-                
-            if self._document._meta['geo_indexes'] and \
-               pymongo.version >= "1.5.1":
-                from pymongo import GEO2D
-                for index in self._document._meta['geo_indexes']:
-                    self._collection.ensure_index([(index, GEO2D)])
-
-            # If _types is being used (for polymorphism), it needs an index
-            if '_types' in self._query:
-                self._collection.ensure_index('_types')
-            
-            # Ensure all needed field indexes are created
-            for field_name, field_instance in self._document._fields.iteritems():
-                if field_instance.__class__.__name__ == 'GeoLocationField':
-                    self._collection.ensure_index([(field_name, pymongo.GEO2D),])
+
+            # Indexes are ensured once per process, see Document.ensure_indexes
+            mode = self._document._meta.get('index_mode') or _index_mode
+            if mode == 'auto':
+                self._document.ensure_indexes()
+            elif mode == 'background':
+                _ensure_indexes_in_background(self._document)
         return self._collection_obj
 
     @property
@@ -283,15 +671,35 @@ class QuerySet(object):
             cursor_args = {}
             if self._loaded_fields:
                 cursor_args = {'fields': self._loaded_fields}
+            if self._snapshot:
+                cursor_args['snapshot'] = True
+            if self._no_cursor_timeout:
+                cursor_args['timeout'] = False
             self._cursor_obj = self._collection.find(self._query, 
                                                      **cursor_args)
-            # Apply where clauses to cursor
-            if self._where_clause:
-                self._cursor_obj.where(self._where_clause)
 
-            # apply default ordering
-            if self._document._meta['ordering']:
-                self.order_by(*self._document._meta['ordering'])
+            if self._batch_size:
+                self._cursor_obj.batch_size(self._batch_size)
+            if self._hint:
+                self._cursor_obj.hint(self._hint)
+            if self._max_time_ms is not None:
+                self._cursor_obj.max_time_ms(self._max_time_ms)
+            if self._comment is not None:
+                self._cursor_obj.comment(self._comment)
+
+            # apply default ordering, which can't be used with snapshots
+            ordering = self._ordering
+            if not ordering and not self._snapshot:
+                ordering = QuerySet._parse_ordering(
+                    self._document._meta['ordering'])
+            if ordering:
+                self._cursor_obj.sort(ordering)
+            if self._skip:
+                self._cursor_obj.skip(self._skip)
+            if self._limit is not None:
+                # A limit of 0 means no limit to MongoDB, so a single
+                # document is requested instead and not returned by next()
+                self._cursor_obj.limit(self._limit or 1)
 
         return self._cursor_obj
 
@@ -325,45 +733,86 @@ class QuerySet(object):
         parts = [f.db_field for f in QuerySet._lookup_field(doc_cls, parts)]
         return '.'.join(parts)
 
+    @classmethod
+    def _plans(cls, doc_cls, name):
+        """Return a document class's cache of compiled query or update keys,
+        emptying it if fields have been added to the class since it was
+        filled, or if it has reached :data:`QUERY_PLAN_CACHE_SIZE`.
+        """
+        cache = doc_cls.__dict__.get(name)
+        if (cache is None or cache[0] != len(doc_cls._fields) or
+            len(cache[1]) >= QUERY_PLAN_CACHE_SIZE):
+            cache = (len(doc_cls._fields), {})
+            setattr(doc_cls, name, cache)
+        return cache[1]
+
+    @classmethod
+    def _query_plan(cls, doc_cls, key):
+        """Compile a Django-style query key into a tuple of the database key,
+        the operator, the function used to prepare the value (or ``None`` if
+        the value is used unchanged) and whether the value is a list of
+        values to prepare. Plans are cached for each document class.
+        """
+        plans = None
+        if doc_cls:
+            plans = QuerySet._plans(doc_cls, '_query_plans')
+            plan = plans.get(key)
+            if plan is not None:
+                return plan
+
+        parts = key.split('__')
+        # Check for an operator and transform to mongo-style if there is
+        op = None
+        if (parts[-1] in QUERY_OPERATORS or parts[-1] in MATCH_OPERATORS or
+            parts[-1] in GEO_OPERATORS):
+            op = parts.pop()
+
+        prepare, many = None, False
+        if doc_cls:
+            from base import BaseField
+
+            # Switch field names to proper names [set in Field(name='foo')]
+            fields = QuerySet._lookup_field(doc_cls, parts)
+            parts = [field.db_field for field in fields]
+
+            # Find how the value should be converted
+            field = fields[-1]
+            if op in (None, 'ne', 'gt', 'gte', 'lt', 'lte') or \
+               op in MATCH_OPERATORS:
+                prepare = field.prepare_query_value
+            elif op in ('in', 'nin', 'all', 'near'):
+                # 'in', 'nin' and 'all' require a list of values
+                prepare, many = field.prepare_query_value, True
+            if prepare is not None and prepare.im_func is \
+               BaseField.prepare_query_value.im_func:
+                prepare, many = None, False
+
+            if field.__class__.__name__ == 'GenericReferenceField':
+                parts.append('_ref')
+
+        plan = ('.'.join(parts), op, prepare, many)
+        if plans is not None:
+            plans[key] = plan
+        return plan
+
     @classmethod
     def _transform_query(cls, _doc_cls=None, **query):
         """Transform a query from Django-style format to Mongo format.
         """
-        operators = ['ne', 'gt', 'gte', 'lt', 'lte', 'in', 'nin', 'mod',
-                     'all', 'size', 'exists']
-        geo_operators = ['within_distance', 'within_box', 'near']
-        match_operators = ['contains', 'icontains', 'startswith', 
-                           'istartswith', 'endswith', 'iendswith']
-
         mongo_query = {}
         for key, value in query.items():
-            parts = key.split('__')
-            # Check for an operator and transform to mongo-style if there is
-            op = None
-            if parts[-1] in operators + match_operators + geo_operators:
-                op = parts.pop()
-            
-            if _doc_cls:
-                # Switch field names to proper names [set in Field(name='foo')]
-                fields = QuerySet._lookup_field(_doc_cls, parts)
-                parts = [field.db_field for field in fields]
-
-                # Convert value to proper value
-                field = fields[-1]
-                singular_ops = [None, 'ne', 'gt', 'gte', 'lt', 'lte']
-                singular_ops += match_operators
-                if op in singular_ops:
-                    value = field.prepare_query_value(op, value)
-                elif op in ('in', 'nin', 'all', 'near'):
-                    # 'in', 'nin' and 'all' require a list of values
-                    value = [field.prepare_query_value(op, v) for v in value]
-
-                if field.__class__.__name__ == 'GenericReferenceField':
-                    parts.append('_ref')
+            key, op, prepare, many = QuerySet._query_plan(_doc_cls, key)
+
+            # Convert value to proper value
+            if prepare is not None:
+                if many:
+                    value = [prepare(op, v) for v in value]
+                else:
+                    value = prepare(op, value)
 
             # if op and op not in match_operators:
             if op:
-                if op in geo_operators:
+                if op in GEO_OPERATORS:
                     if op == "within_distance":
                         value = {'$within': {'$center': value}}
                     elif op == "near":
@@ -371,10 +820,12 @@ class QuerySet(object):
                     else:
                         raise NotImplementedError, \
                               "Geo method has been implemented"
-                elif op not in match_operators:
+                elif op == 'ne' and isinstance(value, RE_TYPE):
+                    # Regular expressions can't be used with $ne
+                    value = {'$not': value}
+                elif op not in MATCH_OPERATORS:
                     value = {'$' + op: value}
 
-            key = '.'.join(parts)
             if op is None or key not in mongo_query:
                 mongo_query[key] = value
             elif key in mongo_query and isinstance(mongo_query[key], dict):
@@ -393,14 +844,15 @@ class QuerySet(object):
         :class:`~mongoengine.queryset.DoesNotExist` or `DocumentName.DoesNotExist`
         if no results are found.
 
+        At most two documents are read, using a single query.
+
         .. versionadded:: 0.3
         """
-        self.__call__(*q_objs, **query)
-        count = self.count()
-        if count == 1:
-            return self[0]
-        elif count > 1:
-            message = u'%d items returned, instead of 1' % count
+        results = list(self.__call__(*q_objs, **query)[:2])
+        if len(results) == 1:
+            return results[0]
+        elif results:
+            message = u'2 or more items returned, instead of 1'
             raise self._document.MultipleObjectsReturned(message)
         else:
             raise self._document.DoesNotExist("%s matching query does not exist."
@@ -416,33 +868,119 @@ class QuerySet(object):
         dictionary of default values for the new document may be provided as a
         keyword argument called :attr:`defaults`.
 
+        The lookup is an upsert, which creates the document with a single
+        command if none matches. It only prevents duplicates when a unique
+        index covers the fields of the query: with one, if another process
+        creates a matching document at the same time, that document is
+        returned instead of a duplicate being saved; without one, two
+        processes may both create a document. When an existing document is
+        found, a second query checks that no other document matches, only so
+        that :class:`~mongoengine.queryset.MultipleObjectsReturned` is raised
+        as it is for :meth:`get`. Upserts require MongoDB 2.4 or newer; on
+        older servers, when the new document doesn't validate, or when
+        ``pre_save`` has receivers for the document class (which may change
+        the document before it is saved), the document is looked up and then
+        saved as before.
+
         .. versionadded:: 0.3
         """
         defaults = query.get('defaults', {})
         if 'defaults' in query:
             del query['defaults']
 
-        self.__call__(*q_objs, **query)
-        count = self.count()
-        if count == 0:
-            query.update(defaults)
-            doc = self._document(**query)
-            doc.save()
-            return doc, True
-        elif count == 1:
-            return self.first(), False
-        else:
-            message = u'%d items returned, instead of 1' % count
+        queryset = self.__call__(*q_objs, **query)
+        query.update(defaults)
+        doc = self._document(**query)
+        server = _collection_key(self._collection)[:2]
+        if server in _no_set_on_insert or \
+           (signals and _has_receivers(signals.pre_save, self._document)):
+            return queryset._get_or_save(doc)
+
+        # The new document must be valid to be upserted, but if it isn't, a
+        # matching document may still exist, so look it up instead
+        from base import ValidationError
+        try:
+            doc.validate()
+        except ValidationError:
+            return queryset._get_or_save(doc)
+
+        # Insert the document with an upsert that leaves any matching
+        # document unchanged, and returns it instead
+        son = doc.to_mongo()
+        # Keep an _id given explicitly, unless the query already sets it
+        if son.get('_id') is None or queryset._query.get('_id') == son['_id']:
+            son.pop('_id', None)
+        try:
+            response = queryset._find_and_modify({'$setOnInsert': son},
+                                                 upsert=True)
+        except pymongo.errors.OperationFailure, err:
+            if u'$setOnInsert' not in unicode(err):
+                raise OperationError(_insert_error(err))
+            _no_set_on_insert.add(server)
+            return queryset._get_or_save(doc)
+
+        value = response['value']
+        if response.get('lastErrorObject', {}).get('updatedExisting'):
+            # The upsert returns any one of the matching documents, so look
+            # for another one only to raise MultipleObjectsReturned
+            matches = queryset.clone()
+            matches._loaded_fields = ['_id']
+            matches._as_pymongo = True
+            matches._select_related = None
+            if len(list(matches[:2])) > 1:
+                message = u'2 or more items returned, instead of 1'
+                raise self._document.MultipleObjectsReturned(message)
+            return queryset._build_result(value), False
+
+        id_field = self._document._meta['id_field']
+        doc[id_field] = self._document._fields[id_field].to_python(
+            value['_id'])
+        doc._clear_changed_fields()
+        doc._created = False
+        if signals:
+            signals.post_save.send(sender=doc.__class__, instance=doc,
+                                   created=True, raw=None)
+        return doc, True
+
+    def _get_or_save(self, doc):
+        """Return the document matched by the query, or save ``doc`` if there
+        isn't one, for :meth:`get_or_create` when it can't upsert ``doc``.
+        """
+        results = list(self[:2])
+        if len(results) == 1:
+            return results[0], False
+        elif results:
+            message = u'2 or more items returned, instead of 1'
             raise self._document.MultipleObjectsReturned(message)
+        doc.save()
+        return doc, True
 
     def first(self):
-        """Retrieve the first object matching the query.
+        """Retrieve the first object matching the query, or ``None`` if there
+        are none.
         """
-        try:
-            result = self[0]
-        except IndexError:
-            result = None
-        return result
+        if self._result_cache is not None:
+            self._fill_cache(1 - len(self._result_cache))
+            if self._result_cache:
+                return self._result_cache[0]
+            return None
+        results = list(self[:1])
+        if results:
+            return results[0]
+        return None
+
+    def exists(self):
+        """Return whether any document matches the query. Only the ``_id``
+        of a single document is read.
+
+        .. versionadded:: 0.4
+        """
+        if self._result_cache is not None:
+            return bool(self)
+        queryset = self[:1]
+        queryset._loaded_fields = ['_id']
+        queryset._as_pymongo = True
+        return bool(list(queryset))
 
     def with_id(self, object_id):
         """Retrieve the object matching the id provided.
@@ -452,9 +990,10 @@ class QuerySet(object):
         id_field = self._document._meta['id_field']
         object_id = self._document._fields[id_field].to_mongo(object_id)
 
-        result = self._collection.find_one({'_id': object_id})
+        result = self._collection.find_one({'_id': object_id},
+                                           fields=self._loaded_fields or None)
         if result is not None:
-            result = self._document._from_son(result)
+            result = self._build_result(result)
         return result
 
     def in_bulk(self, object_ids):
@@ -468,39 +1007,362 @@ class QuerySet(object):
         """
         doc_map = {}
 
-        docs = self._collection.find({'_id': {'$in': object_ids}})
+        docs = self._collection.find({'_id': {'$in': object_ids}},
+                                     fields=self._loaded_fields or None)
         for doc in docs:
-            doc_map[doc['_id']] = self._document._from_son(doc)
+            doc_map[doc['_id']] = self._build_result(doc)
  
         return doc_map
 
+    def insert(self, doc_or_docs, load_bulk=True, batch_size=None,
+               ordered=False, send_signals=False, safe=True):
+        """Insert one or more new documents using as few round trips as
+        possible, rather than calling :meth:`~mongoengine.Document.save` on
+        each of them. The documents are validated and encoded, then sent in
+        batches of at most ``batch_size`` documents and
+        :data:`INSERT_BATCH_BYTES` bytes, and their ids are set once they
+        have been inserted. ::
+
+            BlogPost.objects.insert([BlogPost(title=title) for title in titles])
+
+        If ``safe=True`` and some documents could not be inserted, for
+        instance because of duplicate unique keys, a
+        :class:`~mongoengine.queryset.BulkInsertError` listing each failed
+        document is raised once the other documents have been inserted. To
+        tell them apart from documents already in the collection, the ids of
+        documents that have them set are looked up before each batch.
+
+        :param doc_or_docs: a document or a list of documents to insert
+        :param load_bulk: return the inserted documents if ``True``, or only
+            their ids if ``False``
+        :param batch_size: the maximum number of documents per insert message
+            (defaults to :data:`INSERT_BATCH_SIZE`)
+        :param ordered: stop at the first document that could not be
+            inserted rather than inserting the remaining documents
+        :param send_signals: send the ``pre_save`` and ``post_save`` signals
+            for each document
+        :param safe: check if the operation succeeded before returning
+
+        .. versionadded:: 0.4
+        """
+        return_one = isinstance(doc_or_docs, self._document)
+        if return_one:
+            docs = [doc_or_docs]
+        else:
+            docs = list(doc_or_docs)
+
+        for doc in docs:
+            if not isinstance(doc, self._document):
+                raise OperationError('Some documents to insert are not '
+                                     'instances of %s'
+                                     % self._document._class_name)
+
+        if send_signals and signals:
+            for doc in docs:
+                signals.pre_save.send(sender=doc.__class__, instance=doc,
+                                      raw=None)
+
+        # Encode the documents and split them into batches
+        batch_size = batch_size or INSERT_BATCH_SIZE
+        batches = []
+        batch, batch_bytes = [], 0
+        generated = set()
+        for index, doc in enumerate(docs):
+            doc.validate()
+            son = doc.to_mongo()
+            for field_name in doc._dynamic_fields:
+                if field_name in doc._data:
+                    son[field_name] = doc._data[field_name]
+            # Ids are assigned here, so that the documents which were
+            # inserted may be found if a batch fails
+            if son.get('_id') is None:
+                son['_id'] = pymongo.objectid.ObjectId()
+                generated.add(index)
+            try:
+                size = len(BSON.encode(son))
+            except pymongo.errors.InvalidDocument:
+                # Values a SON manipulator will transform can't be measured
+                size = 0
+            if batch and (len(batch) >= batch_size or
+                          batch_bytes + size > INSERT_BATCH_BYTES):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append((index, doc, son))
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+
+        inserted, errors = [], []
+        for batch in batches:
+            # Ids given by the caller may already be used, in which case the
+            # documents can't be inserted, but would still be found below
+            explicit = [son['_id'] for i, d, son in batch
+                        if i not in generated]
+            existing = set()
+            if explicit and safe:
+                existing = set(son['_id'] for son in self._collection.find(
+                    {'_id': {'$in': explicit}}, fields=['_id']))
+            try:
+                self._collection.insert([son for i, d, son in batch],
+                                        safe=safe)
+                inserted += batch
+                continue
+            except pymongo.errors.OperationFailure, err:
+                error = err
+
+            # Find out which documents the server inserted before it stopped
+            ids = [son['_id'] for i, d, son in batch]
+            found = self._collection.find({'_id': {'$in': ids}},
+                                          fields=['_id'])
+            found = set(son['_id'] for son in found) - existing
+            remaining = []
+            for item in batch:
+                if item[2]['_id'] in found:
+                    inserted.append(item)
+                else:
+                    remaining.append(item)
+
+            if ordered:
+                if remaining:
+                    index, doc = remaining[0][:2]
+                    errors.append((index, doc, _insert_error(error)))
+                else:
+                    errors.append((None, None, _insert_error(error)))
+                break
+
+            # Insert the rest of the batch one by one to find which of the
+            # documents failed
+            for index, doc, son in remaining:
+                try:
+                    self._collection.insert(son, safe=True)
+                    inserted.append((index, doc, son))
+                except pymongo.errors.OperationFailure, err:
+                    errors.append((index, doc, _insert_error(err)))
+
+        id_field = self._document._meta['id_field']
+        for index, doc, son in inserted:
+            doc[id_field] = doc._fields[id_field].to_python(son['_id'])
+            doc._clear_changed_fields()
+            doc._created = False
+            if send_signals and signals:
+                signals.post_save.send(sender=doc.__class__, instance=doc,
+                                       created=True, raw=None)
+
+        if errors:
+            message = u'%d of %d documents could not be inserted (%s)'
+            message %= (len(errors), len(docs), errors[0][2])
+            raise BulkInsertError(message, errors,
+                                  [doc for i, doc, son in inserted])
+
+        if load_bulk:
+            results = docs
+        else:
+            results = [doc[id_field] for doc in docs]
+        if return_one:
+            return results[0]
+        return results
+
+    def select_related(self, *fields, **options):
+        """Load the documents referenced by
+        :class:`~mongoengine.ReferenceField`\ s along with the results, in
+        batches of :data:`SELECT_RELATED_BATCH_SIZE` documents, rather than
+        querying once per document when each reference is accessed. ::
+
+            posts = BlogPost.objects.select_related('author', depth=2)
+
+        :param fields: the reference fields to load; all reference fields are
+            loaded if none are given
+        :param depth: the number of levels of references to follow
+            (default 1), nested levels follow every reference field
+
+        .. versionadded:: 0.4
+        """
+        queryset = self.clone()
+        queryset._select_related = list(fields)
+        queryset._select_related_depth = options.get('depth', 1)
+        return queryset
+
+    def lazy_hydration(self, enabled=True):
+        """Keep the values of the returned documents as they were read from
+        the database, and only convert each one the first time its field is
+        accessed. This saves time and memory when only a few fields of large
+        documents are used. Overrides :attr:`lazy_hydration` in the
+        document's :attr:`meta`. Documents with dynamic fields or a custom
+        ``__init__`` are always hydrated fully.
+
+        :param enabled: whether documents should be hydrated lazily
+
+        .. versionadded:: 0.4
+        """
+        queryset = self.clone()
+        queryset._lazy_hydration = enabled
+        return queryset
+
+    def as_pymongo(self):
+        """Return the raw dictionaries read from the database rather than
+        :class:`~mongoengine.Document` objects. ::
+
+            for son in BlogPost.objects.only('title').as_pymongo():
+                print son['title']
+
+        .. versionadded:: 0.4
+        """
+        queryset = self.clone()
+        queryset._as_pymongo = True
+        queryset._scalar = None
+        return queryset
+
+    def values_list(self, *fields, **options):
+        """Return tuples of the values of the given fields rather than
+        :class:`~mongoengine.Document` objects. Only those fields are loaded
+        from the database, and only their values are converted. Subfields of
+        embedded documents may be given using dot notation. ::
+
+            for title, author_name in BlogPost.objects.values_list(
+                    'title', 'author.name'):
+                ...
+
+        :param fields: the fields whose values should be returned
+        :param flat: return single values rather than 1-tuples, only
+            allowed when a single field is given
+
+        .. versionadded:: 0.4
+        """
+        from base import BaseField
+
+        flat = options.get('flat', False)
+        if flat and len(fields) != 1:
+            raise InvalidQueryError('flat is only allowed when a single '
+                                    'field is given to QuerySet.values_list')
+
+        queryset = self.clone()
+        queryset._loaded_fields = []
+        queryset._scalar = []
+        for field_name in fields:
+            field_path = QuerySet._lookup_field(self._document,
+                                                field_name.split('.'))
+            parts = [field.db_field for field in field_path]
+            field = field_path[-1]
+            # Don't call converters that would return the value unchanged
+            to_python = field.to_python
+            if to_python.im_func is BaseField.to_python.im_func:
+                to_python = None
+            queryset._loaded_fields.append('.'.join(parts))
+            queryset._scalar.append((parts, to_python))
+        queryset._scalar_flat = flat
+        queryset._as_pymongo = False
+        return queryset
+
+    def scalar(self, *fields):
+        """Return the values of the given fields rather than
+        :class:`~mongoengine.Document` objects: a single value per result
+        when one field is given, or a tuple of values when several are given.
+        See :meth:`~mongoengine.queryset.QuerySet.values_list`. ::
+
+            titles = list(BlogPost.objects.scalar('title'))
+
+        :param fields: the fields whose values should be returned
+
+        .. versionadded:: 0.4
+        """
+        return self.values_list(*fields, **{'flat': len(fields) == 1})
+
+    def _scalar_values(self, son):
+        """Pick the values of the fields given to :meth:`values_list` out of
+        a raw dictionary read from the database.
+        """
+        values = []
+        for parts, to_python in self._scalar:
+            value = _lookup_path(son, parts)
+            if value is not None and to_python is not None:
+                value = to_python(value)
+            values.append(value)
+
+        if self._scalar_flat:
+            return values[0]
+        return tuple(values)
+
+    def _build_result(self, son):
+        """Turn a raw dictionary read from the database into a result, which
+        is a :class:`~mongoengine.Document` unless :meth:`as_pymongo` or
+        :meth:`values_list` was used.
+        """
+        if self._as_pymongo:
+            return son
+        if self._scalar is not None:
+            return self._scalar_values(son)
+        return self._document._from_son(son, self._lazy_hydration)
+
+    def _next_related(self):
+        """Return the next document from a batch of documents whose
+        references have been loaded together.
+        """
+        if not self._related_buffer:
+            batch = []
+            while len(batch) < SELECT_RELATED_BATCH_SIZE:
+                try:
+                    son = self._cursor.next()
+                except StopIteration:
+                    break
+                batch.append(self._document._from_son(
+                    son, self._lazy_hydration))
+            _dereference_documents(batch, self._select_related,
+                                   self._select_related_depth)
+            batch.reverse()
+            self._related_buffer = batch
+
+        if not self._related_buffer:
+            raise StopIteration
+        return self._related_buffer.pop()
+
     def next(self):
         """Wrap the result in a :class:`~mongoengine.Document` object.
         """
         try:
             if self._limit == 0:
                 raise StopIteration
-            return self._document._from_son(self._cursor.next())
+            if (self._select_related is not None and not self._as_pymongo
+                and self._scalar is None):
+                return self._next_related()
+            return self._build_result(self._cursor.next())
         except StopIteration, e:
-            self.rewind()
+            # Rewind the cursor, but keep any results that have been cached
+            self._related_buffer = []
+            self._cursor.rewind()
             raise e
 
     def rewind(self):
-        """Rewind the cursor to its unevaluated state.
+        """Rewind the cursor to its unevaluated state, emptying the result
+        cache.
 
         .. versionadded:: 0.3
         """
+        self._related_buffer = []
+        self._result_cache = None
         self._cursor.rewind()
 
-    def count(self):
+    def count(self, with_limit_and_skip=False):
         """Count the selected elements in the query.
+
+        :param with_limit_and_skip: take any :meth:`limit` or :meth:`skip`
+            into account, counting the documents the query would return
         """
         if self._limit == 0:
             return 0
-        return self._cursor.count(with_limit_and_skip=False)
+        return self._cursor.count(with_limit_and_skip=with_limit_and_skip)
 
     def __len__(self):
-        return self.count()
+        if self._result_cache is None:
+            return self.count(with_limit_and_skip=True)
+        self._fill_cache()
+        return len(self._result_cache)
+
+    def __nonzero__(self):
+        if self._no_cache:
+            return self.exists()
+        if not self._result_cache:
+            self._fill_cache(1)
+        return bool(self._result_cache)
 
     def map_reduce(self, map_f, reduce_f, finalize_f=None, limit=None,
                    scope=None, keep_temp=False):
@@ -583,14 +1445,9 @@ class QuerySet(object):
 
         :param n: the maximum number of objects to return
         """
-        if n == 0:
-            self._cursor.limit(1)
-        else:
-            self._cursor.limit(n)
-        self._limit = n
-
-        # Return self to allow chaining
-        return self
+        queryset = self.clone()
+        queryset._limit = n
+        return queryset
 
     def skip(self, n):
         """Skip `n` documents before returning the results. This may also be
@@ -598,33 +1455,49 @@ class QuerySet(object):
 
         :param n: the number of objects to skip before returning results
         """
-        self._cursor.skip(n)
-        self._skip = n
-        return self
+        queryset = self.clone()
+        queryset._skip = n
+        return queryset
 
     def __getitem__(self, key):
         """Support skip and limit using getitem and slicing syntax.
         """
         # Slice provided
         if isinstance(key, slice):
-            try:
-                self._cursor_obj = self._cursor[key]
-                self._skip, self._limit = key.start, key.stop
-            except IndexError, err:
-                # PyMongo raises an error if key.start == key.stop, catch it,
-                # bin it, kill it. 
-                start = key.start or 0
-                if start >= 0 and key.stop >= 0 and key.step is None:
-                    if start == key.stop:
-                        self.limit(0)
-                        self._skip, self._limit = key.start, key.stop - start
-                        return self
-                raise err
+            if key.step is not None:
+                raise IndexError('QuerySet does not support slice steps')
+            start, stop = key.start or 0, key.stop
+            if start < 0 or (stop is not None and stop < 0):
+                raise IndexError('QuerySet does not support negative indices')
+
+            # Slices are taken from the documents already selected
+            queryset = self.clone()
+            queryset._skip = (self._skip or 0) + start
+            limit = self._limit
+            if limit is not None:
+                limit = max(limit - start, 0)
+            if stop is not None:
+                stop_limit = max(stop - start, 0)
+                if limit is None or stop_limit < limit:
+                    limit = stop_limit
+            queryset._limit = limit
             # Allow further QuerySet modifications to be performed
-            return self
+            return queryset
         # Integer index provided
         elif isinstance(key, int):
-            return self._document._from_son(self._cursor[key])
+            if self._result_cache is not None:
+                # Only read as many results as are needed to reach the index
+                if key < 0:
+                    self._fill_cache()
+                else:
+                    self._fill_cache(key + 1 - len(self._result_cache))
+                return self._result_cache[key]
+            result = self._build_result(self._cursor[key])
+            if (self._select_related is not None and not self._as_pymongo
+                and self._scalar is None):
+                _dereference_documents([result], self._select_related,
+                                       self._select_related_depth)
+            return result
 
     def only(self, *fields):
         """Load only a subset of this document's fields. ::
@@ -635,27 +1508,25 @@ class QuerySet(object):
 
         .. versionadded:: 0.3
         """
-        self._loaded_fields = []
+        queryset = self.clone()
+        queryset._loaded_fields = []
         for field in fields:
             if '.' in field:
                 raise InvalidQueryError('Subfields cannot be used as '
                                         'arguments to QuerySet.only')
             # Translate field name
             field = QuerySet._lookup_field(self._document, field)[-1].db_field
-            self._loaded_fields.append(field)
+            queryset._loaded_fields.append(field)
 
         # _cls is needed for polymorphism
         if self._document._meta.get('allow_inheritance'):
-            self._loaded_fields += ['_cls']
-        return self
-
-    def order_by(self, *keys):
-        """Order the :class:`~mongoengine.queryset.QuerySet` by the keys. The
-        order may be specified by prepending each of the keys by a + or a -.
-        Ascending order is assumed.
+            queryset._loaded_fields += ['_cls']
+        return queryset
 
-        :param keys: fields to order the query results by; keys may be
-            prefixed with **+** or **-** to determine the ordering direction
+    @classmethod
+    def _parse_ordering(cls, keys):
+        """Turn keys prefixed with **+** or **-** into a list of
+        ``(key, direction)`` pairs.
         """
         key_list = []
         for key in keys:
@@ -665,10 +1536,245 @@ class QuerySet(object):
             if key[0] in ('-', '+'):
                 key = key[1:]
             key_list.append((key, direction))
+        return key_list
 
-        self._ordering = key_list
-        self._cursor.sort(key_list)
-        return self
+    def order_by(self, *keys):
+        """Order the :class:`~mongoengine.queryset.QuerySet` by the keys. The
+        order may be specified by prepending each of the keys by a + or a -.
+        Ascending order is assumed.
+
+        :param keys: fields to order the query results by; keys may be
+            prefixed with **+** or **-** to determine the ordering direction
+        """
+        queryset = self.clone()
+        queryset._ordering = QuerySet._parse_ordering(keys)
+        return queryset
+
+    def batch_size(self, size):
+        """Read the results from the server in batches of ``size`` documents,
+        rather than letting the server choose the size of each batch.
+
+        :param size: the number of documents in each batch
+
+        .. versionadded:: 0.4
+        """
+        queryset = self.clone()
+        queryset._batch_size = size
+        return queryset
+
+    def hint(self, index):
+        """Tell the server which index to use for the query. The index may
+        be given as in the :attr:`indexes` of the document's :attr:`meta`
+        (e.g. ``'-date'`` or ``['title', '-date']``), by its name in the
+        database (e.g. ``'title_1_date_-1'``), or as a list of ``(key,
+        direction)`` pairs.
+
+        :param index: the index to use, or ``None`` to remove the hint
+
+        .. versionadded:: 0.4
+        """
+        queryset = self.clone()
+        queryset._hint = self._resolve_index(index)
+        return queryset
+
+    def _resolve_index(self, index):
+        """Turn an index given to :meth:`hint` into a list of ``(key,
+        direction)`` pairs.
+        """
+        if index is None:
+            return None
+        if isinstance(index, (list, tuple)) and index and \
+           isinstance(index[0], (list, tuple)):
+            return list(index)
+
+        meta = self._document._meta
+        indexes = [list(spec) for spec in meta['indexes']]
+        indexes += [list(spec) for spec in meta['unique_indexes']]
+        if isinstance(index, basestring):
+            for spec in indexes:
+                name = '_'.join(['%s_%s' % item for item in spec])
+                if index == name:
+                    return spec
+        try:
+            spec = QuerySet._build_index_spec(self._document, index)
+        except (KeyError, InvalidQueryError):
+            raise InvalidQueryError('Cannot resolve index "%s"' % (index,))
+        # _types is prepended to the indexes in meta, but not to those
+        # created by uniqueness constraints
+        if spec not in indexes and spec[0][0] == '_types' and \
+           spec[1:] in indexes:
+            return spec[1:]
+        return spec
+
+    def max_time_ms(self, ms):
+        """Limit the time the server may spend running the query, after which
+        an error is raised rather than the query running on.
+
+        :param ms: the time limit in milliseconds, or ``None`` for no limit
+
+        .. note:: Requires MongoDB **>= 2.6** and PyMongo **>= 2.7**; an
+           :class:`~mongoengine.queryset.OperationError` is raised with older
+           versions of PyMongo.
+
+        .. versionadded:: 0.4
+        """
+        if PYMONGO_VERSION < (2, 7):
+            raise OperationError('max_time_ms() requires PyMongo >= 2.7')
+        queryset = self.clone()
+        queryset._max_time_ms = ms
+        return queryset
+
+    def no_cursor_timeout(self):
+        """Keep the cursor open on the server while it's idle, rather than
+        letting the server close it after ten minutes, for long running
+        exports. The cursor is only closed once all the results have been
+        read, or when it is garbage collected.
+
+        .. versionadded:: 0.4
+        """
+        queryset = self.clone()
+        queryset._no_cursor_timeout = True
+        return queryset
+
+    def snapshot(self):
+        """Use snapshot mode, which makes sure that documents moved while the
+        results are read aren't returned more than once. It can't be used with
+        sorting or :meth:`hint`.
+
+        .. versionadded:: 0.4
+        """
+        queryset = self.clone()
+        queryset._snapshot = True
+        return queryset
+
+    def comment(self, text):
+        """Attach a comment to the query, which identifies it in the server's
+        logs and profiler.
+
+        :param text: the comment
+
+        .. note:: Requires PyMongo **>= 2.7**; an
+           :class:`~mongoengine.queryset.OperationError` is raised with older
+           versions.
+
+        .. versionadded:: 0.4
+        """
+        if PYMONGO_VERSION < (2, 7):
+            raise OperationError('comment() requires PyMongo >= 2.7')
+        queryset = self.clone()
+        queryset._comment = text
+        return queryset
+
+    def _page_ordering(self):
+        """Return the ordering used to paginate the
+        :class:`~mongoengine.queryset.QuerySet`, as ``(db key, direction)``
+        pairs ending with ``_id`` so that every document has a unique
+        position.
+        """
+        ordering = self._ordering or \
+                   QuerySet._parse_ordering(self._document._meta['ordering'])
+        keys = []
+        for key, direction in ordering:
+            try:
+                key = QuerySet._translate_field_name(self._document, key)
+            except (KeyError, InvalidQueryError):
+                # Assume the key is already the name used in the database
+                pass
+            keys.append((key, direction))
+
+        if '_id' not in [key for key, direction in keys]:
+            direction = pymongo.ASCENDING
+            if keys:
+                direction = keys[-1][1]
+            keys.append(('_id', direction))
+        return keys
+
+    def _page_values(self, last, keys):
+        """Return the values of the ordering keys of a document, a raw
+        dictionary or a token made by :meth:`page_token`.
+        """
+        if isinstance(last, basestring):
+            try:
+                data = BSON(base64.urlsafe_b64decode(str(last))).decode()
+            except (TypeError, ValueError, pymongo.errors.InvalidBSON):
+                raise InvalidQueryError('Invalid page token')
+            if data.get('k') != [key for key, direction in keys]:
+                raise InvalidQueryError('The page token was not made for the '
+                                        'ordering of this QuerySet')
+            return data['v']
+
+        if not isinstance(last, dict):
+            last = last.to_mongo()
+        return [_lookup_path(last, key.split('.')) for key, direction in keys]
+
+    def page_token(self, last):
+        """Return a string, safe to use in URLs, that identifies the position
+        of a document in the ordering of the
+        :class:`~mongoengine.queryset.QuerySet`. The next page may then be
+        read by passing it to :meth:`paginate_after`.
+
+        :param last: the last document of a page, or the raw dictionary
+            returned for it by :meth:`as_pymongo`
+
+        .. versionadded:: 0.4
+        """
+        keys = self._page_ordering()
+        data = {'k': [key for key, direction in keys],
+                'v': self._page_values(last, keys)}
+        return base64.urlsafe_b64encode(BSON.encode(data))
+
+    def paginate_after(self, last, page_size):
+        """Return a page of the documents that follow ``last`` in the ordering
+        of the :class:`~mongoengine.queryset.QuerySet`. The ordering is given
+        a final ``_id`` key, and ``last`` is excluded using range conditions
+        on the ordering keys rather than skipping the earlier documents. The
+        cost of reading a page therefore doesn't grow with the number of
+        earlier pages, as long as an index covers the ordering. ::
+
+            page = BlogPost.objects.order_by('-published').paginate_after(
+                request.GET.get('after'), 20)
+            posts = list(page)
+            after = page.page_token(posts[-1])
+
+        Documents whose ordering keys are missing or ``None`` can't be
+        compared with these conditions, so they may be skipped.
+
+        :param last: the last document of the previous page, its raw
+            dictionary, a token made by :meth:`page_token`, or ``None`` for
+            the first page
+        :param page_size: the number of documents in a page
+
+        .. versionadded:: 0.4
+        """
+        keys = self._page_ordering()
+        queryset = self.clone()
+        queryset._ordering = keys
+
+        if last is not None:
+            values = self._page_values(last, keys)
+            clauses = []
+            for i, (key, direction) in enumerate(keys):
+                clause = dict((prev_key, value) for (prev_key, prev_direction),
+                              value in zip(keys[:i], values[:i]))
+                operator = '$gt'
+                if direction == pymongo.DESCENDING:
+                    operator = '$lt'
+                clause[key] = {operator: values[i]}
+                clauses.append(clause)
+
+            if len(clauses) == 1:
+                condition = clauses[0]
+            else:
+                # Also bound the first key on its own, so that the query is
+                # a range scan over an index on the ordering keys
+                operator = '$gte'
+                if keys[0][1] == pymongo.DESCENDING:
+                    operator = '$lte'
+                condition = {keys[0][0]: {operator: values[0]},
+                             '$or': clauses}
+            queryset._query = _merge_queries([queryset._query, condition])
+
+        return queryset[:page_size]
 
     def explain(self, format=False):
         """Return an explain plan record for the
@@ -690,43 +1796,76 @@ class QuerySet(object):
         """
         self._collection.remove(self._query, safe=safe)
 
+    @classmethod
+    def _update_plan(cls, doc_cls, key):
+        """Compile a Django-style update key into a tuple of the database
+        key, the MongoDB operator (without the ``$``), the function used to
+        prepare the value (or ``None``), whether the value is a list of values
+        to prepare and whether a positive value should be negated. Plans are
+        cached for each document class, as with :meth:`_query_plan`.
+        """
+        plans = None
+        if doc_cls:
+            plans = QuerySet._plans(doc_cls, '_update_plans')
+            plan = plans.get(key)
+            if plan is not None:
+                return plan
+
+        parts = key.split('__')
+        # Check for an operator and transform to mongo-style if there is
+        op = None
+        negate = False
+        if parts[0] in UPDATE_OPERATORS:
+            op = parts.pop(0)
+            # Convert Pythonic names to Mongo equivalents
+            if op in ('push_all', 'pull_all'):
+                op = op.replace('_all', 'All')
+            elif op == 'dec':
+                # Support decrement by flipping a positive value's sign
+                # and using 'inc'
+                op = 'inc'
+                negate = True
+
+        prepare, many = None, False
+        if doc_cls:
+            from base import BaseField
+
+            # Switch field names to proper names [set in Field(name='foo')]
+            fields = QuerySet._lookup_field(doc_cls, parts)
+            parts = [field.db_field for field in fields]
+
+            # Find how the value should be converted
+            field = fields[-1]
+            if op in (None, 'set', 'unset', 'push', 'pull'):
+                prepare = field.prepare_query_value
+            elif op in ('pushAll', 'pullAll'):
+                prepare, many = field.prepare_query_value, True
+            if prepare is not None and prepare.im_func is \
+               BaseField.prepare_query_value.im_func:
+                prepare, many = None, False
+
+        plan = ('.'.join(parts), op, prepare, many, negate)
+        if plans is not None:
+            plans[key] = plan
+        return plan
+
     @classmethod
     def _transform_update(cls, _doc_cls=None, **update):
         """Transform an update spec from Django-style format to Mongo format.
         """
-        operators = ['set', 'unset', 'inc', 'dec', 'push', 'push_all', 'pull',
-                     'pull_all']
-
         mongo_update = {}
         for key, value in update.items():
-            parts = key.split('__')
-            # Check for an operator and transform to mongo-style if there is
-            op = None
-            if parts[0] in operators:
-                op = parts.pop(0)
-                # Convert Pythonic names to Mongo equivalents
-                if op in ('push_all', 'pull_all'):
-                    op = op.replace('_all', 'All')
-                elif op == 'dec':
-                    # Support decrement by flipping a positive value's sign
-                    # and using 'inc'
-                    op = 'inc'
-                    if value > 0:
-                        value = -value
-
-            if _doc_cls:
-                # Switch field names to proper names [set in Field(name='foo')]
-                fields = QuerySet._lookup_field(_doc_cls, parts)
-                parts = [field.db_field for field in fields]
-
-                # Convert value to proper value
-                field = fields[-1]
-                if op in (None, 'set', 'unset', 'push', 'pull'):
-                    value = field.prepare_query_value(op, value)
-                elif op in ('pushAll', 'pullAll'):
-                    value = [field.prepare_query_value(op, v) for v in value]
-
-            key = '.'.join(parts)
+            key, op, prepare, many, negate = QuerySet._update_plan(_doc_cls,
+                                                                   key)
+            if negate and value > 0:
+                value = -value
+
+            # Convert value to proper value
+            if prepare is not None:
+                if many:
+                    value = [prepare(op, v) for v in value]
+                else:
+                    value = prepare(op, value)
 
             if op:
                 value = {key: value}
@@ -781,8 +1920,130 @@ class QuerySet(object):
         except pymongo.errors.OperationFailure, e:
             raise OperationError(u'Update failed [%s]' % unicode(e))
 
+    def _find_and_modify(self, update=None, upsert=False, new=True,
+                         remove=False):
+        """Run a findAndModify command on the first document matched by the
+        query, in the order of the :class:`~mongoengine.queryset.QuerySet`,
+        and return the server's response.
+        """
+        collection = self._collection
+        command = SON([('findandmodify', collection.name),
+                       ('query', self._query)])
+        ordering = self._ordering or \
+                   QuerySet._parse_ordering(self._document._meta['ordering'])
+        if ordering:
+            command['sort'] = SON(ordering)
+        if self._loaded_fields:
+            command['fields'] = dict((field, 1)
+                                     for field in self._loaded_fields)
+        if remove:
+            command['remove'] = True
+        else:
+            command['update'] = update
+            command['new'] = new
+            command['upsert'] = upsert
+
+        try:
+            response = collection.database.command(command)
+        except pymongo.errors.OperationFailure, err:
+            # Servers before 2.0 report a failure when nothing matched
+            if u'No matching object found' in unicode(err):
+                return {}
+            raise
+
+        if response.get('value') is not None:
+            # Commands bypass the SON manipulators applied to queries
+            response['value'] = collection.database._fix_outgoing(
+                response['value'], collection)
+        return response
+
+    def modify(self, upsert=False, new=True, remove=False, **update):
+        """Atomically update or remove the first document matched by the
+        query, and return it, using a single findAndModify command. The
+        document is chosen using the ordering of the
+        :class:`~mongoengine.queryset.QuerySet`, and only the fields given
+        to :meth:`only` are returned. ::
+
+            job = Job.objects(state='queued').order_by('created').modify(
+                set__state='running')
+
+        :param upsert: insert a document if none is matched
+        :param new: return the document as it is after the update rather
+            than before it
+        :param remove: remove the document rather than updating it
+        :param update: Django-style update keyword arguments
+
+        Returns ``None`` if no document was matched, or if ``new=False`` and
+        a document was inserted.
+
+        .. versionadded:: 0.4
+        """
+        if remove and (update or upsert):
+            raise InvalidQueryError('Cannot update and remove a document in '
+                                    'the same modify')
+        if not remove and not update:
+            raise InvalidQueryError('No update given to modify')
+
+        update = QuerySet._transform_update(self._document, **update)
+        try:
+            response = self._find_and_modify(update, upsert=upsert, new=new,
+                                             remove=remove)
+        except pymongo.errors.OperationFailure, err:
+            raise OperationError(u'Update failed (%s)' % unicode(err))
+
+        value = response.get('value')
+        if value is None:
+            return None
+        return self._build_result(value)
+
     def __iter__(self):
-        return self
+        if self._no_cache:
+            return self
+        if self._result_cache is None:
+            self._result_cache = []
+            self._has_more = True
+        return self._iter_results()
+
+    def _iter_results(self):
+        """Yield the results held in the result cache, reading more from the
+        cursor as they are needed. Several iterators may be used at once.
+        """
+        cache = self._result_cache
+        pos = 0
+        while True:
+            if pos < len(cache):
+                yield cache[pos]
+                pos += 1
+            elif self._has_more and self._result_cache is cache:
+                self._fill_cache(ITER_CHUNK_SIZE)
+            else:
+                return
+
+    def _fill_cache(self, num=None):
+        """Read up to ``num`` more results (all of them if ``num`` is not
+        given) from the cursor into the result cache.
+        """
+        if self._result_cache is None:
+            self._result_cache = []
+            self._has_more = True
+        while self._has_more and (num is None or num > 0):
+            try:
+                self._result_cache.append(self.next())
+            except StopIteration:
+                self._has_more = False
+            if num is not None:
+                num -= 1
+
+    def no_cache(self):
+        """Don't keep the results in memory once they have been iterated
+        over, so that large result sets may be streamed. Each iteration,
+        ``len()`` and index then queries the database again.
+
+        .. versionadded:: 0.4
+        """
+        queryset = self.clone()
+        queryset._no_cache = True
+        return queryset
 
     def _sub_js_fields(self, code):
         """When fields are specified with [~fieldname] syntax, where 
@@ -832,53 +2093,199 @@ class QuerySet(object):
             'options': options or {},
         }
 
-        query = self._query
-        if self._where_clause:
-            query['$where'] = self._where_clause
-
-        scope['query'] = query
+        scope['query'] = self._query
         code = pymongo.code.Code(code, scope=scope)
 
-        db = _get_db()
+        db = self._document._get_db()
         return db.eval(code, *fields)
 
+    def _aggregate(self, pipeline, batch_size=None):
+        """Run an aggregation pipeline and return an iterable of the results,
+        or ``None`` if the server doesn't support aggregation.
+        """
+        collection = self._collection
+        server = _collection_key(collection)[:2]
+        if server in _no_aggregation:
+            return None
+
+        try:
+            if batch_size:
+                # Receive the results through a cursor, in batches, which
+                # PyMongo >= 2.7 returns as a CommandCursor
+                result = collection.aggregate(
+                    pipeline, cursor={'batchSize': batch_size})
+            elif hasattr(collection, 'aggregate'):
+                result = collection.aggregate(pipeline)
+            else:
+                # Older versions of PyMongo have no aggregate helper, and
+                # receive all of the results in a single reply
+                command = SON([('aggregate', collection.name),
+                               ('pipeline', pipeline)])
+                result = collection.database.command(command)
+        except pymongo.errors.OperationFailure, err:
+            if u'no such c' in unicode(err):
+                _no_aggregation.add(server)
+                return None
+            raise OperationError(u'Aggregation failed (%s)' % unicode(err))
+
+        if isinstance(result, dict):
+            return result['result']
+        return result
+
+    def _sub_aggregation_fields(self, value):
+        """Substitute the MongoDB names of fields for MongoEngine field names
+        prefixed with a tilde in aggregation stages: in keys (``~title``) and
+        in references to the values of fields (``$~title``).
+        """
+        if isinstance(value, dict):
+            items = []
+            for key, item in value.items():
+                if isinstance(key, basestring) and key.startswith('~'):
+                    key = QuerySet._translate_field_name(self._document,
+                                                         key[1:])
+                items.append((key, self._sub_aggregation_fields(item)))
+            return SON(items)
+        if isinstance(value, (list, tuple)):
+            return [self._sub_aggregation_fields(item) for item in value]
+        if isinstance(value, basestring) and value.startswith('$~'):
+            return '$' + QuerySet._translate_field_name(self._document,
+                                                        value[2:])
+        return value
+
+    def aggregate(self, *stages, **options):
+        """Run an aggregation pipeline over the selected documents, and return
+        an iterator yielding the resulting dictionaries. The pipeline starts
+        with stages that select the documents matched by this
+        :class:`~mongoengine.queryset.QuerySet`, in its order and with its
+        skip and limit applied, followed by the given stages. ::
+
+            tag_counts = BlogPost.objects(published=True).aggregate(
+                {'$unwind': '$~tags'},
+                {'$group': {'_id': '$~tags', 'count': {'$sum': 1}}},
+            )
+
+        Field names may be given prefixed with a tilde, as keys (``~title``)
+        or to refer to the values of fields (``$~title``), in which case they
+        will be substituted for the names of the fields in the database. See
+        :meth:`~mongoengine.queryset.QuerySet.pipeline` for building the
+        stages.
+
+        :param stages: aggregation pipeline stages, as dictionaries
+        :param batch_size: the number of results to receive at a time, which
+            returns the results through a cursor rather than in a single reply
+            limited to 16MB
+
+        .. note:: Aggregation requires server version **>= 2.1**, and
+           ``batch_size`` requires server version **>= 2.6** and PyMongo
+           **>= 2.7**; an :class:`~mongoengine.queryset.OperationError` is
+           raised with older versions of PyMongo.
+
+        .. versionadded:: 0.4
+        """
+        _check_aggregation_options(options)
+        if self._limit == 0:
+            return iter([])
+
+        pipeline = []
+        if self._query:
+            pipeline.append({'$match': self._query})
+        ordering = self._ordering or \
+                   QuerySet._parse_ordering(self._document._meta['ordering'])
+        if ordering:
+            sort = SON()
+            for key, direction in ordering:
+                try:
+                    key = QuerySet._translate_field_name(self._document, key)
+                except (KeyError, InvalidQueryError):
+                    pass
+                sort[key] = direction
+            pipeline.append({'$sort': sort})
+        if self._skip:
+            pipeline.append({'$skip': self._skip})
+        if self._limit:
+            pipeline.append({'$limit': self._limit})
+        pipeline += [self._sub_aggregation_fields(stage) for stage in stages]
+
+        results = self._aggregate(pipeline, options.get('batch_size'))
+        if results is None:
+            raise NotImplementedError('Requires MongoDB >= 2.1')
+        return iter(results)
+
+    def pipeline(self, **options):
+        """Return an :class:`~mongoengine.queryset.AggregationPipeline` for
+        building the stages of an aggregation over the selected documents,
+        which yields the results when iterated over. ::
+
+            pipeline = BlogPost.objects(published=True).pipeline()
+            pipeline.unwind('~tags').group('$~tags', count={'$sum': 1})
+            for result in pipeline.sort('-count').limit(10):
+                print result['_id'], result['count']
+
+        :param batch_size: the number of results to receive at a time, see
+            :meth:`~mongoengine.queryset.QuerySet.aggregate`
+
+        .. versionadded:: 0.4
+        """
+        _check_aggregation_options(options)
+        return AggregationPipeline(self, **options)
+
+    def _field_values(self, field):
+        """Return the values of a field of the selected documents, reading
+        only that field from the database.
+        """
+        field = QuerySet._translate_field_name(self._document, field)
+        parts = field.split('.')
+        for son in self._collection.find(self._query, fields=[field]):
+            yield _lookup_path(son, parts)
+
     def sum(self, field):
         """Sum over the values of the specified field.
 
         :param field: the field to sum over; use dot-notation to refer to
             embedded document fields
         """
-        sum_func = """
-            function(sumField) {
-                var total = 0.0;
-                db[collection].find(query).forEach(function(doc) {
-                    total += (doc[sumField] || 0.0);
-                });
-                return total;
-            }
-        """
-        return self.exec_js(sum_func, field)
+        db_field = QuerySet._translate_field_name(self._document, field)
+        results = self._aggregate([
+            {'$match': self._query},
+            {'$group': {'_id': None, 'total': {'$sum': '$' + db_field}}},
+        ])
+        if results is not None:
+            for result in results:
+                return result['total']
+            return 0
+
+        total = 0
+        for value in self._field_values(field):
+            if isinstance(value, (int, long, float)) and \
+               not isinstance(value, bool):
+                total += value
+        return total
 
     def average(self, field):
-        """Average over the values of the specified field.
+        """Average over the values of the specified field. Documents without
+        a value for the field are ignored.
 
         :param field: the field to average over; use dot-notation to refer to
             embedded document fields
         """
-        average_func = """
-            function(averageField) {
-                var total = 0.0;
-                var num = 0;
-                db[collection].find(query).forEach(function(doc) {
-                    if (doc[averageField]) {
-                        total += doc[averageField];
-                        num += 1;
-                    }
-                });
-                return total / num;
-            }
-        """
-        return self.exec_js(average_func, field)
+        db_field = QuerySet._translate_field_name(self._document, field)
+        results = self._aggregate([
+            {'$match': self._query},
+            {'$group': {'_id': None, 'average': {'$avg': '$' + db_field}}},
+        ])
+        if results is not None:
+            for result in results:
+                return result['average'] or 0
+            return 0
+
+        total = 0.0
+        num = 0
+        for value in self._field_values(field):
+            if isinstance(value, (int, long, float)) and \
+               not isinstance(value, bool):
+                total += value
+                num += 1
+        return num and total / num or 0
 
     def item_frequencies(self, list_field, normalize=False):
         """Returns a dictionary of all items present in a list field across
@@ -888,57 +2295,459 @@ class QuerySet(object):
         :param list_field: the list field to use
         :param normalize: normalize the results so they add to 1.0
         """
-        freq_func = """
-            function(listField) {
-                if (options.normalize) {
-                    var total = 0.0;
-                    db[collection].find(query).forEach(function(doc) {
-                        total += doc[listField].length;
-                    });
-                }
-
-                var frequencies = {};
-                var inc = 1.0;
-                if (options.normalize) {
-                    inc /= total;
-                }
-                db[collection].find(query).forEach(function(doc) {
-                    doc[listField].forEach(function(item) {
-                        frequencies[item] = inc + (frequencies[item] || 0);
-                    });
-                });
-                return frequencies;
-            }
-        """
-        return self.exec_js(freq_func, list_field, normalize=normalize)
+        db_field = QuerySet._translate_field_name(self._document, list_field)
+        results = self._aggregate([
+            {'$match': self._query},
+            {'$unwind': '$' + db_field},
+            {'$group': {'_id': '$' + db_field, 'count': {'$sum': 1}}},
+        ])
+        frequencies = {}
+        if results is not None:
+            for result in results:
+                frequencies[result['_id']] = result['count']
+        else:
+            for value in self._field_values(list_field):
+                if value is None:
+                    continue
+                if not isinstance(value, list):
+                    value = [value]
+                for item in value:
+                    frequencies[item] = frequencies.get(item, 0) + 1
+
+        if normalize:
+            total = float(sum(frequencies.values()))
+            for item in frequencies:
+                frequencies[item] /= total
+        return frequencies
+
+    def _split_points(self, key, n):
+        """Return up to ``n - 1`` increasing values of the database field
+        ``key`` that split the selected documents into ``n`` ranges.
+        ObjectIds, numbers and dates are split into ranges of equal size
+        between the lowest and highest values, other values (and ObjectIds
+        created within fewer than ``n`` seconds) are read at evenly spaced
+        positions in the order of the field.
+        """
+        queryset = self.clone()
+        queryset._loaded_fields = [key]
+        queryset._as_pymongo = True
+        queryset._select_related = None
+        parts = key.split('.')
+
+        def bound(direction):
+            ordered = queryset.clone()
+            ordered._ordering = [(key, direction)]
+            for son in ordered[:1]:
+                return _lookup_path(son, parts)
+            return None
+
+        low, high = bound(pymongo.ASCENDING), bound(pymongo.DESCENDING)
+        if low is None or high is None or low == high:
+            return []
+
+        def sample():
+            ordered = queryset.clone()
+            ordered._ordering = [(key, pymongo.ASCENDING)]
+            count = ordered.count()
+            return [_lookup_path(ordered[count * i // n], parts)
+                    for i in range(1, n)]
+
+        ObjectId = pymongo.objectid.ObjectId
+        number = (int, long, float)
+        if isinstance(low, ObjectId) and isinstance(high, ObjectId):
+            # Split the range of creation times, to the second, unless the
+            # documents were created within fewer seconds than ranges
+            start = calendar.timegm(low.generation_time.utctimetuple())
+            span = calendar.timegm(high.generation_time.utctimetuple()) - start
+            if span < n:
+                points = sample()
+            else:
+                points = [ObjectId.from_datetime(
+                              datetime.datetime.utcfromtimestamp(
+                                  start + span * i // n))
+                          for i in range(1, n)]
+        elif (isinstance(low, number) and isinstance(high, number) and
+              not isinstance(low, bool) and not isinstance(high, bool)):
+            if isinstance(low, float) or isinstance(high, float):
+                points = [low + (high - low) * i / float(n)
+                          for i in range(1, n)]
+            else:
+                points = [low + (high - low) * i // n for i in range(1, n)]
+        elif (isinstance(low, datetime.datetime) and
+              isinstance(high, datetime.datetime)):
+            points = [low + (high - low) * i // n for i in range(1, n)]
+        else:
+            points = sample()
+
+        # Drop points that would leave a range empty
+        split_points = []
+        previous = low
+        for point in points:
+            if point is not None and point > previous:
+                split_points.append(point)
+                previous = point
+        return split_points
+
+    def partition(self, n, field='id'):
+        """Split the :class:`~mongoengine.queryset.QuerySet` into at most
+        ``n`` querysets that select disjoint ranges of values of ``field``,
+        and together select the same documents. The split points are computed
+        from the lowest and highest values of the field, using the creation
+        times of ObjectIds, so the partitions may not all be the same size.
+        ``field`` should be indexed and present in every document. ::
+
+            for queryset in BlogPost.objects.partition(4):
+                ...
+
+        :param n: the number of partitions
+        :param field: the field used to split the documents
+
+        .. versionadded:: 0.4
+        """
+        if n < 1:
+            raise ValueError('A QuerySet must be split into at least one '
+                             'partition')
+        if self._skip or self._limit is not None:
+            raise InvalidQueryError('A QuerySet that has been skipped or '
+                                    'limited can\'t be partitioned')
+
+        key = QuerySet._translate_field_name(self._document, field)
+        points = []
+        if n > 1:
+            points = self._split_points(key, n)
+
+        querysets = []
+        for lower, upper in zip([None] + points, points + [None]):
+            queryset = self.clone()
+            condition = {}
+            if lower is not None:
+                condition['$gte'] = lower
+            if upper is not None:
+                condition['$lt'] = upper
+            if condition:
+                queryset._query = _merge_queries([queryset._query,
+                                                  {key: condition}])
+            querysets.append(queryset)
+        return querysets
+
+    def parallel_map(self, fn, workers=4, executor='thread', partitions=None,
+                     field='id', collect=True):
+        """Apply ``fn`` to every selected document, using ``workers`` threads
+        or processes that each read a partition of the documents (see
+        :meth:`partition`) through their own connection. Returns the results
+        in the order of the partitions. ::
+
+            def word_count(post):
+                return len(post.content.split())
+
+            counts = BlogPost.objects.parallel_map(word_count, workers=8,
+                                                   executor='process')
+
+        If ``fn`` raises an exception, the remaining documents of its
+        partition are skipped, and once all partitions have been processed
+        a :class:`~mongoengine.queryset.ParallelMapError` is raised.
+
+        With the ``'process'`` executor, ``fn`` and the document class must
+        be picklable (defined at the top level of a module), and
+        :meth:`values_list` can't be used.
+
+        :param fn: the function to call with each document
+        :param workers: the number of threads or processes
+        :param executor: ``'thread'`` or ``'process'``
+        :param partitions: the number of partitions, by default one per
+            worker
+        :param field: the field used to partition the documents
+        :param collect: return the results, rather than only the number of
+            documents processed, which saves memory when ``fn`` stores its
+            own results
+
+        .. versionadded:: 0.4
+        """
+        if executor not in ('thread', 'process'):
+            raise ValueError("executor must be 'thread' or 'process'")
+        if executor == 'process' and self._scalar is not None:
+            raise InvalidQueryError('values_list can\'t be used with the '
+                                    'process executor')
+
+        querysets = self.partition(partitions or workers, field)
+        workers = min(workers, len(querysets))
+        if executor == 'process':
+            import multiprocessing
+            tasks = []
+            for queryset in querysets:
+                state = dict((name, getattr(queryset, name))
+                             for name in ('_query', '_loaded_fields',
+                                          '_ordering', '_select_related',
+                                          '_select_related_depth',
+                                          '_lazy_hydration', '_as_pymongo',
+                                          '_batch_size', '_hint',
+                                          '_max_time_ms',
+                                          '_no_cursor_timeout', '_snapshot',
+                                          '_comment'))
+                tasks.append((fn, self._document, state, collect))
+            pool = multiprocessing.Pool(workers)
+            try:
+                outcomes = pool.map(_map_partition, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            tasks = Queue.Queue()
+            for task in enumerate(querysets):
+                tasks.put(task)
+            outcomes = [None] * len(querysets)
+
+            def work():
+                while True:
+                    try:
+                        index, queryset = tasks.get_nowait()
+                    except Queue.Empty:
+                        return
+                    outcomes[index] = _map_queryset(fn, queryset, collect)
+
+            threads = [threading.Thread(target=work) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        results = []
+        count = 0
+        errors = []
+        for index, (partition_results, partition_count, error) in \
+                enumerate(outcomes):
+            results.extend(partition_results)
+            count += partition_count
+            if error is not None:
+                errors.append((index, error))
+
+        if not collect:
+            results = count
+        if errors:
+            message = u'%d of %d partitions failed' % (len(errors),
+                                                        len(querysets))
+            raise ParallelMapError(message, errors, results)
+        return results
+
+    def tail(self, await_data=True, poll_interval=1, callback=None,
+             stop=None):
+        """Follow the selected documents of a capped collection as they are
+        inserted, using a tailable cursor. Returns a generator that yields
+        the documents already in the collection and then waits for new ones::
+
+            for job in Job.objects(queue='mail').tail():
+                job.run()
+
+        If the cursor dies, for example because the collection was empty or
+        the connection was lost, the query is run again for the documents
+        inserted after the last one that was seen.
+
+        If ``callback`` is given, the documents are passed to it by a daemon
+        thread instead, which is started and returned.
+
+        :param await_data: let the server wait a while for new documents
+            before returning an empty batch, rather than only polling
+        :param poll_interval: the number of seconds to wait before reading
+            again when there are no new documents
+        :param callback: a function to call with each document in a new thread
+        :param stop: a :class:`threading.Event` that ends the generator (or
+            thread) when it is set
+
+        .. note:: Tailable cursors return the documents in the order they
+           were inserted, so :meth:`order_by`, :meth:`skip` and :meth:`limit`
+           can't be used. With :meth:`select_related`, the references of
+           each document are loaded as it is read, rather than for a batch.
+
+        .. versionadded:: 0.4
+        """
+        if self._ordering or self._skip or self._limit is not None:
+            raise InvalidQueryError('Tailable cursors can\'t be used with '
+                                    'order_by, skip or limit')
+        if self._snapshot:
+            raise InvalidQueryError('Tailable cursors can\'t be used with '
+                                    'snapshot')
+
+        if callback is not None:
+            documents = self.tail(await_data, poll_interval, stop=stop)
+            def consume():
+                for document in documents:
+                    callback(document)
+            thread = threading.Thread(target=consume)
+            thread.setDaemon(True)
+            thread.start()
+            return thread
+        return self._tail(await_data, poll_interval, stop)
+
+    def _tail(self, await_data, poll_interval, stop):
+        """Generate the documents read by :meth:`tail`.
+        """
+        cursor_args = {}
+        if self._loaded_fields:
+            cursor_args['fields'] = self._loaded_fields
+        cursor_args['tailable'] = True
+        # Older drivers don't support awaitData, so only poll
+        await_data = await_data and PYMONGO_VERSION >= (2, 0)
+        if await_data:
+            cursor_args['await_data'] = True
+
+        last_id = None
+        while stop is None or not stop.isSet():
+            query = self._query
+            if last_id is not None:
+                query = _merge_queries([query, {'_id': {'$gt': last_id}}])
+            try:
+                cursor = self._collection.find(query, **cursor_args)
+                if self._batch_size:
+                    cursor.batch_size(self._batch_size)
+                while cursor.alive:
+                    try:
+                        son = cursor.next()
+                    except StopIteration:
+                        if stop is not None and stop.isSet():
+                            return
+                        if not await_data:
+                            time.sleep(poll_interval)
+                        continue
+                    last_id = son['_id']
+                    result = self._build_result(son)
+                    # Documents are yielded as they arrive, so their
+                    # references are loaded one document at a time
+                    if (self._select_related is not None and
+                        not self._as_pymongo and self._scalar is None):
+                        _dereference_documents([result], self._select_related,
+                                               self._select_related_depth)
+                    yield result
+            except pymongo.errors.AutoReconnect:
+                pass
+            if stop is None or not stop.isSet():
+                time.sleep(poll_interval)
 
     def __repr__(self):
-        limit = REPR_OUTPUT_SIZE + 1
-        if self._limit is not None and self._limit < limit:
-            limit = self._limit
-        data = list(self[self._skip:limit])
+        if self._no_cache:
+            data = list(self[:REPR_OUTPUT_SIZE + 1])
+        else:
+            self._fill_cache(REPR_OUTPUT_SIZE + 1 -
+                             len(self._result_cache or []))
+            data = self._result_cache[:REPR_OUTPUT_SIZE + 1]
         if len(data) > REPR_OUTPUT_SIZE:
             data[-1] = "...(remaining elements truncated)..."
         return repr(data)
 
 
+class AggregationPipeline(object):
+    """Builds the stages of an aggregation pipeline run over the documents
+    selected by a :class:`~mongoengine.queryset.QuerySet`, using
+    :meth:`~mongoengine.queryset.QuerySet.aggregate`. Each method adds a stage
+    and returns the pipeline, so that calls may be chained; iterating over
+    the pipeline runs it. As in
+    :meth:`~mongoengine.queryset.QuerySet.aggregate`, field names prefixed
+    with a tilde are substituted for their names in the database.
+
+    .. versionadded:: 0.4
+    """
+
+    def __init__(self, queryset, **options):
+        self._queryset = queryset
+        self._options = options
+        self.stages = []
+
+    def _add(self, operator, value):
+        self.stages.append({operator: value})
+        return self
+
+    def match(self, q_obj=None, **query):
+        """Filter the documents using a :class:`~mongoengine.queryset.Q`
+        object or Django-style query keyword arguments.
+        """
+        document = self._queryset._document
+        query = QuerySet._transform_query(_doc_cls=document, **query)
+        if q_obj:
+            query = _merge_queries([query, q_obj.to_query(document)])
+        return self._add('$match', query)
+
+    def group(self, _id, **fields):
+        """Group the documents by the ``_id`` expression, computing the
+        other fields using accumulators such as ``{'$sum': 1}``.
+        """
+        group = SON([('_id', _id)])
+        group.update(fields)
+        return self._add('$group', group)
+
+    def project(self, *fields, **expressions):
+        """Reshape the documents, keeping the given fields and adding fields
+        computed from the given expressions.
+        """
+        projection = SON((field, 1) for field in fields)
+        projection.update(expressions)
+        return self._add('$project', projection)
+
+    def sort(self, *keys):
+        """Sort the documents by the keys, which may be prefixed with **+**
+        or **-** as in :meth:`~mongoengine.queryset.QuerySet.order_by`.
+        """
+        return self._add('$sort', SON(QuerySet._parse_ordering(keys)))
+
+    def unwind(self, field):
+        """Output a document for each item of a list field.
+        """
+        if not field.startswith('$'):
+            field = '$' + field
+        return self._add('$unwind', field)
+
+    def skip(self, n):
+        """Skip the first ``n`` documents.
+        """
+        return self._add('$skip', n)
+
+    def limit(self, n):
+        """Pass on at most ``n`` documents.
+        """
+        return self._add('$limit', n)
+
+    def lookup(self, document, local_field, foreign_field, as_field):
+        """Join the documents of another collection, whose ``foreign_field``
+        matches ``local_field``, into the list field ``as_field``.
+
+        :param document: the :class:`~mongoengine.Document` class, or the
+            name of the collection, to join
+        """
+        if local_field.startswith('~'):
+            local_field = QuerySet._translate_field_name(
+                self._queryset._document, local_field[1:])
+        if isinstance(document, basestring):
+            collection = document
+        else:
+            collection = document._meta['collection']
+            if foreign_field.startswith('~'):
+                foreign_field = QuerySet._translate_field_name(
+                    document, foreign_field[1:])
+        return self._add('$lookup', SON([('from', collection),
+                                         ('localField', local_field),
+                                         ('foreignField', foreign_field),
+                                         ('as', as_field)]))
+
+    def __iter__(self):
+        return self._queryset.aggregate(*self.stages, **self._options)
+
+
 class QuerySetManager(object):
 
     def __init__(self, manager_func=None):
         self._manager_func = manager_func
-        self._collection = None
+        # PyMongo collections, by connection alias
+        self._collections = {}
 
-    def __get__(self, instance, owner):
-        """Descriptor for instantiating a new QuerySet object when
-        Document.objects is accessed.
+    def _get_collection(self, owner):
+        """Return the PyMongo collection for the document class, using the
+        connection given by :attr:`db_alias` in its :attr:`meta`, creating it
+        as a capped collection first if :attr:`meta` asks for one.
         """
-        if instance is not None:
-            # Document class being used rather than a document object
-            return self
-
-        if self._collection is None:
-            db = _get_db()
-            collection = owner._meta['collection']
+        alias = _get_alias(owner)
+        db = _get_db(alias)
+        collection = self._collections.get(alias)
+        # The collection is obtained again if the database has changed
+        if collection is None or collection.database is not db:
+            name = owner._meta['collection']
 
             # Create collection as a capped collection if specified
             if owner._meta['max_size'] or owner._meta['max_documents']:
@@ -946,27 +2755,40 @@ class QuerySetManager(object):
                 max_size = owner._meta['max_size'] or 10000000 # 10MB default
                 max_documents = owner._meta['max_documents']
 
-                if collection in db.collection_names():
-                    self._collection = db[collection]
+                if name in db.collection_names():
+                    collection = db[name]
                     # The collection already exists, check if its capped
                     # options match the specified capped options
-                    options = self._collection.options()
+                    options = collection.options()
                     if options.get('max') != max_documents or \
                        options.get('size') != max_size:
                         msg = ('Cannot create collection "%s" as a capped '
-                               'collection as it already exists') % collection
+                               'collection as it already exists') % name
                         raise InvalidCollectionError(msg)
                 else:
                     # Create the collection as a capped collection
                     opts = {'capped': True, 'size': max_size}
                     if max_documents:
                         opts['max'] = max_documents
-                    self._collection = db.create_collection(collection, **opts)
+                    collection = db.create_collection(name, **opts)
             else:
-                self._collection = db[collection]
+                collection = db[name]
+            if owner._meta.get('django_models') is False:
+                _skip_django_transform(alias, name)
+            self._collections[alias] = collection
+
+        return collection
+
+    def __get__(self, instance, owner):
+        """Descriptor for instantiating a new QuerySet object when
+        Document.objects is accessed.
+        """
+        if instance is not None:
+            # Document class being used rather than a document object
+            return self
 
         # owner is the document that contains the QuerySetManager
-        queryset = QuerySet(owner, self._collection)
+        queryset = QuerySet(owner, self._get_collection(owner))
         if self._manager_func:
             if self._manager_func.func_code.co_argcount == 1:
                 queryset = self._manager_func(queryset)
@@ -981,7 +2803,7 @@ def queryset_manager(func):
     accepts a :class:`~mongoengine.Document` class as its first argument, and a
     :class:`~mongoengine.queryset.QuerySet` as its second argument. The method
     function should return a :class:`~mongoengine.queryset.QuerySet`, probably
-    the same one that was passed in, but modified in some way.
+    one obtained by refining the one that was passed in.
     """
     if func.func_code.co_argcount == 1:
         import warnings
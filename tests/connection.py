@@ -0,0 +1,241 @@
+from __future__ import with_statement
+
+import unittest
+import threading
+import warnings
+import os
+
+from mongoengine import *
+import mongoengine.connection
+from mongoengine.connection import _get_db, PYMONGO_VERSION
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        connect(db='mongoenginetest', max_pool_size=1, wait_queue_timeout=0.1)
+
+    def tearDown(self):
+        mongoengine.connection._connection_settings['default']['pool'] = {}
+
+    def test_requests(self):
+        """Ensure that requests check sockets out of the pool, and that
+        threads wait for a socket when the pool is exhausted.
+        """
+        stats = request_stats()
+        self.assertEqual(stats['max_requests'], 1)
+        self.assertEqual(stats['in_request'], 0)
+        requests = stats['requests']
+
+        start_request()
+        # Requests may be nested
+        start_request()
+        _get_db().collection_names()
+        end_request()
+        stats = request_stats()
+        self.assertEqual(stats['in_request'], 1)
+        self.assertEqual(stats['requests'], requests + 1)
+
+        # Other threads can't start a request until this one ends
+        errors = []
+        def request():
+            try:
+                start_request()
+                end_request()
+            except ConnectionError, e:
+                errors.append(e)
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+        end_request()
+        self.assertEqual(request_stats()['in_request'], 0)
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(request_stats()['waiting'], 0)
+
+    def test_failed_request(self):
+        """Ensure that a request which fails to start doesn't keep its place
+        in the pool.
+        """
+        class BrokenConnection(object):
+            def start_request(self):
+                raise ConnectionError('Cannot start a request')
+
+        def cannot_connect(alias):
+            raise ConnectionError('Cannot connect to the database')
+
+        get_connection = mongoengine.connection._get_connection
+        broken = [cannot_connect]
+        if PYMONGO_VERSION >= (2, 0):
+            broken.append(lambda alias: BrokenConnection())
+        try:
+            for replacement in broken:
+                mongoengine.connection._get_connection = replacement
+                self.assertRaises(ConnectionError, start_request)
+                self.assertEqual(request_stats()['in_request'], 0)
+        finally:
+            mongoengine.connection._get_connection = get_connection
+
+        # The pool's only place is free for the next request
+        start_request()
+        end_request()
+        self.assertEqual(request_stats()['in_request'], 0)
+
+    def test_unsupported_pool_settings(self):
+        """Ensure that a warning is issued for pool settings the installed
+        PyMongo can't accept.
+        """
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            connect('mongoenginetest', alias='timeouts', connect_timeout=1,
+                    wait_queue_timeout=1)
+        messages = sorted(str(warning.message) for warning in caught)
+        unsupported = []
+        if PYMONGO_VERSION < (2, 0):
+            unsupported.append('connect_timeout')
+        if PYMONGO_VERSION < (2, 6):
+            unsupported.append('wait_queue_timeout')
+        self.assertEqual([message.split()[0] for message in messages],
+                         unsupported)
+
+        # Settings that weren't passed on don't stop PyMongo from connecting
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            options = mongoengine.connection._connection_options('timeouts')
+        self.assertEqual('connectTimeoutMS' in options,
+                         PYMONGO_VERSION >= (2, 0))
+        self.assertEqual('waitQueueTimeoutMS' in options,
+                         PYMONGO_VERSION >= (2, 6))
+        _get_db('timeouts')
+
+    def test_aliases(self):
+        """Ensure that documents are stored using the connection given by
+        their db_alias.
+        """
+        connect('mongoenginetest2', alias='testdb')
+        db = _get_db()
+        other_db = _get_db('testdb')
+        self.assertEqual(other_db.name, 'mongoenginetest2')
+        self.assertRaises(ConnectionError, _get_db, 'nonexistent')
+
+        class Person(Document):
+            name = StringField()
+            meta = {'db_alias': 'testdb'}
+
+        class Employee(Person):
+            pass
+
+        class Page(Document):
+            title = StringField()
+
+        self.assertEqual(Employee._meta['db_alias'], 'testdb')
+
+        Person.drop_collection()
+        Page.drop_collection()
+
+        Person(name='Ross').save()
+        Employee(name='Harry').save()
+        self.assertEqual(other_db.person.count(), 2)
+        self.assertEqual(db.person.count(), 0)
+
+        # Querysets created beforehand use the current connection
+        pages = Page.objects
+        with switch_db(Page, 'testdb') as Page:
+            Page(title='Archived').save()
+            self.assertEqual(Page.objects.count(), 1)
+            self.assertEqual(pages.count(), 1)
+        self.assertEqual(Page.objects.count(), 0)
+        self.assertEqual(pages.count(), 0)
+        self.assertEqual(other_db.page.count(), 1)
+
+        # Subclasses are switched too, and other threads aren't affected
+        counts = []
+        def count_people():
+            counts.append(Employee.objects.count())
+        with switch_db(Person, 'default') as Person:
+            Employee(name='Temp').save()
+            self.assertEqual(Employee.objects.count(), 1)
+            thread = threading.Thread(target=count_people)
+            thread.start()
+            thread.join()
+        self.assertEqual(counts, [1])
+        self.assertEqual(Employee._meta['db_alias'], 'testdb')
+        self.assertEqual(Employee.objects.count(), 1)
+        self.assertEqual(db.person.count(), 1)
+        self.assertEqual(other_db.person.count(), 2)
+        db.drop_collection('person')
+
+        Person.drop_collection()
+        self.assertEqual(other_db.person.count(), 0)
+        other_db.drop_collection('page')
+
+    def test_dereference_aliases(self):
+        """Ensure that references to collections with the same name in
+        different databases are loaded from the right database.
+        """
+        connect('mongoenginetest2', alias='testdb')
+
+        class Author(Document):
+            name = StringField()
+            meta = {'collection': 'author'}
+
+        class ArchivedAuthor(Document):
+            name = StringField()
+            meta = {'collection': 'author', 'db_alias': 'testdb'}
+
+        class Book(Document):
+            author = ReferenceField(Author)
+            archived_author = ReferenceField(ArchivedAuthor)
+
+        Author.drop_collection()
+        ArchivedAuthor.drop_collection()
+        Book.drop_collection()
+
+        author = Author(name='Ross')
+        author.save()
+        archived = ArchivedAuthor(id=author.id, name='Harry')
+        archived.save()
+        Book(author=author, archived_author=archived).save()
+
+        book = Book.objects.select_related().first()
+        self.assertEqual(book._data['author'].name, 'Ross')
+        self.assertEqual(book._data['archived_author'].name, 'Harry')
+
+        Author.drop_collection()
+        ArchivedAuthor.drop_collection()
+        Book.drop_collection()
+
+    def test_fork(self):
+        """Ensure that connections inherited from a parent process are not
+        used by the child process.
+        """
+        class Person(Document):
+            name = StringField()
+
+        Person.drop_collection()
+        Person(name='Ross').save()
+        db = _get_db()
+        people = Person.objects
+        collection = people._collection
+
+        # Pretend the connection was made by another process
+        mongoengine.connection._pid = -1
+        self.assertFalse(_get_db() is db)
+        self.assertEqual(mongoengine.connection._pid, os.getpid())
+        self.assertFalse(Person.objects._collection is collection)
+        self.assertEqual(Person.objects.first().name, 'Ross')
+
+        # Querysets created in the parent don't use its connection either
+        self.assertFalse(people._collection is collection)
+        self.assertEqual(people.first().name, 'Ross')
+
+        Person.drop_collection()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -40,6 +40,123 @@ class ShorcutsTest(unittest.TestCase):
         self.assertEqual(len(t2), 1)
         self.Person.drop_collection()
 
+    def test_son_manipulator(self):
+        """Ensure that the Django SON manipulator is installed once, and
+        skipped for documents that don't contain Django models.
+        """
+        from mongoengine.connection import _son_manipulators, TransformDjango
+        for i in range(10):
+            self.assertTrue(_get_db() is self.db)
+        manipulators = _son_manipulators['default']
+        self.assertEqual(len(manipulators), 1)
+        self.assertTrue(isinstance(manipulators[0], TransformDjango))
+
+        class LogEntry(Document):
+            message = StringField()
+            meta = {'django_models': False}
+
+        LogEntry.drop_collection()
+        LogEntry(message='Test').save()
+        self.assertTrue('logentry' in manipulators[0].skip_collections)
+        self.assertFalse('person' in manipulators[0].skip_collections)
+        self.assertEqual(LogEntry.objects.first().message, 'Test')
+        LogEntry.drop_collection()
+
+    def test_django_models(self):
+        """Ensure that the Django models stored in a document are loaded with
+        one query per model class, in order, and that their ContentTypes are
+        cached.
+        """
+        import mongoengine.connection
+        from django.db import models
+        from mongoengine.base import BaseField
+
+        class Book(models.Model):
+            title = models.CharField(max_length=100)
+            class Meta:
+                app_label = 'mongoenginetest'
+
+        class Film(models.Model):
+            title = models.CharField(max_length=100)
+            class Meta:
+                app_label = 'mongoenginetest'
+
+        # Serve the models' rows and ContentTypes without a SQL database,
+        # recording the queries made
+        rows = {
+            Book: dict((pk, Book(pk=pk, title='Book %d' % pk))
+                       for pk in (1, 2, 3)),
+            Film: {1: Film(pk=1, title='Film 1')},
+        }
+        queries = []
+        def in_bulk(model):
+            def query(pks):
+                queries.append((model, sorted(pks)))
+                return dict((pk, rows[model][pk]) for pk in pks
+                            if pk in rows[model])
+            return query
+
+        class FakeContentType(object):
+            def __init__(self, pk, model):
+                self.pk, self.model = pk, model
+            def model_class(self):
+                return self.model
+
+        content_types = {'book': FakeContentType(1, Book),
+                         'film': FakeContentType(2, Film)}
+        lookups = []
+        class FakeContentTypeManager(object):
+            def get(self, app_label, model):
+                lookups.append((app_label, model))
+                return content_types[model]
+
+        class ContentType(object):
+            objects = FakeContentTypeManager()
+
+        original_content_type = mongoengine.connection.ContentType
+        mongoengine.connection.ContentType = ContentType
+        mongoengine.connection._content_types.clear()
+        for model in rows:
+            model._default_manager.in_bulk = in_bulk(model)
+        try:
+            class Shelf(Document):
+                items = ListField(BaseField())
+
+            Shelf.drop_collection()
+            Shelf(items=[rows[Book][3], rows[Film][1], rows[Book][1]]).save()
+
+            # Models held directly in a list are stored as stubs
+            transform = mongoengine.connection.TransformDjango()
+            son = transform.transform_incoming({'items': [rows[Book][3]]},
+                                               None)
+            self.assertEqual(son['items'][0]['_type'], 'django')
+            self.assertEqual(son['items'][0]['pk'], 3)
+
+            shelf = Shelf.objects.first()
+            self.assertEqual([item.title for item in shelf.items],
+                             ['Book 3', 'Film 1', 'Book 1'])
+            self.assertEqual(sorted(queries),
+                             [(Book, [1, 3]), (Film, [1])])
+            self.assertEqual(sorted(lookups),
+                             [('mongoenginetest', 'book'),
+                              ('mongoenginetest', 'film')])
+
+            # The ContentTypes are cached for later loads
+            Shelf.objects.first()
+            self.assertEqual(len(lookups), 2)
+            self.assertEqual(len(queries), 4)
+
+            # Models whose rows were deleted can't be loaded
+            del rows[Book][3]
+            self.assertRaises(Book.DoesNotExist, Shelf.objects.first)
+
+            Shelf.drop_collection()
+        finally:
+            mongoengine.connection.ContentType = original_content_type
+            mongoengine.connection._content_types.clear()
+            for model in rows:
+                del model._default_manager.in_bulk
+
 if __name__ == '__main__':
     print settings.DATABASES['default']
     unittest.main()
@@ -3,12 +3,25 @@ if not 'DJANGO_SETTINGS_MODULE' in environ:
     environ['DJANGO_SETTINGS_MODULE'] = 'settings'
     
 import unittest
+import pickle
+import cPickle
 from datetime import datetime
 import pymongo
 
 from mongoengine import *
-from mongoengine.base import BaseField
+from mongoengine.base import BaseField, signals
 from mongoengine.connection import _get_db
+from mongoengine.queryset import _ensure_index
+
+
+class PickleTest(Document):
+    """Pickled documents' classes must be importable, so this one is
+    defined at the top level of the module.
+    """
+    number = IntField()
+    tags = ListField(StringField())
+    info = DictField()
+    flags = SetField(StringField())
 
 
 class DocumentTest(unittest.TestCase):
@@ -290,6 +303,66 @@ class DocumentTest(unittest.TestCase):
 
         BlogPost.drop_collection()
 
+    def test_ensure_indexes(self):
+        """Ensure that indexes are ensured once per process and that deferred
+        indexes are only created when explicitly requested.
+        """
+        class BlogPost(Document):
+            title = StringField()
+            meta = {
+                'indexes': ['title'],
+                'index_mode': 'deferred',
+            }
+
+        BlogPost.drop_collection()
+
+        # Deferred indexes aren't created when the collection is first used
+        list(BlogPost.objects)
+        info = BlogPost.objects._collection.index_information()
+        self.assertFalse([('_types', 1), ('title', 1)] in info.values())
+
+        BlogPost.ensure_indexes()
+        info = BlogPost.objects._collection.index_information()
+        self.assertTrue([('_types', 1), ('title', 1)] in info.values())
+
+        # The index has already been ensured by this process
+        collection = BlogPost.objects._collection
+        index = BlogPost._meta['indexes'][0]
+        self.assertFalse(_ensure_index(collection, index))
+
+        # Dropping the collection means the index must be ensured again
+        BlogPost.drop_collection()
+        self.assertTrue(_ensure_index(collection, index))
+
+        BlogPost.drop_collection()
+
+    def test_ensure_all_indexes(self):
+        """Ensure that ensure_all_indexes ensures the indexes of every
+        document class, including classes that share a name.
+        """
+        def define(collection):
+            class BlogPost(Document):
+                title = StringField()
+                meta = {
+                    'collection': collection,
+                    'indexes': ['title'],
+                    'index_mode': 'deferred',
+                }
+            return BlogPost
+
+        first = define('blogpost_first')
+        second = define('blogpost_second')
+        first.drop_collection()
+        second.drop_collection()
+
+        ensure_all_indexes()
+        for doc_cls in (first, second):
+            info = doc_cls.objects._collection.index_information()
+            self.assertTrue([('_types', 1), ('title', 1)] in info.values())
+
+        first.drop_collection()
+        second.drop_collection()
+
     def test_unique(self):
         """Ensure that uniqueness constraints are applied to fields.
         """
@@ -449,6 +522,166 @@ class DocumentTest(unittest.TestCase):
         self.assertEqual(person_obj['age'], 30)
         self.assertEqual(person_obj['_id'], person.id)
 
+    def test_from_son(self):
+        """Ensure that documents built from SON by the class codec match
+        those built through the constructor.
+        """
+        class Comment(EmbeddedDocument):
+            content = StringField(db_field='c')
+
+        class BlogPost(Document):
+            title = StringField()
+            hits = IntField(default=0)
+            tags = ListField(StringField())
+            comments = ListField(EmbeddedDocumentField(Comment))
+            author = ReferenceField(self.Person)
+
+        son = {
+            '_id': pymongo.objectid.ObjectId(),
+            '_cls': 'BlogPost',
+            '_types': ['BlogPost'],
+            'title': u'Test',
+            'tags': [u'fun'],
+            'comments': [{'_cls': 'Comment', '_types': ['Comment'],
+                          'c': u'Good'}],
+            'author': pymongo.dbref.DBRef('person',
+                                          pymongo.objectid.ObjectId()),
+        }
+        post = BlogPost._from_son(son)
+        self.assertEqual(post._data.keys(),
+                         BlogPost._from_son_with_init(son)._data.keys())
+        self.assertEqual(post.id, son['_id'])
+        self.assertEqual(post.title, 'Test')
+        self.assertEqual(post.hits, 0)
+        self.assertEqual(post.comments[0].content, 'Good')
+        self.assertFalse(post._created)
+        self.assertEqual(post._delta(), ({}, {}))
+
+        # References that haven't been dereferenced are written back as-is
+        son['hits'] = 0
+        self.assertEqual(post.to_mongo(), son)
+
+    def test_from_son_signals(self):
+        """Ensure that documents built from SON by the class codec send the
+        Django init signals.
+        """
+        if signals is None:
+            return
+
+        class BlogPost(Document):
+            title = StringField()
+
+        received = []
+        def pre_init(sender, args, kwargs, **extra):
+            kwargs['title'] = kwargs['title'].upper()
+            received.append('pre_init')
+        def post_init(sender, instance, **extra):
+            received.append(instance.title)
+        signals.pre_init.connect(pre_init, sender=BlogPost)
+        signals.post_init.connect(post_init, sender=BlogPost)
+        try:
+            post = BlogPost._from_son({'_id': pymongo.objectid.ObjectId(),
+                                       '_cls': 'BlogPost',
+                                       '_types': ['BlogPost'],
+                                       'title': u'Test'})
+        finally:
+            signals.pre_init.disconnect(pre_init, sender=BlogPost)
+            signals.post_init.disconnect(post_init, sender=BlogPost)
+        self.assertEqual(received, ['pre_init', 'TEST'])
+        self.assertEqual(post.title, 'TEST')
+
+    def test_save_delta(self):
+        """Ensure that saving a loaded document only writes the fields that
+        have changed.
+        """
+        class Comment(EmbeddedDocument):
+            content = StringField(db_field='c')
+
+        class BlogPost(Document):
+            title = StringField()
+            hits = IntField()
+            tags = ListField(StringField())
+            comments = ListField(EmbeddedDocumentField(Comment))
+
+        BlogPost.drop_collection()
+
+        post = BlogPost(title='Test', hits=1, tags=['fun'],
+                        comments=[Comment(content='Good')])
+        post.save()
+        self.assertEqual(post._delta(), ({}, {}))
+
+        post_obj = BlogPost.objects.first()
+        self.assertEqual(post_obj._delta(), ({}, {}))
+
+        post_obj.title = 'Updated'
+        post_obj.tags.append('leisure')
+        post_obj.comments[0].content = 'Great'
+        post_obj.hits = None
+        self.assertEqual(post_obj._delta(), (
+            {'title': 'Updated', 'tags': ['fun', 'leisure'],
+             'comments.0.c': 'Great'},
+            {'hits': 1}))
+
+        # Change a field behind the document's back, it mustn't be overwritten
+        collection = self.db[BlogPost._meta['collection']]
+        collection.update({'_id': post.id}, {'$set': {'extra': 'kept'}})
+
+        post_obj.save()
+        self.assertEqual(post_obj._delta(), ({}, {}))
+
+        son = collection.find_one({'_id': post.id})
+        self.assertEqual(son['title'], 'Updated')
+        self.assertEqual(son['tags'], ['fun', 'leisure'])
+        self.assertEqual(son['comments'][0]['c'], 'Great')
+        self.assertFalse('hits' in son)
+        self.assertEqual(son['extra'], 'kept')
+
+        # Documents removed from the database are saved in full again
+        collection.remove({'_id': post.id})
+        post_obj.hits = 2
+        post_obj.save()
+        son = collection.find_one({'_id': post.id})
+        self.assertEqual(son['title'], 'Updated')
+        self.assertEqual(son['hits'], 2)
+        self.assertEqual(son['tags'], ['fun', 'leisure'])
+
+        collection.remove({'_id': post.id})
+        post_obj.save()
+        self.assertEqual(BlogPost.objects.get(id=post.id).hits, 2)
+
+        BlogPost.drop_collection()
+
+    def test_pickle(self):
+        """Ensure that loaded documents may be pickled once their
+        containers have been read, and still track changes afterwards.
+        """
+        PickleTest.drop_collection()
+        PickleTest(number=1, tags=['fun'], info={'a': 1},
+                   flags=set(['new'])).save()
+
+        for lazy in (False, True):
+            queryset = PickleTest.objects
+            if lazy:
+                queryset = queryset.lazy_hydration()
+            doc = queryset.first()
+            doc.tags, doc.info, doc.flags
+            for module in (pickle, cPickle):
+                for protocol in (0, 1, 2):
+                    doc_obj = module.loads(module.dumps(doc, protocol))
+                    self.assertEqual(doc_obj.number, 1)
+                    self.assertEqual(doc_obj.tags, ['fun'])
+                    self.assertEqual(doc_obj.info, {'a': 1})
+                    self.assertEqual(doc_obj.flags, set(['new']))
+                    self.assertEqual(doc_obj._delta(), ({}, {}))
+
+                    doc_obj.tags.append('leisure')
+                    doc_obj.info['b'] = 2
+                    self.assertEqual(doc_obj._delta(), (
+                        {'tags': ['fun', 'leisure'],
+                         'info': {'a': 1, 'b': 2}}, {}))
+
+        PickleTest.drop_collection()
+
     def test_delete(self):
         """Ensure that document may be deleted using the delete method.
         """
@@ -7,6 +7,7 @@ import pymongo
 
 from mongoengine import *
 from mongoengine.connection import _get_db
+import mongoengine.fields
 
 
 class FieldTest(unittest.TestCase):
@@ -526,6 +527,64 @@ class FieldTest(unittest.TestCase):
         User.drop_collection()
         Group.drop_collection()
     
+    def test_list_item_dereference_in_bulk(self):
+        """Ensure that ListField references are dereferenced together,
+        keeping their order, and that missing documents are left as DBRefs.
+        """
+        class User(Document):
+            name = StringField()
+
+        class Group(Document):
+            members = ListField(ReferenceField(User))
+
+        User.drop_collection()
+        Group.drop_collection()
+
+        users = []
+        for i in range(5):
+            user = User(name='user%s' % i)
+            user.save()
+            users.append(user)
+
+        group = Group(members=list(reversed(users)))
+        group.save()
+        users[2].delete()
+
+        group_obj = Group.objects.first()
+        self.assertTrue(isinstance(group_obj._data['members'][0],
+                                   pymongo.dbref.DBRef))
+
+        # Count the batches of references loaded
+        load_references = mongoengine.fields._load_references
+        calls = []
+        def counting_load_references(references):
+            calls.append(references)
+            return load_references(references)
+        mongoengine.fields._load_references = counting_load_references
+        try:
+            members = group_obj.members
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(len(calls[0]), 5)
+            self.assertTrue(isinstance(members[2], pymongo.dbref.DBRef))
+            names = [user.name for user in members[:2] + members[3:]]
+            self.assertEqual(names, ['user4', 'user3', 'user1', 'user0'])
+
+            # Later reads return the same list without querying again, even
+            # though it holds a dangling reference
+            self.assertTrue(group_obj.members is members)
+            self.assertEqual(len(calls), 1)
+        finally:
+            mongoengine.fields._load_references = load_references
+
+        # The dereferenced list is kept on the document, and can be saved
+        self.assertTrue(isinstance(group_obj._data['members'][0], User))
+        members.append(users[0])
+        group_obj.save()
+        self.assertEqual(len(Group.objects.first().members), 6)
+
+        User.drop_collection()
+        Group.drop_collection()
+
     def test_set_item_dereference(self):
         """Ensure that DBRef items in SetFields are dereferenced.
         """
@@ -2,12 +2,15 @@
 
 
 import unittest
+import threading
 import pymongo
 from datetime import datetime, timedelta
 
 from mongoengine.queryset import (QuerySet, MultipleObjectsReturned,
-                                  ObjectDoesNotExist)
+                                  ObjectDoesNotExist, BulkInsertError,
+                                  _collection_key, _no_aggregation)
 from mongoengine import *
+import mongoengine.queryset
 
 
 class QuerySetTest(unittest.TestCase):
@@ -45,6 +48,37 @@ class QuerySetTest(unittest.TestCase):
         self.assertEqual(QuerySet._transform_query(name__exists=True),
                          {'name': {'$exists': True}})
 
+    def test_query_plans(self):
+        """Ensure that compiled query and update keys are cached for each
+        document class, and that the caches are bounded.
+        """
+        class BlogPost(Document):
+            title = StringField(db_field='t')
+            hits = IntField()
+
+        for i in range(2):
+            self.assertEqual(
+                QuerySet._transform_query(BlogPost, title='a', hits__gt=1),
+                {'t': 'a', 'hits': {'$gt': 1}})
+            self.assertEqual(
+                QuerySet._transform_update(BlogPost, set__title='b',
+                                           dec__hits=2),
+                {'$set': {'t': 'b'}, '$inc': {'hits': -2}})
+        self.assertEqual(sorted(BlogPost._query_plans[1]),
+                         ['hits__gt', 'title'])
+        self.assertEqual(sorted(BlogPost._update_plans[1]),
+                         ['dec__hits', 'set__title'])
+        self.assertRaises(KeyError, QuerySet._transform_query, BlogPost,
+                          content='c')
+
+        size = mongoengine.queryset.QUERY_PLAN_CACHE_SIZE
+        mongoengine.queryset.QUERY_PLAN_CACHE_SIZE = 2
+        try:
+            QuerySet._transform_query(BlogPost, title__ne='a', hits=1)
+            self.assertTrue(len(BlogPost._query_plans[1]) <= 2)
+        finally:
+            mongoengine.queryset.QUERY_PLAN_CACHE_SIZE = size
+
     def test_find(self):
         """Ensure that a query returns a valid set of results.
         """
@@ -142,6 +176,12 @@ class QuerySetTest(unittest.TestCase):
         person = self.Person.objects.with_id(person1.id)
         self.assertEqual(person.name, "User A")
 
+        self.assertTrue(self.Person.objects(age=30).exists())
+        self.assertFalse(self.Person.objects(age=40).exists())
+        self.assertFalse(self.Person.objects[2:].exists())
+        self.assertEqual(self.Person.objects[1:].first().name, "User B")
+        self.assertEqual(self.Person.objects.limit(0).first(), None)
+
     def test_find_only_one(self):
         """Ensure that a query using ``get`` returns at most one result.
         """
@@ -183,6 +223,7 @@ class QuerySetTest(unittest.TestCase):
                           self.Person.objects.get_or_create)
         self.assertRaises(self.Person.MultipleObjectsReturned,
                           self.Person.objects.get_or_create)
+        self.assertEqual(self.Person.objects.count(), 2)
 
         # Use a query to filter the people found to just person2
         person, created = self.Person.objects.get_or_create(age=30)
@@ -199,6 +240,61 @@ class QuerySetTest(unittest.TestCase):
         
         person = self.Person.objects.get(age=50)
         self.assertEqual(person.name, "User C")
+        self.assertEqual(person.id, self.Person.objects.get(age=50).id)
+
+        person, created = self.Person.objects.get_or_create(age=50)
+        self.assertEqual(created, False)
+        self.assertEqual(person.name, "User C")
+        self.assertEqual(self.Person.objects(age=50).count(), 1)
+
+        # A primary key given explicitly is used for the new document
+        person_id = pymongo.objectid.ObjectId()
+        person, created = self.Person.objects.get_or_create(
+            age=60, defaults={'id': person_id, 'name': 'User D'})
+        self.assertEqual(created, True)
+        self.assertEqual(person.id, person_id)
+        self.assertEqual(self.Person.objects.get(age=60).id, person_id)
+        person, created = self.Person.objects.get_or_create(id=person_id)
+        self.assertEqual(created, False)
+        self.assertEqual(person.name, 'User D')
+
+        # An existing document is found even if the query alone wouldn't make
+        # a valid document
+        class Employee(Document):
+            name = StringField(required=True)
+            age = IntField()
+        Employee.drop_collection()
+        Employee(name='User E', age=40).save()
+        employee, created = Employee.objects.get_or_create(age=40)
+        self.assertEqual(created, False)
+        self.assertEqual(employee.name, 'User E')
+        self.assertRaises(ValidationError, Employee.objects.get_or_create,
+                          age=41)
+        Employee.drop_collection()
+
+        # Save signals are only sent when a document is created
+        signals = mongoengine.queryset.signals
+        if signals is not None:
+            saved = []
+            def pre_save(sender, instance, **kwargs):
+                saved.append(instance.age)
+            signals.pre_save.connect(pre_save, sender=self.Person)
+            try:
+                self.Person.objects.get_or_create(age=60)
+                self.Person.objects.get_or_create(age=70)
+            finally:
+                signals.pre_save.disconnect(pre_save, sender=self.Person)
+            self.assertEqual(saved, [70])
+
+            # Receivers for other classes don't affect Person
+            _has_receivers = mongoengine.queryset._has_receivers
+            signals.pre_save.connect(pre_save, sender=Employee)
+            try:
+                self.assertFalse(_has_receivers(signals.pre_save,
+                                                self.Person))
+                self.assertTrue(_has_receivers(signals.pre_save, Employee))
+            finally:
+                signals.pre_save.disconnect(pre_save, sender=Employee)
 
     def test_repeated_iteration(self):
         """Ensure that QuerySet rewinds itself one iteration finishes.
@@ -212,6 +308,46 @@ class QuerySetTest(unittest.TestCase):
 
         self.assertEqual(people1, people2)
 
+    def test_result_cache(self):
+        """Ensure that the results of iterating over a QuerySet are cached,
+        unless no_cache is used.
+        """
+        self.Person(name='Person 1').save()
+        self.Person(name='Person 2').save()
+
+        queryset = self.Person.objects.order_by('name')
+        people = list(queryset)
+        self.assertEqual(len(people), 2)
+
+        # Later reads are served from the cache
+        self.Person.objects(name='Person 2').delete()
+        self.assertEqual(len(queryset), 2)
+        self.assertTrue(queryset)
+        self.assertEqual(queryset[1].name, 'Person 2')
+        self.assertEqual(list(queryset), people)
+        self.assertTrue('Person 2' in repr(queryset))
+
+        queryset.rewind()
+        self.assertEqual(len(list(queryset)), 1)
+
+        queryset = self.Person.objects.no_cache()
+        self.assertEqual(len(list(queryset)), 1)
+        self.Person(name='Person 3').save()
+        self.assertEqual(len(list(queryset)), 2)
+        self.assertEqual(len(queryset), 2)
+
+        self.assertFalse(self.Person.objects(name='Person 4'))
+
+        # The length of a sliced queryset is the same before and after the
+        # results are cached
+        queryset = self.Person.objects[:1]
+        self.assertEqual(len(queryset), 1)
+        list(queryset)
+        self.assertEqual(len(queryset), 1)
+        self.assertEqual(self.Person.objects[:1].count(), 2)
+        self.assertEqual(
+            self.Person.objects[1:].count(with_limit_and_skip=True), 1)
+
     def test_regex_query_shortcuts(self):
         """Ensure that contains, startswith, endswith, etc work.
         """
@@ -302,6 +438,37 @@ class QuerySetTest(unittest.TestCase):
 
         BlogPost.drop_collection()
 
+    def test_clone(self):
+        """Ensure that refining a QuerySet returns a new QuerySet, leaving
+        the original unchanged.
+        """
+        for i in range(5):
+            self.Person(name='Person %d' % i, age=i * 10).save()
+
+        queryset = self.Person.objects(age__gte=10)
+        ordered = queryset.order_by('-age')
+        self.assertFalse(ordered is queryset)
+        self.assertEqual(ordered.first().name, 'Person 4')
+        self.assertEqual(queryset.count(), 4)
+
+        older = queryset.filter(age__gte=30)
+        self.assertEqual(older.count(), 2)
+        self.assertEqual(queryset.count(), 4)
+
+        page = ordered[1:3]
+        self.assertEqual([p.name for p in page], ['Person 3', 'Person 2'])
+        self.assertEqual([p.name for p in page[1:]], ['Person 2'])
+        self.assertEqual(list(page[2:]), [])
+        self.assertEqual(len(list(ordered)), 4)
+
+        names = ordered.only('name').limit(2)
+        self.assertEqual([p.age for p in names], [None, None])
+        self.assertEqual([p.age for p in ordered.limit(2)], [40, 30])
+
+        clone = ordered.clone()
+        self.assertEqual(clone._query, ordered._query)
+        self.assertFalse(clone._query is ordered._query)
+
     def test_ordering(self):
         """Ensure default ordering is applied and can be overridden.
         """
@@ -460,6 +627,22 @@ class QuerySetTest(unittest.TestCase):
         self.assertEqual(len(self.Person.objects(Q(age__in=[20]))), 2)
         self.assertEqual(len(self.Person.objects(Q(age__in=[20, 30]))), 3)
 
+        # Check negation, and filtering with several Q objects
+        people = self.Person.objects(~(Q(age=20) | Q(name='user4')))
+        self.assertEqual([p.name for p in people], ['user3'])
+        people = self.Person.objects(Q(age=20) | Q(age=30))
+        people = people.filter(Q(name='user1') | Q(name='user3'))
+        self.assertEqual(sorted(p.name for p in people), ['user1', 'user3'])
+
+        # Q objects and keyword arguments on the same field must all match
+        people = self.Person.objects(Q(age__gte=25), age__lte=35)
+        self.assertEqual(people._query['age'], {'$gte': 25, '$lte': 35})
+        self.assertEqual([p.name for p in people], ['user3'])
+        people = self.Person.objects(Q(age__gte=25), age__gte=35)
+        self.assertEqual([p.name for p in people], ['user4'])
+        people = self.Person.objects(age__gte=25).filter(age__lte=35)
+        self.assertEqual([p.name for p in people], ['user3'])
+
     def test_q_regex(self):
         """Ensure that Q objects can be queried using regexes.
         """
@@ -627,6 +810,220 @@ class QuerySetTest(unittest.TestCase):
 
         BlogPost.drop_collection()
 
+    def test_paginate_after(self):
+        """Ensure that pages of documents may be read using range
+        conditions on the ordering keys.
+        """
+        for i in range(10):
+            self.Person(name='Person %d' % i, age=i // 3).save()
+
+        queryset = self.Person.objects.order_by('-age')
+        names = []
+        last = None
+        while True:
+            page = list(queryset.paginate_after(last, 4))
+            if not page:
+                break
+            self.assertTrue(len(page) <= 4)
+            names += [person.name for person in page]
+            last = queryset.page_token(page[-1])
+        self.assertEqual(len(names), 10)
+        self.assertEqual(len(set(names)), 10)
+        ages = [self.Person.objects.get(name=name).age for name in names]
+        self.assertEqual(ages, sorted(ages, reverse=True))
+
+        # Documents and raw dictionaries may be given instead of tokens
+        first = list(queryset.paginate_after(None, 3))
+        second = list(queryset.paginate_after(first[-1], 3))
+        raw = list(queryset.as_pymongo().paginate_after(None, 3))
+        self.assertEqual(list(queryset.paginate_after(raw[-1], 3)), second)
+        self.assertEqual([p.name for p in first + second], names[:6])
+
+        self.assertRaises(InvalidQueryError, queryset.paginate_after,
+                          'invalid', 3)
+        token = self.Person.objects.page_token(first[-1])
+        self.assertRaises(InvalidQueryError, queryset.paginate_after,
+                          token, 3)
+
+    def test_partition(self):
+        """Ensure that a QuerySet may be split into querysets selecting
+        disjoint sets of documents.
+        """
+        for i in range(20):
+            self.Person(name='Person %02d' % i, age=i).save()
+
+        for field in ('id', 'age', 'name'):
+            querysets = self.Person.objects(age__gte=4).partition(4, field)
+            self.assertEqual(len(querysets), 4)
+            names = []
+            for queryset in querysets:
+                names += [person.name for person in queryset]
+            self.assertEqual(sorted(names),
+                             ['Person %02d' % i for i in range(4, 20)])
+
+        self.assertEqual(len(self.Person.objects.partition(1)), 1)
+        self.assertEqual(len(self.Person.objects(age=50).partition(4)), 1)
+        self.assertRaises(InvalidQueryError, self.Person.objects[:5].partition,
+                          2)
+
+    def test_parallel_map(self):
+        """Ensure that a function may be applied to documents from several
+        threads.
+        """
+        for i in range(20):
+            self.Person(name='Person %02d' % i, age=i).save()
+
+        ages = self.Person.objects.parallel_map(lambda person: person.age,
+                                                workers=3)
+        self.assertEqual(sorted(ages), range(20))
+        self.assertEqual(self.Person.objects.parallel_map(
+            lambda person: None, workers=3, collect=False), 20)
+
+        def check(person):
+            if person.age >= 10:
+                raise ValueError(person.age)
+            return person.age
+
+        try:
+            self.Person.objects.parallel_map(check, workers=2, field='age')
+        except ParallelMapError, e:
+            self.assertEqual(len(e.errors), 1)
+            self.assertTrue(isinstance(e.errors[0][1], ValueError))
+            self.assertEqual(sorted(e.results), range(10))
+        else:
+            self.fail('ParallelMapError not raised')
+
+    def test_cursor_options(self):
+        """Ensure that cursor options are kept by clones and applied to the
+        cursor.
+        """
+        class BlogPost(Document):
+            title = StringField(db_field='t')
+            date = DateTimeField()
+            meta = {'indexes': ['-date', ('title', '-date')]}
+
+        BlogPost.drop_collection()
+        for i in range(5):
+            BlogPost(title='Post %d' % i, date=datetime(2010, 1, i + 1)).save()
+
+        self.assertEqual(BlogPost.objects.hint('-date')._hint,
+                         [('_types', 1), ('date', -1)])
+        self.assertEqual(BlogPost.objects.hint(['title', '-date'])._hint,
+                         [('_types', 1), ('t', 1), ('date', -1)])
+        self.assertEqual(BlogPost.objects.hint('_types_1_date_-1')._hint,
+                         [('_types', 1), ('date', -1)])
+        self.assertRaises(InvalidQueryError, BlogPost.objects.hint, 'body')
+
+        queryset = BlogPost.objects.batch_size(2).hint('-date')
+        queryset = queryset.no_cursor_timeout().filter(title__ne='Post 0')
+        self.assertEqual(queryset._batch_size, 2)
+        self.assertEqual(len(list(queryset)), 4)
+        self.assertEqual(len(list(BlogPost.objects.snapshot())), 5)
+
+        # Options the installed PyMongo can't apply are refused when chained
+        if mongoengine.queryset.PYMONGO_VERSION < (2, 7):
+            self.assertRaises(OperationError, BlogPost.objects.max_time_ms,
+                              100)
+            self.assertRaises(OperationError, BlogPost.objects.comment, 'x')
+        else:
+            queryset = BlogPost.objects.max_time_ms(1000).comment('export')
+            self.assertEqual(len(list(queryset)), 5)
+
+        BlogPost.drop_collection()
+
+    def test_tail(self):
+        """Ensure that documents inserted into a capped collection are read
+        by tailable cursors.
+        """
+        class Job(Document):
+            name = StringField()
+            meta = {'max_documents': 10, 'max_size': 90000}
+
+        Job.drop_collection()
+        for i in range(3):
+            Job(name='Job %d' % i).save()
+
+        stop = threading.Event()
+        jobs = Job.objects(name__ne='Job 1').tail(await_data=False,
+                                                  poll_interval=0.01,
+                                                  stop=stop)
+        self.assertEqual(jobs.next().name, 'Job 0')
+        self.assertEqual(jobs.next().name, 'Job 2')
+        Job(name='Job 3').save()
+        self.assertEqual(jobs.next().name, 'Job 3')
+        stop.set()
+        self.assertRaises(StopIteration, jobs.next)
+
+        names = []
+        def callback(job):
+            names.append(job.name)
+            if len(names) == 5:
+                stop.set()
+        stop = threading.Event()
+        thread = Job.objects.tail(poll_interval=0.01, callback=callback,
+                                  stop=stop)
+        Job(name='Job 4').save()
+        thread.join(10)
+        self.assertFalse(thread.isAlive())
+        self.assertEqual(names, ['Job %d' % i for i in range(5)])
+
+        self.assertRaises(InvalidQueryError, Job.objects.order_by('name').tail)
+        self.assertRaises(InvalidQueryError, Job.objects[:5].tail)
+
+        # References are loaded for tailed documents with select_related
+        class Task(Document):
+            job = ReferenceField(Job)
+            meta = {'max_documents': 10, 'max_size': 90000}
+
+        Task.drop_collection()
+        Task(job=Job.objects.get(name='Job 0')).save()
+        stop = threading.Event()
+        tasks = Task.objects.select_related().tail(await_data=False,
+                                                   poll_interval=0.01,
+                                                   stop=stop)
+        task = tasks.next()
+        stop.set()
+        self.assertTrue(isinstance(task._data['job'], Job))
+        self.assertEqual(task._data['job'].name, 'Job 0')
+
+        Task.drop_collection()
+        Job.drop_collection()
+
+    def test_modify(self):
+        """Ensure that documents may be atomically updated and returned.
+        """
+        self.Person(name='User A', age=20).save()
+        self.Person(name='User B', age=30).save()
+
+        person = self.Person.objects.order_by('-age').modify(inc__age=1)
+        self.assertEqual(person.name, 'User B')
+        self.assertEqual(person.age, 31)
+
+        person = self.Person.objects(name='User A').modify(new=False,
+                                                           set__age=25)
+        self.assertEqual(person.age, 20)
+        self.assertEqual(self.Person.objects.get(name='User A').age, 25)
+
+        person = self.Person.objects(name='User A').only('name').modify(
+            set__age=26)
+        self.assertEqual(person.name, 'User A')
+        self.assertEqual(person.age, None)
+
+        self.assertEqual(self.Person.objects(name='User C').modify(
+            set__age=40), None)
+        person = self.Person.objects(name='User C').modify(upsert=True,
+                                                           set__age=40)
+        self.assertEqual(person.age, 40)
+        self.assertEqual(self.Person.objects(name='User C').count(), 1)
+
+        person = self.Person.objects(name='User C').modify(remove=True)
+        self.assertEqual(person.name, 'User C')
+        self.assertEqual(self.Person.objects(name='User C').count(), 0)
+
+        self.assertRaises(InvalidQueryError, self.Person.objects.modify)
+        self.assertRaises(InvalidQueryError, self.Person.objects.modify,
+                          remove=True, set__age=1)
+
     def test_update_pull(self):
         """Ensure that the 'pull' update operation works correctly.
         """
@@ -931,6 +1328,90 @@ class QuerySetTest(unittest.TestCase):
         self.Person(name='ageless person').save()
         self.assertEqual(int(self.Person.objects.sum('age')), sum(ages))
 
+    def test_aggregation_fallback(self):
+        """Ensure that sum, average and item_frequencies are computed client
+        side when the server doesn't support aggregation.
+        """
+        class BlogPost(Document):
+            hits = IntField(db_field='h')
+            tags = ListField(StringField(), db_field='blogTags')
+
+        BlogPost.drop_collection()
+
+        BlogPost(hits=1, tags=['music', 'film']).save()
+        BlogPost(hits=2, tags=['music']).save()
+        BlogPost(hits=5).save()
+        BlogPost().save()
+
+        def aggregate():
+            return (BlogPost.objects.sum('hits'),
+                    BlogPost.objects.average('hits'),
+                    BlogPost.objects.item_frequencies('tags'),
+                    BlogPost.objects(hits__gt=1).item_frequencies('tags'))
+        results = aggregate()
+
+        server = _collection_key(BlogPost.objects._collection)[:2]
+        _no_aggregation.add(server)
+        try:
+            self.assertEqual(aggregate(), results)
+            self.assertEqual(aggregate(), (8, 8 / 3.0, {'music': 2, 'film': 1},
+                                           {'music': 1}))
+        finally:
+            _no_aggregation.discard(server)
+
+        BlogPost.drop_collection()
+
+    def test_aggregate(self):
+        """Ensure that aggregation pipelines are run over the selected
+        documents, with field names translated.
+        """
+        class BlogPost(Document):
+            title = StringField(db_field='postTitle')
+            hits = IntField(db_field='h')
+            tags = ListField(StringField(), db_field='blogTags')
+
+        BlogPost.drop_collection()
+
+        BlogPost(title='A', hits=1, tags=['music', 'film']).save()
+        BlogPost(title='B', hits=2, tags=['music']).save()
+        BlogPost(title='C', hits=3, tags=['music', 'actors']).save()
+        BlogPost(title='D', hits=4, tags=['film']).save()
+
+        results = BlogPost.objects(hits__lte=3).aggregate(
+            {'$unwind': '$~tags'},
+            {'$group': {'_id': '$~tags', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1}},
+        )
+        self.assertEqual([(r['_id'], r['count']) for r in results][0],
+                         ('music', 3))
+
+        # Ordering, skip and limit are applied before the given stages
+        results = BlogPost.objects.order_by('-hits')[1:3].aggregate(
+            {'$project': {'~title': 1}})
+        self.assertEqual([r['postTitle'] for r in results], ['C', 'B'])
+
+        # Results are received in batches through a cursor, which older
+        # versions of PyMongo can't return
+        if mongoengine.queryset.PYMONGO_VERSION < (2, 7):
+            self.assertRaises(OperationError, BlogPost.objects.pipeline,
+                              batch_size=2)
+            self.assertRaises(OperationError, BlogPost.objects.aggregate,
+                              {'$project': {'~title': 1}}, batch_size=2)
+        else:
+            pipeline = BlogPost.objects.pipeline(batch_size=2)
+            pipeline.match(hits__gte=2).unwind('~tags')
+            pipeline.group('$~tags', hits={'$sum': '$~hits'}).sort('-hits')
+            results = [(r['_id'], r['hits']) for r in pipeline]
+            self.assertEqual(results,
+                             [('music', 5), ('film', 4), ('actors', 3)])
+
+            results = BlogPost.objects.order_by('hits').aggregate(
+                {'$project': {'~title': 1}}, batch_size=1)
+            self.assertEqual([r['postTitle'] for r in results],
+                             ['A', 'B', 'C', 'D'])
+
+        BlogPost.drop_collection()
+
     def test_custom_manager(self):
         """Ensure that custom QuerySetManager instances work as expected.
         """
@@ -1099,6 +1580,231 @@ class QuerySetTest(unittest.TestCase):
 
         BlogPost.drop_collection()
 
+    def test_select_related(self):
+        """Ensure that references are loaded for a whole batch of results
+        when select_related is used.
+        """
+        class Company(Document):
+            name = StringField()
+
+        class Author(Document):
+            name = StringField()
+            company = ReferenceField(Company)
+
+        class BlogPost(Document):
+            title = StringField()
+            author = ReferenceField(Author)
+
+        Company.drop_collection()
+        Author.drop_collection()
+        BlogPost.drop_collection()
+
+        company = Company(name='Test Company')
+        company.save()
+        for i in range(3):
+            author = Author(name='Author %s' % i, company=company)
+            author.save()
+            BlogPost(title='Post %s' % i, author=author).save()
+
+        posts = list(BlogPost.objects.select_related('author'))
+        self.assertEqual(len(posts), 3)
+        for post in posts:
+            self.assertTrue(isinstance(post._data['author'], Author))
+            self.assertTrue(isinstance(post._data['author']._data['company'],
+                                       pymongo.dbref.DBRef))
+
+        posts = list(BlogPost.objects.select_related(depth=2))
+        for post in posts:
+            company_obj = post._data['author']._data['company']
+            self.assertTrue(isinstance(company_obj, Company))
+            self.assertEqual(company_obj.name, 'Test Company')
+
+        post = BlogPost.objects.select_related()[0]
+        self.assertTrue(isinstance(post._data['author'], Author))
+
+        Company.drop_collection()
+        Author.drop_collection()
+        BlogPost.drop_collection()
+
+    def test_lazy_hydration(self):
+        """Ensure that lazily hydrated documents only convert values when
+        their fields are accessed.
+        """
+        class Comment(EmbeddedDocument):
+            content = StringField()
+
+        class BlogPost(Document):
+            title = StringField()
+            comments = ListField(EmbeddedDocumentField(Comment))
+            meta = {'lazy_hydration': True}
+
+        BlogPost.drop_collection()
+
+        BlogPost(title='Test', comments=[Comment(content='Good')]).save()
+
+        post = BlogPost.objects.first()
+        self.assertTrue('comments' in post._data._converters)
+        self.assertEqual(post.title, 'Test')
+        self.assertTrue('comments' in post._data._converters)
+
+        self.assertEqual(post.comments[0].content, 'Good')
+        self.assertFalse('comments' in post._data._converters)
+
+        # Lazy hydration may be turned off for a single queryset
+        post = BlogPost.objects.lazy_hydration(False).first()
+        self.assertFalse(hasattr(post._data, '_converters'))
+        self.assertTrue(isinstance(post._data['comments'][0], Comment))
+
+        # Unhydrated values aren't converted when saving, and are written
+        # back unchanged
+        post = BlogPost.objects.first()
+        post.title = 'Updated'
+        post.save()
+        self.assertTrue('comments' in post._data._converters)
+        self.assertEqual(post.to_mongo()['comments'][0]['content'], 'Good')
+        self.assertTrue('comments' in post._data._converters)
+        post = BlogPost.objects.lazy_hydration(False).first()
+        self.assertEqual(post.title, 'Updated')
+        self.assertEqual(post.comments[0].content, 'Good')
+
+        # Changing the values directly doesn't leave stale converters behind
+        post = BlogPost.objects.first()
+        del post._data['comments']
+        self.assertEqual(post._data.get('comments'), None)
+        post._data.update(comments=[Comment(content='New')])
+        self.assertEqual(post._data.setdefault('comments')[0].content, 'New')
+        post = BlogPost.objects.first()
+        self.assertEqual(post._data.pop('comments')[0].content, 'Good')
+        self.assertFalse('comments' in post._data._converters)
+
+        BlogPost.drop_collection()
+
+    def test_values_list(self):
+        """Ensure that raw dictionaries and field values may be returned
+        instead of documents.
+        """
+        class Author(EmbeddedDocument):
+            name = StringField(db_field='n')
+
+        class BlogPost(Document):
+            title = StringField(db_field='t')
+            hits = IntField()
+            published_date = DateTimeField()
+            author = EmbeddedDocumentField(Author)
+
+        BlogPost.drop_collection()
+
+        date = datetime(2010, 1, 1)
+        post = BlogPost(title='Test', hits=5, published_date=date,
+                        author=Author(name='Bob'))
+        post.save()
+        other = BlogPost(title='Other')
+        other.save()
+
+        son = BlogPost.objects(title='Test').as_pymongo().first()
+        self.assertTrue(isinstance(son, dict))
+        self.assertEqual(son['t'], 'Test')
+        self.assertEqual(son['author'], {'n': 'Bob'})
+
+        queryset = BlogPost.objects.order_by('title')
+        self.assertEqual(list(queryset.values_list('title', 'author.name')),
+                         [(u'Other', None), (u'Test', u'Bob')])
+        self.assertEqual(list(queryset.values_list('title', flat=True)),
+                         [u'Other', u'Test'])
+        self.assertEqual(list(queryset.scalar('id', 'hits')),
+                         [(other.id, None), (post.id, 5)])
+        self.assertEqual(BlogPost.objects(title='Test').scalar(
+            'published_date')[0], date)
+
+        # Only the requested fields are loaded
+        son = BlogPost.objects.values_list('hits').as_pymongo().first()
+        self.assertEqual(set(son.keys()), set(['_id', 'hits']))
+
+        self.assertRaises(InvalidQueryError, BlogPost.objects.values_list,
+                          'title', 'hits', flat=True)
+
+        BlogPost.drop_collection()
+
+    def test_insert(self):
+        """Ensure that many documents may be inserted at once.
+        """
+        class Blog(Document):
+            title = StringField(unique=True)
+            tags = ListField(StringField())
+
+        Blog.drop_collection()
+
+        blogs = [Blog(title='Blog %d' % i, tags=['tag%d' % i])
+                 for i in range(10)]
+        result = Blog.objects.insert(blogs, batch_size=3)
+        self.assertEqual(result, blogs)
+        self.assertEqual(Blog.objects.count(), 10)
+        for blog in blogs:
+            self.assertTrue(blog.id is not None)
+            self.assertEqual(Blog.objects.with_id(blog.id).title, blog.title)
+
+        blog = Blog(title='Single')
+        blog_id = Blog.objects.insert(blog, load_bulk=False)
+        self.assertEqual(blog_id, blog.id)
+
+        # Inserted documents are updated with save rather than inserted again
+        blog.title = 'Single blog'
+        blog.save()
+        self.assertEqual(Blog.objects.count(), 11)
+
+        # Duplicates are reported per document
+        blogs = [Blog(title='New 1'), Blog(title='Blog 1'),
+                 Blog(title='New 2'), Blog(title='Blog 2')]
+        try:
+            Blog.objects.insert(blogs)
+            self.fail('BulkInsertError was not raised')
+        except BulkInsertError, err:
+            self.assertEqual([e[0] for e in err.errors], [1, 3])
+            self.assertTrue(err.errors[0][1] is blogs[1])
+            self.assertEqual(err.inserted, [blogs[0], blogs[2]])
+        self.assertEqual(Blog.objects.count(), 13)
+        self.assertTrue(blogs[1].id is None)
+
+        # Ordered inserts stop at the first failure
+        blogs = [Blog(title='New 3'), Blog(title='Blog 3'),
+                 Blog(title='New 4')]
+        self.assertRaises(BulkInsertError, Blog.objects.insert, blogs,
+                          ordered=True)
+        self.assertEqual(Blog.objects(title='New 3').count(), 1)
+        self.assertEqual(Blog.objects(title='New 4').count(), 0)
+
+        # Documents whose id is already used aren't reported as inserted
+        existing = Blog.objects.get(title='Blog 5')
+        blogs = [Blog(title='New 5'), Blog(id=existing.id, title='New 6'),
+                 Blog(title='New 7')]
+        try:
+            Blog.objects.insert(blogs)
+            self.fail('BulkInsertError was not raised')
+        except BulkInsertError, err:
+            self.assertEqual([e[0] for e in err.errors], [1])
+            self.assertEqual(err.inserted, [blogs[0], blogs[2]])
+        self.assertTrue(blogs[1]._created)
+        self.assertEqual(Blog.objects.with_id(existing.id).title, 'Blog 5')
+        self.assertEqual(Blog.objects(title='New 7').count(), 1)
+
+        # Documents with new ids inserted before the failure are reported as
+        # inserted, wherever they are in the batch
+        blogs = [Blog(id=pymongo.objectid.ObjectId(), title='New 8'),
+                 Blog(title='Blog 6')]
+        try:
+            Blog.objects.insert(blogs)
+            self.fail('BulkInsertError was not raised')
+        except BulkInsertError, err:
+            self.assertEqual([e[0] for e in err.errors], [1])
+            self.assertEqual(err.inserted, [blogs[0]])
+        self.assertFalse(blogs[0]._created)
+        self.assertEqual(Blog.objects.with_id(blogs[0].id).title, 'New 8')
+
+        self.assertRaises(OperationError, Blog.objects.insert,
+                          [self.Person(name='Test')])
+
+        Blog.drop_collection()
+
     def tearDown(self):
         self.Person.drop_collection()
 
@@ -1176,37 +1882,65 @@ class QuerySetTest(unittest.TestCase):
 
 class QTest(unittest.TestCase):
 
+    def setUp(self):
+        class Person(Document):
+            name = StringField(db_field='n')
+            age = IntField()
+        self.Person = Person
+
     def test_or_and(self):
         """Ensure that Q objects may be combined correctly.
         """
         q1 = Q(name='test')
         q2 = Q(age__gte=18)
 
-        query = ['(', {'name': 'test'}, '||', {'age__gte': 18}, ')']
-        self.assertEqual((q1 | q2).query, query)
+        query = {'$or': [{'n': 'test'}, {'age': {'$gte': 18}}]}
+        self.assertEqual((q1 | q2).to_query(self.Person), query)
+
+        query = {'n': 'test', 'age': {'$gte': 18}}
+        self.assertEqual((q1 & q2).to_query(self.Person), query)
 
-        query = ['(', {'name': 'test'}, '&&', {'age__gte': 18}, ')']
-        self.assertEqual((q1 & q2).query, query)
+        query = {'$or': [{'n': 'test', 'age': {'$gte': 18}},
+                         {'n': 'example'}]}
+        self.assertEqual((q1 & q2 | Q(name='example')).to_query(self.Person),
+                         query)
 
-        query = ['(', '(', {'name': 'test'}, '&&', {'age__gte': 18}, ')', '||',
-                 {'name': 'example'}, ')']
-        self.assertEqual((q1 & q2 | Q(name='example')).query, query)
+        # Conditions on the same field are merged where possible
+        query = {'age': {'$gte': 18, '$lt': 65}}
+        self.assertEqual((q2 & Q(age__lt=65)).to_query(self.Person), query)
+        query = {'age': {'$gte': 18}, '$and': [{'age': {'$gte': 21}}]}
+        self.assertEqual((q2 & Q(age__gte=21)).to_query(self.Person), query)
 
-    def test_item_query_as_js(self):
-        """Ensure that the _item_query_as_js utilitiy method works properly.
+    def test_flatten(self):
+        """Ensure that nested Q objects of the same type are flattened.
         """
-        q = Q()
-        examples = [
-            ({'name': 'test'}, 'this.name == i0f0', {'i0f0': 'test'}),
-            ({'age': {'$gt': 18}}, 'this.age > i0f0o0', {'i0f0o0': 18}),
-            ({'name': 'test', 'age': {'$gt': 18, '$lte': 65}},
-             'this.age <= i0f0o0 && this.age > i0f0o1 && this.name == i0f1',
-             {'i0f0o0': 65, 'i0f0o1': 18, 'i0f1': 'test'}),
-        ]
-        for item, js, scope in examples:
-            test_scope = {}
-            self.assertEqual(q._item_query_as_js(item, test_scope, 0), js)
-            self.assertEqual(scope, test_scope)
+        q = Q(age=0)
+        for i in range(1, 5):
+            q = q | Q(age=i)
+        query = {'$or': [{'age': i} for i in range(5)]}
+        self.assertEqual(q.to_query(self.Person), query)
+
+        q = (Q(age=0) | Q(age=1)) | (Q(age=2) | (Q(age=3) | Q(age=4)))
+        self.assertEqual(q.to_query(self.Person), query)
+
+        q = Q(age=0) | (Q(name='a') & (Q(name='b') & Q(age__gt=1)))
+        query = {'$or': [{'age': 0}, {'n': 'a', 'age': {'$gt': 1},
+                                      '$and': [{'n': 'b'}]}]}
+        self.assertEqual(q.to_query(self.Person), query)
+
+    def test_not(self):
+        """Ensure that Q objects may be negated.
+        """
+        q = ~(Q(name='test') | Q(age__gte=18))
+        query = {'$nor': [{'n': 'test'}, {'age': {'$gte': 18}}]}
+        self.assertEqual(q.to_query(self.Person), query)
+
+        q = ~(Q(name='test') & Q(age__gte=18))
+        query = {'$nor': [{'n': 'test', 'age': {'$gte': 18}}]}
+        self.assertEqual(q.to_query(self.Person), query)
+
+        self.assertEqual((~~Q(name='test')).to_query(self.Person),
+                         {'n': 'test'})
 
 if __name__ == '__main__':
     unittest.main()